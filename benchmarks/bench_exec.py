@@ -0,0 +1,85 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Benchmark per-command latency of `SSHConnection.exec`.
+
+Compares the current reader with the former 100 ms select polling loop
+against a local paramiko server, optionally behind a latency proxy.
+
+>>> python benchmarks/bench_exec.py --latency 20 -n 50     # doctest: +SKIP
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+from select import select
+from datetime import datetime
+
+sys.path.append(os.path.abspath(f'{__file__}/../..'))
+
+from server import serve
+from xbot.plugins.ssh.ssh import SSHConnection
+
+
+def legacy_exec(conn: SSHConnection, cmd: str, timeout: int = 15) -> int:
+    """
+    The former `exec` reading loop (select with 100 ms timeout).
+    """
+    _, stdout, _ = conn._sshclient.exec_command(cmd, get_pty=True)
+    start = datetime.now()
+    output = ''
+    while (datetime.now() - start).seconds <= timeout:
+        rlist, _, _ = select([stdout.channel], [], [], 0.1)
+        if stdout.channel in rlist:
+            data = stdout.channel.recv(1024).decode(errors='ignore')
+            output += data
+            if data == '':
+                break
+    return stdout.channel.recv_exit_status()
+
+
+def measure(func, n: int) -> list:
+    """
+    Call `func` `n` times and return the latencies (ms).
+    """
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list) -> None:
+    print(f'{name:<12} mean {statistics.mean(latencies):8.2f} ms   '
+          f'median {statistics.median(latencies):8.2f} ms   '
+          f'max {max(latencies):8.2f} ms')
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=30,
+                        help='commands to execute per engine.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated round-trip time(ms).')
+    parser.add_argument('--cmd', default='true',
+                        help='command to execute.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    server, proxy, port = serve('xbot', 'xbot', args.latency)
+    conn = SSHConnection()
+    conn.connect('127.0.0.1', 'xbot', 'xbot', port)
+    transport = conn.transport
+    rtt = measure(lambda: transport.global_request('keepalive@xbot', wait=True),
+                  args.number)
+    report('round-trip', rtt)
+    report('legacy', measure(lambda: legacy_exec(conn, args.cmd), args.number))
+    report('exec', measure(lambda: conn.exec(args.cmd), args.number))
+    conn.disconnect()
+    server.stop()
@@ -0,0 +1,121 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Benchmark output sanitizing of `SSHCommandResult`.
+
+Compares the former four passes (regex compiled on each call, generator
+over `string.printable`, `splitlines`/`join`, `strip`) with `sanitize`
+on realistic command outputs, and checks that both give the same result.
+
+>>> python benchmarks/bench_sanitize.py --size 50     # doctest: +SKIP
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import string
+import argparse
+
+sys.path.append(os.path.abspath(f'{__file__}/../..'))
+
+from xbot.plugins.ssh.utils import sanitize
+
+
+def legacy_sanitize(s: str) -> str:
+    """
+    The former `SSHCommandResult.__new__` passes.
+    """
+    escapes = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+    s = escapes.sub('', s)
+    s = ''.join(c for c in s if c in string.printable)
+    s = '\n'.join(s.splitlines())
+    return s.strip()
+
+
+def colored_ls(rnd: random.Random) -> str:
+    """
+    A line of `ls -l --color=always`.
+    """
+    color = rnd.choice(['01;34', '01;32', '01;36', '0'])
+    name = ''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(4, 16)))
+    return (f'-rw-r--r-- 1 xbot xbot {rnd.randint(0, 10 ** 9):>10} Jan  1 00:00 '
+            f'\x1b[{color}m{name}\x1b[0m\r\n')
+
+
+def top_batch(rnd: random.Random) -> str:
+    """
+    A line of `top -b`.
+    """
+    return (f'{rnd.randint(1, 99999):>7} xbot      20   0 {rnd.randint(0, 10 ** 7):>8} '
+            f'{rnd.randint(0, 10 ** 6):>6} {rnd.randint(0, 10 ** 5):>6} S  '
+            f'{rnd.random() * 100:4.1f}  {rnd.random() * 10:3.1f}   0:00.{rnd.randint(0, 99):02d} '
+            f'python3\r\n')
+
+
+def progress_bar(rnd: random.Random) -> str:
+    """
+    Redraws of a progress bar (`curl`, `pip`, `wget` ...).
+    """
+    parts = []
+    for p in range(0, 101, 5):
+        bar = '=' * (p // 5) + '>' + ' ' * (20 - p // 5)
+        parts.append(f'\r\x1b[K {p:3d}% [{bar}] {rnd.random() * 100:5.1f}MB/s')
+    return ''.join(parts) + '\r\n'
+
+
+def unicode_mixed(rnd: random.Random) -> str:
+    """
+    A line with non-ASCII characters (file names, locales).
+    """
+    name = ''.join(rnd.choices('abcdé中文日本語ü', k=rnd.randint(4, 16)))
+    return f'\x1b[1m{name}\x1b[0m — ok\r\n'
+
+
+GENERATORS = {
+    'ls --color': colored_ls,
+    'top -b': top_batch,
+    'progress': progress_bar,
+    'unicode': unicode_mixed,
+}
+
+
+def generate(generator, size: int) -> str:
+    """
+    Output of about `size` characters made of lines of `generator`.
+    """
+    rnd = random.Random(0)
+    lines, n = [], 0
+    while n < size:
+        line = generator(rnd)
+        lines.append(line)
+        n += len(line)
+    return ''.join(lines)
+
+
+def measure(func, s: str) -> float:
+    """
+    Call `func(s)` and return the throughput (MB/s).
+    """
+    start = time.perf_counter()
+    func(s)
+    return len(s) / 1048576 / (time.perf_counter() - start)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=10,
+                        help='output size(MB).')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    size = int(args.size * 1048576)
+    for name, generator in GENERATORS.items():
+        s = generate(generator, size)
+        assert sanitize(s) == legacy_sanitize(s), name
+        old, new = measure(legacy_sanitize, s), measure(sanitize, s)
+        print(f'{name:<12} legacy {old:9.2f} MB/s   sanitize {new:9.2f} MB/s   '
+              f'x{new / old:.2f}')
@@ -0,0 +1,72 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Benchmark SFTP file transfer throughput.
+
+Compares `SFTPClient.get`/`put` (the former path of `getfile`/`putfile`)
+with the chunked `FileTransfer` against a local paramiko server,
+optionally behind a latency proxy.
+
+>>> python benchmarks/bench_sftp.py --latency 20 --size 64     # doctest: +SKIP
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.append(os.path.abspath(f'{__file__}/../..'))
+
+from server import serve
+from xbot.plugins.ssh.sftp import SFTPConnection
+from xbot.plugins.ssh.transfer import FileTransfer
+
+
+def measure(func, size: int) -> float:
+    """
+    Call `func` and return the throughput (MB/s) for `size` bytes.
+    """
+    start = time.perf_counter()
+    func()
+    return size / 1048576 / (time.perf_counter() - start)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=32,
+                        help='file size(MB).')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated round-trip time(ms).')
+    parser.add_argument('--chunksize', type=int, default=FileTransfer.CHUNKSIZE,
+                        help='range size(bytes) of FileTransfer.')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='channels of FileTransfer.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    server, proxy, port = serve('xbot', 'xbot', args.latency)
+    conn = SFTPConnection()
+    conn.connect('127.0.0.1', 'xbot', 'xbot', port)
+    client = conn._sftpclient
+    transfer = FileTransfer(client, args.chunksize, args.concurrency)
+    size = args.size * 1048576
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'src')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(size))
+        dst = os.path.join(tmp, 'dst')
+        local = os.path.join(tmp, 'local')
+        results = [
+            ('put', measure(lambda: client.put(src, dst), size),
+             measure(lambda: transfer.put(src, dst), size)),
+            ('get', measure(lambda: client.get(dst, local), size),
+             measure(lambda: transfer.get(dst, local), size)),
+        ]
+    for name, legacy, chunked in results:
+        print(f'{name:<4} legacy {legacy:8.2f} MB/s   chunked {chunked:8.2f} MB/s   '
+              f'x{chunked / legacy:.2f}')
+    conn.disconnect()
+    server.stop()
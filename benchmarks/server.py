@@ -0,0 +1,543 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Local paramiko SSH/SFTP server for benchmarks.
+
+Commands are executed by the local bash or sh (through a pty when the client
+requests one), and the SFTP subsystem is backed by the local filesystem.
+An optional latency proxy can be put in front of it to simulate a WAN link.
+
+>>> python benchmarks/server.py -P 2222 -u xbot -p xbot --latency 50   # doctest: +SKIP
+"""
+
+import os
+import sys
+import pty
+import time
+import socket
+import select
+import struct
+import argparse
+import threading
+import subprocess
+
+from collections import deque
+
+import paramiko
+
+from paramiko import (ServerInterface, SFTPServerInterface, SFTPServer,
+                      SFTPAttributes, SFTPHandle, AUTH_SUCCESSFUL,
+                      AUTH_FAILED, OPEN_SUCCEEDED, SFTP_OK)
+from paramiko.common import MSG_CHANNEL_SUCCESS, MSG_CHANNEL_FAILURE
+
+
+SHELL = '/bin/bash' if os.path.exists('/bin/bash') else '/bin/sh'
+
+
+class LocalServer(ServerInterface):
+    """
+    Server interface which authenticates one user by password.
+    """
+    def __init__(self, user: str, password: str):
+        self._user = user
+        self._password = password
+        self.ptys = set()
+        self.envs = {}
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self._user, self._password):
+            return AUTH_SUCCESSFUL
+        return AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        self.ptys.add(channel.get_id())
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        self.envs.setdefault(channel.get_id(), {})[name] = value
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode('utf-8', errors='replace')
+        return self._start(channel, command)
+
+    def check_channel_shell_request(self, channel):
+        return self._start(channel, None)
+
+    def _start(self, channel: paramiko.Channel, command: str) -> bool:
+        """
+        Start `command` in background, its channel is closed only after the
+        reply of this request is sent.
+        """
+        replied = threading.Event()
+        channel.transport.replies[channel.remote_chanid] = replied
+        threading.Thread(target=self._run, args=(channel, command, replied),
+                         daemon=True).start()
+        return True
+
+    def check_global_request(self, kind, msg):
+        return False
+
+    def _run(
+        self,
+        channel: paramiko.Channel,
+        command: str,
+        replied: threading.Event
+    ) -> None:
+        """
+        Run `command` (or an interactive shell) and pump its io.
+        """
+        env = os.environ.copy()
+        env.update(self.envs.pop(channel.get_id(), {}))
+        args = [SHELL, '-c', command] if command else [SHELL]
+        usepty = channel.get_id() in self.ptys
+        self.ptys.discard(channel.get_id())
+        if usepty:
+            master, slave = pty.openpty()
+            proc = subprocess.Popen(args, stdin=slave, stdout=slave,
+                                    stderr=slave, env=env,
+                                    start_new_session=True)
+            feeder = threading.Thread(target=self._feed,
+                                      args=(channel, lambda d: os.write(master, d)),
+                                      daemon=True)
+            feeder.start()
+            self._drainpty(master, slave, proc, channel.sendall)
+        else:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=env)
+            feeder = threading.Thread(target=self._feed,
+                                      args=(channel, self._writer(proc.stdin),
+                                            proc.stdin.close),
+                                      daemon=True)
+            feeder.start()
+            errpump = threading.Thread(
+                target=self._drain,
+                args=(proc.stderr.fileno(), channel.sendall_stderr),
+                daemon=True)
+            errpump.start()
+            self._drain(proc.stdout.fileno(), channel.sendall)
+            errpump.join()
+        replied.wait(1)
+        try:
+            channel.send_exit_status(proc.wait())
+            channel.shutdown_write()
+            channel.close()
+        except Exception:
+            pass
+        feeder.join()
+        if usepty:
+            os.close(master)
+        else:
+            for f in (proc.stdin, proc.stdout, proc.stderr):
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+    def _feed(self, channel: paramiko.Channel, write, eof=None) -> None:
+        """
+        Copy data from `channel` to `write`, call `eof` at EOF.
+        """
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                write(data)
+            if eof:
+                eof()
+        except Exception:
+            pass
+
+    def _writer(self, f):
+        """
+        Unbuffered write function of file object `f`.
+        """
+        def write(data: bytes) -> None:
+            f.write(data)
+            f.flush()
+        return write
+
+    def _drainpty(self, master: int, slave: int, proc: subprocess.Popen, send) -> None:
+        """
+        Copy data from pty `master` to `send` until `proc` exits and its
+        output is read, like sshd. The slave is kept open meanwhile, as
+        reading the master once it is closed may drop the last output.
+        """
+        try:
+            while True:
+                if select.select([master], [], [], 0.05)[0]:
+                    try:
+                        data = os.read(master, 65536)
+                    except OSError:
+                        break
+                    if not data:
+                        break
+                    try:
+                        send(data)
+                    except Exception:
+                        break
+                elif proc.poll() is not None:
+                    break
+        finally:
+            os.close(slave)
+
+    def _drain(self, fd: int, send) -> None:
+        """
+        Copy data from `fd` to `send` until EOF.
+        """
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            try:
+                send(data)
+            except Exception:
+                break
+
+
+class ServerTransport(paramiko.Transport):
+    """
+    Transport which tells when the reply of a channel request is sent.
+    """
+    def __init__(self, sock: socket.socket):
+        super().__init__(sock)
+        self.replies = {}
+
+    def _send_user_message(self, data):
+        super()._send_user_message(data)
+        raw = data.asbytes()
+        if raw[0] in (MSG_CHANNEL_SUCCESS, MSG_CHANNEL_FAILURE):
+            chanid = struct.unpack('>I', raw[1:5])[0]
+            replied = self.replies.pop(chanid, None)
+            if replied:
+                replied.set()
+
+
+class LocalSFTPHandle(SFTPHandle):
+    """
+    SFTP handle on a local file.
+    """
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class LocalSFTPServer(SFTPServerInterface):
+    """
+    SFTP server interface on the local filesystem.
+    """
+    def list_folder(self, path):
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            binary = getattr(os, 'O_BINARY', 0)
+            mode = getattr(attr, 'st_mode', None) or 0o666
+            fd = os.open(path, flags | binary, mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        try:
+            f = os.fdopen(fd, fstr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        handle = LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+            if attr is not None:
+                SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        try:
+            os.symlink(target_path, path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def readlink(self, path):
+        try:
+            return os.readlink(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if os.path.isabs(path)
+                                else os.path.join('/', path))
+
+
+class SSHServer(object):
+    """
+    SSH/SFTP server listening on localhost.
+    """
+    def __init__(
+        self,
+        user: str = 'xbot',
+        password: str = 'xbot',
+        port: int = 0
+    ):
+        """
+        :param user: the only user allowed to login.
+        :param password: password of `user`.
+        :param port: listening port, 0 to pick a free one.
+        """
+        self.user = user
+        self.password = password
+        self._hostkey = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', port))
+        self._sock.listen(128)
+        self.host, self.port = self._sock.getsockname()
+        self._transports = []
+        self._stopped = False
+
+    def start(self) -> 'SSHServer':
+        """
+        Start accepting connections in background.
+        """
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop the server and close all connections.
+        """
+        self._stopped = True
+        self._sock.close()
+        for t in self._transports:
+            t.close()
+
+    def _accept(self) -> None:
+        while not self._stopped:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = ServerTransport(client)
+            t.add_server_key(self._hostkey)
+            t.set_subsystem_handler('sftp', SFTPServer, LocalSFTPServer)
+            t.start_server(server=LocalServer(self.user, self.password))
+            self._transports.append(t)
+
+
+class LatencyProxy(object):
+    """
+    TCP proxy which delays every packet by half of `rtt` in each direction.
+    """
+    def __init__(self, target: tuple, rtt: float, port: int = 0):
+        """
+        :param target: (host, port) to forward to.
+        :param rtt: round-trip time to simulate (seconds).
+        :param port: listening port, 0 to pick a free one.
+        """
+        self._target = target
+        self._delay = rtt / 2
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', port))
+        self._sock.listen(128)
+        self.host, self.port = self._sock.getsockname()
+
+    def start(self) -> 'LatencyProxy':
+        """
+        Start accepting connections in background.
+        """
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop accepting connections.
+        """
+        self._sock.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                break
+            upstream = socket.create_connection(self._target)
+            for s in (client, upstream):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for src, dst in ((client, upstream), (upstream, client)):
+                queue = deque()
+                cond = threading.Condition()
+                threading.Thread(target=self._recv, args=(src, queue, cond),
+                                 daemon=True).start()
+                threading.Thread(target=self._send, args=(dst, queue, cond),
+                                 daemon=True).start()
+
+    def _recv(self, src: socket.socket, queue: deque,
+              cond: threading.Condition) -> None:
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b''
+            with cond:
+                queue.append((time.monotonic() + self._delay, data))
+                cond.notify()
+            if not data:
+                break
+
+    def _send(self, dst: socket.socket, queue: deque,
+              cond: threading.Condition) -> None:
+        while True:
+            with cond:
+                while not queue:
+                    cond.wait()
+                due, data = queue.popleft()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not data:
+                try:
+                    dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                break
+            try:
+                dst.sendall(data)
+            except OSError:
+                break
+
+
+def serve(
+    user: str = 'xbot',
+    password: str = 'xbot',
+    latency: float = 0
+) -> tuple:
+    """
+    Start a server (and a latency proxy in front of it if `latency` > 0).
+
+    :param user: the only user allowed to login.
+    :param password: password of `user`.
+    :param latency: simulated round-trip time (ms).
+    :return: (server, proxy or None, port to connect).
+    """
+    server = SSHServer(user, password).start()
+    if latency > 0:
+        proxy = LatencyProxy((server.host, server.port), latency / 1000).start()
+        return server, proxy, proxy.port
+    return server, None, server.port
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--user', default='xbot',
+                        help='username to login.')
+    parser.add_argument('-p', '--password', default='xbot',
+                        help='password for user.')
+    parser.add_argument('-P', '--port', type=int, default=2222,
+                        help='listening port.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated round-trip time(ms).')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    if args.latency > 0:
+        server = SSHServer(args.user, args.password).start()
+        proxy = LatencyProxy((server.host, server.port), args.latency / 1000,
+                             port=args.port).start()
+    else:
+        server = SSHServer(args.user, args.password, args.port).start()
+    print(f'Listening on 127.0.0.1:{args.port}', file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
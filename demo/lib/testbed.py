@@ -3,6 +3,7 @@ from typing import Union
 from xbot.framework import testbed
 from xbot.plugins.ssh.ssh import SSHConnection
 from xbot.plugins.ssh.sftp import SFTPConnection
+from xbot.plugins.ssh.pool import SSHConnectionPool
 
 
 class TestBed(testbed.TestBed):
@@ -18,6 +19,10 @@ class TestBed(testbed.TestBed):
             'ssh': {},
             'sftp': {}
         }
+        self._pools = {
+            'ssh': SSHConnectionPool(connclass=SSHConnection),
+            'sftp': SSHConnectionPool(connclass=SFTPConnection)
+        }
 
     def get_conn(
         self, 
@@ -35,14 +40,17 @@ class TestBed(testbed.TestBed):
             raise ValueError(f'Invalid connection type: {typ}, should be one of {typs}.')
         for user in self.get('host.users'):
             if user['role'] == role:
-                if role not in self._conns[typ]:
-                    conn = SSHConnection() if typ == 'ssh' else SFTPConnection()
-                    conn.connect(self.get('host.ip'), 
-                                 user['name'], 
-                                 user['password'], 
-                                 port=self.get('host.sshport'))
+                conn = self._conns[typ].get(role)
+                if conn and not conn.active:
+                    self._pools[typ].checkin(conn)
+                    conn = None
+                if not conn:
+                    conn = self._pools[typ].checkout(self.get('host.ip'),
+                                                     user['name'],
+                                                     user['password'],
+                                                     port=self.get('host.sshport'))
                     self._conns[typ][role] = conn
-                return self._conns[typ][role]
+                return conn
         raise ValueError(f'No such user: role={role}')
 
     
@@ -47,7 +47,6 @@ setup(
         "License :: OSI Approved :: BSD License",
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
@@ -56,7 +55,7 @@ setup(
         "Programming Language :: Python :: 3.12"
     ],
     url='https://github.com/zhaowcheng/xbot.plugins.ssh',
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     project_urls={
         'Homepage': 'https://github.com/zhaowcheng/xbot.plugins.ssh',
         'Issues': 'https://github.com/zhaowcheng/xbot.plugins.ssh/issues'
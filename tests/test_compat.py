@@ -0,0 +1,35 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+import unittest
+from unittest import mock
+import sys
+import os
+sys.path.append(os.path.abspath(f'{__file__}/../..'))
+
+from xbot.plugins.ssh import compat
+
+
+class TestCompat(unittest.TestCase):
+
+    def test_check(self):
+        compat._check()
+        with mock.patch.object(compat, 'VERSION', (3, 2)):
+            with self.assertRaisesRegex(ImportError, r'paramiko>=3\.3'):
+                compat._check()
+        with mock.patch.object(compat, 'SFTPClient', type('SFTPClient', (), {})):
+            with self.assertRaisesRegex(ImportError, 'SFTPClient._adjust_cwd'):
+                compat._check()
+        class Bare(object):
+            def __init__(self):
+                self.in_buffer = None
+        with mock.patch.object(compat, 'Channel', type('Channel', (Bare,), {})):
+            with self.assertRaisesRegex(ImportError, 'Channel.status_event'):
+                compat._check()
+
+    def test_replyhandler(self):
+        with self.assertRaises(TypeError):
+            compat.ReplyHandler()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,86 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+import unittest
+import doctest
+import sys
+import os
+sys.path.append(os.path.abspath(f'{__file__}/../..'))
+
+from xbot.plugins.ssh import parsers
+from xbot.plugins.ssh.parsers import Table, parse
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(parsers))
+    return tests
+
+
+class TestParsers(unittest.TestCase):
+
+    def test_ps(self):
+        t = parse('ps', '''\
+USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND
+root         1  0.3  0.1  23768  9216 ?        SLl  22:49   0:11 /sbin/init splash
+root         2  0.0  0.0      0     0 ?        S    22:49   0:00 [kthreadd]
+xbot       316  1.5  0.4  41000 20480 pts/0    S+   22:50   0:02 python run.py''')
+        self.assertEqual(len(t), 3)
+        self.assertEqual(t['pid'].typecode, 'q')
+        self.assertEqual(t['pcpu'].typecode, 'd')
+        self.assertEqual(t.aggregate('rss', by='user'), {'root': 9216, 'xbot': 20480})
+        self.assertEqual(t.filter(user='xbot')['command'], ['python run.py'])
+        self.assertEqual(t.sort('pcpu', reverse=True).select('pid')['pid'].tolist(), [316, 1, 2])
+
+    def test_df(self):
+        t = parse('df', '''\
+Filesystem     1024-blocks     Used Available Capacity Mounted on
+devtmpfs           3066676        0   3066676       0% /dev
+/dev/vda         264212084 18501092  83795036      19% /
+/dev/vdb            102400    97280      5120      95% /mnt/my data''')
+        self.assertEqual(t.filter(usep=lambda v: v > 90)['mount'], ['/mnt/my data'])
+        self.assertEqual(t.aggregate('used'), 18598372)
+        t = parse('df', '''\
+Filesystem      Size  Used Avail Use% Mounted on
+tmpfs           1.6G  2.1M  1.6G   1% /run
+/dev/vda        252G   18G  220G   8% /''')
+        self.assertEqual(t['size'].typecode, 'q')
+        self.assertEqual(t.aggregate('used'), 18 * 1024 ** 3 + int(2.1 * 1024 ** 2))
+
+    def test_free(self):
+        t = parse('free', '''\
+               total        used        free      shared  buff/cache   available
+Mem:      6294937600   615088128  4991954944     9396224   923418624  5679849472
+Swap:     2147479552           0  2147479552''')
+        self.assertEqual(t['type'], ['Mem', 'Swap'])
+        self.assertEqual(t.filter(type='Swap')['total'][0], 2147479552)
+        self.assertEqual(t.filter(type='Swap')['available'][0], 0)
+        t = parse('free', '''\
+             total       used       free     shared    buffers     cached
+Mem:       8062176    7728616     333560          0     255860    5231180
+-/+ buffers/cache:    2241576    5820600
+Swap:      2097148          0    2097148''')
+        self.assertEqual(t['type'], ['Mem', 'Swap'])
+
+    def test_ss(self):
+        t = parse('ss', '''\
+State     Recv-Q Send-Q Local Address:Port  Peer Address:Port Process
+LISTEN    0      128        127.0.0.1:2222       0.0.0.0:*     users:(("python",pid=316,fd=3))
+ESTAB     0      0          127.0.0.1:2222     127.0.0.1:42282''')
+        self.assertEqual(t.aggregate('state', len, by='state'), {'LISTEN': 1, 'ESTAB': 1})
+        self.assertEqual(t['process'], ['users:(("python",pid=316,fd=3))', ''])
+
+    def test_proc(self):
+        t = parse('meminfo', 'MemTotal:        6147400 kB\nHugePages_Total:       0')
+        self.assertEqual(t.rows(), [('MemTotal', 6147400 * 1024), ('HugePages_Total', 0)])
+        t = parse('loadavg', '0.78 0.46 0.36 2/74 17787')
+        self.assertEqual(t.todicts(), [{'load1': 0.78, 'load5': 0.46, 'load15': 0.36,
+                                        'running': 2, 'total': 74, 'lastpid': 17787}])
+
+    def test_empty(self):
+        self.assertEqual(len(parse('ps', '')), 0)
+        self.assertEqual(len(Table.fromrows(['a'], []).filter(a=1)), 0)
+        with self.assertRaises(ValueError):
+            parse('unknown', '')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,12 +1,33 @@
 # Copyright (c) 2022-2023, zhaowcheng <zhaowcheng@163.com>
 
 import unittest
+import doctest
+import asyncio
+import io
 import shutil
+import zlib
+import zipfile
+import time
+from unittest import mock
+import paramiko
 import os
 import sys
 sys.path.append(os.path.abspath(f'{__file__}/../..'))
 
+from xbot.plugins.ssh import transfer, sync, walk, cache, monitor, throttle
 from xbot.plugins.ssh.sftp import SFTPConnection
+from xbot.plugins.ssh.aio import AsyncSFTPConnection
+from xbot.plugins.ssh.session import SSHSession
+from xbot.plugins.ssh.errors import SFTPTransferError
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(transfer))
+    tests.addTests(doctest.DocTestSuite(walk))
+    tests.addTests(doctest.DocTestSuite(cache))
+    tests.addTests(doctest.DocTestSuite(monitor))
+    tests.addTests(doctest.DocTestSuite(throttle))
+    return tests
 
 
 class TestSFTPConnection(unittest.TestCase):
@@ -83,6 +104,340 @@ class TestSFTPConnection(unittest.TestCase):
         with self.sftp.open(p, 'r') as fp:
             self.assertIn('xbot', fp.read().decode('utf-8'))
 
+    def test_06_async(self):
+        async def run():
+            sftp = AsyncSFTPConnection()
+            await sftp.connect(self.HOST, self.USER, self.PWD, self.PORT)
+            r = sftp.join(self.RGETDIR, 'file')
+            await sftp.getfile(r, self.LGETDIR, 'asyncfile')
+            tops = [top async for top, _, _ in sftp.walk(self.RPUTDIR)]
+            p = sftp.join(self.RPUTDIR, 'asyncopen')
+            async with sftp.open(p, 'w') as f:
+                await f.write('xbot')
+            async with sftp.open(p) as f:
+                self.assertEqual(await f.read(), b'xbot')
+            # a slow transfer does not hold up metadata requests.
+            transfer = asyncio.ensure_future(sftp.getfile(
+                r, self.LGETDIR, 'asyncslow', callback=lambda p: time.sleep(1)))
+            await asyncio.sleep(0.2)
+            await sftp.stat(r)
+            blocked = transfer.done()
+            await transfer
+            await sftp.disconnect()
+            return tops, blocked
+        tops, blocked = asyncio.run(run())
+        self.assertTrue(os.path.exists(os.path.join(self.LGETDIR, 'asyncfile')))
+        self.assertIn(self.RPUTDIR, tops)
+        self.assertFalse(blocked)
+
+    def test_07_session(self):
+        session = SSHSession()
+        session.connect(self.HOST, self.USER, self.PWD, self.PORT)
+        self.assertIs(session.sftp.transport, session.ssh.transport)
+        r = session.sftp.join(self.RPUTDIR, 'file')
+        self.assertTrue(session.sftp.exists(r))
+        self.assertIn('xbot', session.ssh.exec(f'cat {r}'))
+        session.sftp.disconnect()
+        self.assertTrue(session.ssh.active)
+        session.disconnect()
+        self.assertFalse(session.active)
+
+    def test_08_chunked(self):
+        data = os.urandom(3 * 1024 * 1024 + 123)
+        l = os.path.join(self.LPUTDIR, 'bigfile')
+        with open(l, 'wb') as fp:
+            fp.write(data)
+        stats = self.sftp.putfile(l, self.RPUTDIR, chunksize=262144, concurrency=4)
+        self.assertEqual(stats.size, len(data))
+        r = self.sftp.join(self.RPUTDIR, 'bigfile')
+        self.sftp.getfile(r, self.LGETDIR, 'bigfile', chunksize=262144, concurrency=4)
+        with open(os.path.join(self.LGETDIR, 'bigfile'), 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+
+    def test_09_tree(self):
+        l = os.path.join(self.LPUTDIR, 'tree')
+        for i in range(4):
+            d = os.path.join(l, *[f'd{j}' for j in range(i)])
+            os.makedirs(d, exist_ok=True)
+            for j in range(10):
+                with open(os.path.join(d, f'f{j}'), 'w') as fp:
+                    fp.write(f'{i}-{j}')
+        stats = self.sftp.putdir(l, self.RPUTDIR, concurrency=4)
+        self.assertEqual(stats.files, 40)
+        # existing dirs are skipped
+        self.sftp.putdir(l, self.RPUTDIR, concurrency=4)
+        r = self.sftp.join(self.RPUTDIR, 'tree')
+        stats = self.sftp.getdir(r, self.LGETDIR, concurrency=4)
+        self.assertEqual(stats.files, 40)
+        p = os.path.join(self.LGETDIR, 'tree', 'd0', 'd1', 'f9')
+        with open(p) as fp:
+            self.assertEqual(fp.read(), '2-9')
+
+    def test_10_sync(self):
+        l = os.path.join(self.LPUTDIR, 'sync')
+        os.makedirs(os.path.join(l, 'sub'))
+        for name in ('a', 'b', os.path.join('sub', 'c')):
+            with open(os.path.join(l, name), 'w') as fp:
+                fp.write(name)
+        big = os.urandom(4 * 1024 * 1024)
+        with open(os.path.join(l, 'big'), 'wb') as fp:
+            fp.write(big)
+        report = self.sftp.sync(l, self.RPUTDIR, delete=True)
+        self.assertEqual(len(report.created + report.updated + report.patched)
+                         + report.unchanged, 4)
+        report = self.sftp.sync(l, self.RPUTDIR)
+        self.assertFalse(report.changed)
+        # change one block of big file, remove a file and add a file
+        with open(os.path.join(l, 'big'), 'r+b') as fp:
+            fp.seek(2 * 1024 * 1024)
+            fp.write(b'xbot')
+        os.utime(os.path.join(l, 'big'), (0, 0))
+        os.remove(os.path.join(l, 'b'))
+        with open(os.path.join(l, 'sub', 'd'), 'w') as fp:
+            fp.write('d')
+        report = self.sftp.sync(l, self.RPUTDIR, delete=True, dryrun=True)
+        self.assertEqual((report.created, report.patched, report.deleted),
+                         (['sub/d'], ['big'], ['b']))
+        report = self.sftp.sync(l, self.RPUTDIR, delete=True)
+        self.assertLess(report.sent, 1024 * 1024)
+        r = self.sftp.join(self.RPUTDIR, 'sync')
+        self.assertFalse(self.sftp.exists(self.sftp.join(r, 'b')))
+        with self.sftp.open(self.sftp.join(r, 'big'), 'rb') as fp:
+            self.assertEqual(fp.read(), big[:2 * 1024 * 1024] + b'xbot' + big[2 * 1024 * 1024 + 4:])
+        self.assertFalse(self.sftp.sync(l, self.RPUTDIR, checksum=True).changed)
+        # a wedged remote hash sends the whole file.
+        os.utime(os.path.join(l, 'big'), (1, 1))
+        opencmd = sync.open_command
+        with mock.patch.object(sync, 'open_command',
+                               side_effect=lambda t, cmd, **kw: opencmd(t, 'sleep 5', **kw)):
+            start = time.monotonic()
+            report = sync.DirSync(self.sftp._sftpclient, hashtimeout=0.5).run(l, r, dryrun=True)
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertEqual((report.updated, report.patched), (['big'], []))
+
+    def test_11_walk(self):
+        l = os.path.join(self.LPUTDIR, 'walk')
+        deep = os.path.join(l, *['d'] * 30)
+        os.makedirs(deep)
+        os.makedirs(os.path.join(l, 'skip', 'sub'))
+        with open(os.path.join(deep, 'f'), 'w') as fp:
+            fp.write('xbot')
+        self.sftp.putdir(l, self.RPUTDIR)
+        r = self.sftp.join(self.RPUTDIR, 'walk')
+        tops, sizes = [], {}
+        for top, dirs, files in self.sftp.walk(r, entries=True, concurrency=4):
+            tops.append(top)
+            sizes.update((f.path, f.attr.st_size) for f in files)
+            dirs[:] = [d for d in dirs if d.name != 'skip']
+        self.assertEqual(len(tops), 31)
+        self.assertEqual(list(sizes.values()), [4])
+        self.assertEqual(sorted(e.name for e in self.sftp.scandir(r)), ['d', 'skip'])
+        names = [top for top, _, _ in self.sftp.walk(r)]
+        self.assertIn(self.sftp.join(r, 'skip', 'sub'), names)
+
+    def test_12_cache(self):
+        sftp = SFTPConnection(cachettl=60)
+        sftp.connect(self.HOST, self.USER, self.PWD, self.PORT)
+        r = self.sftp.join(self.RPUTDIR, 'cache', 'a', 'b')
+        sftp.makedirs(r)
+        with mock.patch.object(sftp._sftpclient, 'stat', side_effect=AssertionError):
+            sftp.makedirs(r)
+            self.assertTrue(sftp.exists(r))
+        l = os.path.join(self.LPUTDIR, 'file')
+        sftp.putfile(l, r)
+        f = sftp.join(r, 'file')
+        self.assertEqual(sftp.stat(f).st_size, os.path.getsize(l))
+        sftp.remove(f)
+        self.assertFalse(sftp.exists(f))
+        self.assertGreater(sftp.cache.hits, 0)
+        sftp.disconnect()
+
+    def test_13_tar(self):
+        l = os.path.join(self.LPUTDIR, 'tar')
+        os.makedirs(os.path.join(l, 'sub'))
+        for name in ('a', os.path.join('sub', 'b')):
+            with open(os.path.join(l, name), 'w') as fp:
+                fp.write(name)
+        # progress is reported file by file.
+        progresses = []
+        callback = lambda p: progresses.append((p.filesdone, p.sizedone))
+        with mock.patch.object(monitor.TransferMonitor, 'INTERVAL', 0):
+            stats = self.sftp.putdir(l, self.RPUTDIR, mode='tar', compress='gz',
+                                     callback=callback)
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(progresses[0], (0, 1))
+        self.assertEqual(progresses[-1], (2, 6))
+        r = self.sftp.join(self.RPUTDIR, 'tar', 'sub', 'b')
+        self.assertTrue(self.sftp.exists(r))
+        ltar = os.path.join(self.LGETDIR, 'tar')
+        progresses.clear()
+        with mock.patch.object(monitor.TransferMonitor, 'INTERVAL', 0):
+            stats = self.sftp.getdir(self.sftp.join(self.RPUTDIR, 'tar'), ltar, mode='tar',
+                                     callback=callback)
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(progresses[-1], (2, 6))
+        self.assertGreater(len(progresses), 2)
+        with open(os.path.join(ltar, 'tar', 'sub', 'b')) as fp:
+            self.assertEqual(fp.read(), os.path.join('sub', 'b'))
+        with mock.patch.object(self.sftp, '_hastar', {None: False}):
+            stats = self.sftp.getdir(self.sftp.join(self.RPUTDIR, 'tar'), ltar, mode='tar')
+            self.assertEqual(stats.files, 2)
+        with self.assertRaises(ValueError):
+            self.sftp.putdir(l, self.RPUTDIR, mode='zip')
+
+    def test_14_resume(self):
+        chunk = 1024 * 1024
+        l = os.path.join(self.LPUTDIR, 'resume')
+        data = os.urandom(3 * chunk + 10)
+        with open(l, 'wb') as fp:
+            fp.write(data)
+        stats = self.sftp.putfile(l, self.RPUTDIR, chunksize=chunk, resume=True)
+        self.assertEqual(stats.size, len(data))
+        stats = self.sftp.putfile(l, self.RPUTDIR, chunksize=chunk, resume=True)
+        self.assertEqual(stats.size, 0)
+        r = self.sftp.join(self.RPUTDIR, 'resume')
+        self.assertFalse(self.sftp.exists(r + '.part'))
+        # interrupted after the first range, the second one is corrupted
+        lget = os.path.join(self.LGETDIR, 'resume')
+        with open(lget + '.part', 'wb') as fp:
+            fp.write(data[:chunk] + b'x' * chunk)
+        attr = self.sftp.stat(r)
+        checkpoint = transfer.Checkpoint(lget + '.part.json', {
+            'rfile': r, 'size': attr.st_size, 'mtime': attr.st_mtime, 'chunksize': chunk})
+        checkpoint.add(0, zlib.crc32(data[:chunk]))
+        checkpoint.add(chunk, zlib.crc32(data[chunk:2 * chunk]))
+        checkpoint.save()
+        stats = self.sftp.getfile(r, self.LGETDIR, chunksize=chunk, resume=True)
+        self.assertEqual(stats.size, len(data) - chunk)
+        with open(lget, 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+        self.assertFalse(os.path.exists(lget + '.part'))
+        self.assertFalse(os.path.exists(lget + '.part.json'))
+        stats = self.sftp.getfile(r, self.LGETDIR, chunksize=chunk, resume=True)
+        self.assertEqual(stats.size, 0)
+
+    def test_15_verify(self):
+        chunk = 1024 * 1024
+        l = os.path.join(self.LPUTDIR, 'verify')
+        with open(l, 'wb') as fp:
+            fp.write(os.urandom(2 * chunk + 10))
+        stats = self.sftp.putfile(l, self.RPUTDIR, chunksize=chunk, verify=True)
+        self.assertTrue(stats.verified)
+        r = self.sftp.join(self.RPUTDIR, 'verify')
+        stats = self.sftp.getfile(r, self.LGETDIR, chunksize=chunk, concurrency=2, verify=True)
+        self.assertTrue(stats.verified)
+        stats = self.sftp.getfile(r, self.LGETDIR)
+        self.assertIsNone(stats.verified)
+        with mock.patch.object(transfer.FileTransfer, '_rdigests', return_value=['0' * 32] * 3):
+            with self.assertRaises(SFTPTransferError) as cm:
+                self.sftp.getfile(r, self.LGETDIR, chunksize=chunk, verify=True)
+        self.assertFalse(cm.exception.stats.verified)
+        # a wedged hashing command is given up at `verifytimeout`
+        opencmd = transfer.open_command
+        with mock.patch.object(transfer, 'open_command',
+                               side_effect=lambda t, cmd, **kw: opencmd(t, 'sleep 5', **kw)):
+            t = transfer.FileTransfer(self.sftp._sftpclient, chunk, verify=True, verifytimeout=0.5)
+            start = time.monotonic()
+            stats = t.get(r, os.path.join(self.LGETDIR, 'verify'))
+        self.assertIsNone(stats.verified)
+        self.assertLess(time.monotonic() - start, 4)
+
+    def test_16_monitor(self):
+        with self.assertRaises(TypeError):
+            monitor.MetricsSink()
+        class ListSink(monitor.MetricsSink):
+            def __init__(self):
+                self.metrics = []
+            def emit(self, name, value, tags):
+                self.metrics.append((name, value, tags))
+        sink = ListSink()
+        observer = monitor.MetricsObserver(sink, tags={'host': 'test'})
+        self.sftp.addobserver(observer)
+        progresses = []
+        try:
+            self.sftp.putdir(self.LPUTDIR, self.RPUTDIR, callback=progresses.append)
+        finally:
+            self.sftp.removeobserver(observer)
+        progress = progresses[-1]
+        self.assertEqual(progress.op, 'put')
+        self.assertEqual(progress.sizedone, progress.size)
+        self.assertEqual(progress.filesdone, progress.files)
+        self.assertEqual(progress.eta, 0)
+        metrics = {name: value for name, value, _ in sink.metrics}
+        self.assertEqual(metrics['sftp.transfer.files'], progress.files)
+        self.assertEqual(metrics['sftp.transfer.errors'], 0)
+        self.assertIn('sftp.file.data', metrics)
+        self.assertEqual(sink.metrics[0][2], {'host': 'test', 'op': 'put'})
+
+    def test_17_throttle(self):
+        l = os.path.join(self.LPUTDIR, 'throttle')
+        with open(l, 'wb') as fp:
+            fp.write(os.urandom(2 * 1024 * 1024))
+        host = self.sftp.transport.getpeername()[0]
+        throttle.scheduler.setlimit(4 * 1024 * 1024, host, burst=1)
+        try:
+            stats = self.sftp.putfile(l, self.RPUTDIR)
+            self.assertGreaterEqual(stats.elapsed, 0.4)
+            with throttle.scheduler.control(host):
+                stats = self.sftp.putfile(l, self.RPUTDIR)
+            self.assertGreaterEqual(stats.elapsed, 1.6)
+        finally:
+            throttle.scheduler.setlimit(0, host)
+        stats = self.sftp.putfile(l, self.RPUTDIR)
+        self.assertLess(stats.elapsed, 0.4)
+
+    def test_18_reader(self):
+        l = os.path.join(self.LPUTDIR, 'reader.zip')
+        data = {f'f{i}': os.urandom(100000) for i in range(5)}
+        with zipfile.ZipFile(l, 'w') as z:
+            for name, content in data.items():
+                z.writestr(name, content)
+        self.sftp.putfile(l, self.RPUTDIR)
+        r = self.sftp.join(self.RPUTDIR, 'reader.zip')
+        with self.sftp.openreader(r) as f:
+            with zipfile.ZipFile(f) as z:
+                self.assertEqual(z.read('f3'), data['f3'])
+                self.assertEqual(z.read('f1'), data['f1'])
+        with self.sftp.openreader(r, blocksize=4096, buffered=False) as f:
+            with open(l, 'rb') as lf:
+                self.assertEqual(f.read(), lf.read())
+            self.assertLess(f.fetches, f.size // 4096 // 4)
+            f.seek(-10, io.SEEK_END)
+            self.assertEqual(len(f.read(100)), 10)
+
+
+    def test_19_channels(self):
+        transport = self.sftp.transport
+        pool = transfer.ChannelPool(transport, 2)
+        with pool.clients(3) as clients:
+            self.assertEqual(len(clients), 2)
+            with pool.clients(1) as more:
+                self.assertEqual(more, [])
+            kept = clients[0]
+        self.assertTrue(kept.get_channel().closed)
+        with pool.clients(1) as clients, pool.clients(1) as more:
+            self.assertEqual(len(clients + more), 2)
+        # transfers go on with the shared client when no channel can be opened.
+        l = os.path.join(self.LPUTDIR, 'channels')
+        os.makedirs(l)
+        for i in range(10):
+            with open(os.path.join(l, str(i)), 'w') as fp:
+                fp.write(str(i))
+        refuse = paramiko.ChannelException(2, 'administratively prohibited')
+        with mock.patch.object(transfer.SFTPClient, 'from_transport', side_effect=refuse):
+            stats = self.sftp.putdir(l, self.RPUTDIR, concurrency=8)
+            self.assertEqual(stats.files, 10)
+            stats = self.sftp.getdir(self.sftp.join(self.RPUTDIR, 'channels'), self.LGETDIR)
+            self.assertEqual(stats.files, 10)
+            # a chunked file goes on with fewer workers.
+            big = os.path.join(l, 'big')
+            with open(big, 'wb') as fp:
+                fp.write(os.urandom(1024 * 1024))
+            self.sftp.putfile(big, self.RPUTDIR, chunksize=65536, concurrency=4)
+            self.sftp.getfile(self.sftp.join(self.RPUTDIR, 'big'), self.LGETDIR, 'channelsbig',
+                              chunksize=65536, concurrency=4)
+        with open(big, 'rb') as fp, open(os.path.join(self.LGETDIR, 'channelsbig'), 'rb') as gp:
+            self.assertEqual(fp.read(), gp.read())
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
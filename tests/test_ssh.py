@@ -2,17 +2,29 @@
 
 import unittest
 import doctest
+import asyncio
+import socket
+import threading
+import time
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import paramiko
 sys.path.append(os.path.abspath(f'{__file__}/../..'))
 
-from xbot.plugins.ssh import ssh
+from xbot.plugins.ssh import ssh, channel
 from xbot.plugins.ssh.ssh import SSHConnection
+from xbot.plugins.ssh.aio import AsyncSSHConnection
+from xbot.plugins.ssh.group import HostGroup
+from xbot.plugins.ssh.pool import SSHConnectionPool
 from xbot.plugins.ssh.errors import SSHConnectError, SSHCommandError
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(ssh))
+    tests.addTests(doctest.DocTestSuite(channel))
     return tests
 
 
@@ -90,10 +102,272 @@ class TestSSHConnection(unittest.TestCase):
         with self.assertRaises(TimeoutError):
             self.conn.exec('sleep 3', timeout=1)
 
+    def test_large_output(self):
+        r = self.conn.exec('seq 1 100000')
+        self.assertEqual(r.getcol(1)[-1], '100000')
+
+    def test_result_table(self):
+        r = self.conn.exec('printf "NAME SIZE\\na 1\\nb 2\\nc 3\\n"')
+        self.assertEqual(r.header, ['NAME', 'SIZE'])
+        self.assertEqual(r.getcol('SIZE'), ['SIZE', '1', '2', '3'])
+        self.assertEqual(r.getcols('SIZE', 'NAME')[1:], [('1', 'a'), ('2', 'b'), ('3', 'c')])
+        self.assertEqual(r.getfield('b', 'SIZE'), '2')
+        self.assertEqual(r.getfield(3, 1), 'b')
+        self.assertIsNone(r.getfield('d', 1))
+        with self.assertRaises(IndexError):
+            r.getfield(5, 1)
+        self.assertEqual(r.getrow('c'), ['c', '3'])
+        self.assertIsNone(r.getrow('d'))
+        with self.assertRaises(ValueError):
+            r.getcol('MTIME')
+
+    def test_result_parse(self):
+        t = self.conn.exec('ps -eo pid,user,rss,args').parse('ps')
+        self.assertIn(1, t['pid'])
+        self.assertGreater(self.conn.exec('df -P').parse('df').aggregate('size'), 0)
+        mem = self.conn.exec('free -b').parse('free').filter(type='Mem')
+        self.assertEqual(len(mem), 1)
+        self.assertIn('127.0.0.1', self.conn.exec('ip addr').parse('ip addr')['address'])
+        ss = self.conn.exec('ss -tan').parse('ss')
+        self.assertGreater(len(ss.filter(state='LISTEN')), 0)
+        meminfo = self.conn.exec('cat /proc/meminfo').parse('meminfo')
+        self.assertEqual(meminfo.filter(name='MemTotal')['value'][0], mem['total'][0])
+
+    def test_shell(self):
+        with self.conn.cd('/tmp'), self.conn.shell() as sh:
+            self.assertEqual(sh.exec('pwd'), '/tmp')
+            sh.exec('cd / && export XBOT_X=1')
+            self.assertEqual(sh.exec('echo $PWD $XBOT_X'), '/ 1')
+            self.assertEqual(sh.exec('echo err >&2; exit_2() { return 2; }; exit_2', expect=2), 'err')
+            self.assertEqual(sh.exec('ls (', expect=None).rc, 2)
+            with self.assertRaises(SSHCommandError):
+                sh.exec('false')
+            with self.assertRaises(TimeoutError):
+                sh.exec('sleep 3', timeout=1)
+            self.assertTrue(sh.closed)
+        sh = self.conn.shell()
+        self.assertEqual(sh.exec('exit 3', expect=3).rc, 3)
+        with self.assertRaises(SSHCommandError):
+            sh.exec('pwd')
+
+    def test_batch(self):
+        r = self.conn.batch(['echo 1', 'echo err >&2; exit 3', 'printf x', 'ls ('],
+                            expect=[0, 3, 'x', None])
+        self.assertEqual(r[:3], ['1', 'err', 'x'])
+        self.assertEqual([i.rc for i in r], [0, 3, 0, 2])
+        with self.conn.cd('/tmp'):
+            self.assertEqual(self.conn.batch(['cd /', 'pwd']), ['', '/tmp'])
+        with self.assertRaises(SSHCommandError):
+            self.conn.batch(['true', 'false'])
+        with self.assertRaisesRegex(TimeoutError, r"after 1/3 commands, running: 'sleep 3'"):
+            self.conn.batch(['true', 'sleep 3', 'true'], timeout=1)
+        # all sentinels arrive, a background process holds the output open
+        with self.assertRaisesRegex(TimeoutError, r'after 1/1 commands, running: \(waiting for EOF\)'):
+            self.conn.batch(['sleep 3 &'], timeout=1)
+
+    def test_stream(self):
+        s = self.conn.stream('seq 1 3; exit 3')
+        self.assertEqual(list(s), ['1', '2', '3'])
+        self.assertEqual(s.rc, 3)
+        with self.assertRaises(TimeoutError):
+            list(self.conn.stream('sleep 3', timeout=1))
+
+    def test_async_exec(self):
+        async def run():
+            conn = AsyncSSHConnection()
+            await conn.connect(self.HOST, self.USER, self.PWD, self.PORT)
+            with conn.cd('/tmp'):
+                r1 = await conn.exec('pwd')
+            rs = await asyncio.gather(*[conn.exec(f'echo {i}') for i in range(10)])
+            await conn.disconnect()
+            return r1, rs
+        r1, rs = asyncio.run(run())
+        self.assertEqual(r1, '/tmp')
+        self.assertEqual(rs, [str(i) for i in range(10)])
+
+    def test_hostgroup(self):
+        hosts = [{'name': f'h{i}', 'host': self.HOST, 'user': self.USER,
+                  'password': self.PWD, 'port': self.PORT} for i in range(3)]
+        hosts.append({'name': 'bad', 'host': self.HOST, 'user': self.USER,
+                      'password': self.PWD, 'port': self.PORT + 1000})
+        group = HostGroup(hosts, concurrency=2)
+        results = group.exec('echo hello', expect='hello')
+        self.assertEqual(sorted(results.succeeded), ['h0', 'h1', 'h2'])
+        self.assertIsInstance(results.failed['bad'], SSHConnectError)
+        names = [n for n, _ in group.as_completed('sleep 0.1', timeout={'h0': 5, 'h1': 5, 'h2': 5, 'bad': 5})]
+        self.assertEqual(sorted(names), ['bad', 'h0', 'h1', 'h2'])
+        results = dict(group.as_completed('echo hello', timeout={'h0': 5, 'h1': 5}))
+        self.assertEqual(results['h1'], 'hello')
+        self.assertIsInstance(results['h2'], KeyError)
+        group.disconnect()
+
+    def test_pool(self):
+        pool = SSHConnectionPool(maxsize=1, keepalive=0)
+        with pool.connection(self.HOST, self.USER, self.PWD, self.PORT) as conn:
+            conn.exec('true')
+            with self.assertRaises(TimeoutError):
+                pool.checkout(self.HOST, self.USER, self.PWD, self.PORT, timeout=0.1)
+        conn.disconnect()
+        with pool.connection(self.HOST, self.USER, self.PWD, self.PORT) as conn2:
+            self.assertIs(conn2, conn)
+            conn2.exec('true')
+        self.assertEqual((pool.stats.hits, pool.stats.misses), (1, 1))
+        self.assertEqual((pool.stats.reconnects, pool.stats.handshakes), (1, 2))
+        with self.assertRaises(ValueError):
+            pool.checkin(SSHConnection())
+        # a half-open link never replies to the probe
+        pool._probetimeout = 0.2
+        with mock.patch.object(conn.transport, 'global_request',
+                               side_effect=lambda *a, **k: time.sleep(3)):
+            with pool.connection(self.HOST, self.USER, self.PWD, self.PORT) as conn3:
+                self.assertIs(conn3, conn)
+        self.assertEqual(pool.stats.reconnects, 2)
+        pool.close()
+        # idle and dead connections are evicted without checkouts.
+        with mock.patch.object(SSHConnectionPool, 'REAPINTERVAL', 0.1):
+            pool = SSHConnectionPool(idletime=1)
+        conns = [pool.checkout(self.HOST, self.USER, self.PWD, self.PORT) for _ in range(2)]
+        for c in conns:
+            pool.checkin(c)
+        conns[1].disconnect()
+        time.sleep(0.3)
+        self.assertEqual(pool.stats.evictions, 1)
+        time.sleep(1)
+        self.assertEqual(pool.stats.evictions, 2)
+        self.assertFalse(conns[0].active)
+        pool.close()
+
     def test_cmd_cd(self):
         with self.conn.cd('/tmp'):
             self.assertEqual(self.conn.exec('pwd'), '/tmp')
 
+    def test_concurrent_exec(self):
+        def run(i):
+            d = ['/tmp', '/'][i % 2]
+            with self.conn.cd(d), self.conn.env(XBOT_N=str(i)):
+                return self.conn.exec('sleep 0.2; pwd; echo $XBOT_N')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(run, range(8)))
+        for i, r in enumerate(results):
+            self.assertEqual(r.getcol(1), [['/tmp', '/'][i % 2], str(i)])
+        self.assertEqual(self.conn.exec('pwd', cwd='/'), '/')
+
+
+class ExitStatusFirstServer(paramiko.ServerInterface):
+    """
+    Server which sends the exit status before the output of commands,
+    as SSH allows.
+    """
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_env_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            time.sleep(0.1)
+            channel.send_exit_status(0)
+            channel.sendall(b'head\n')
+            time.sleep(0.2)
+            channel.sendall(b'tail\n')
+            channel.shutdown_write()
+            channel.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+class TestExitStatusFirst(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sock = socket.socket()
+        cls.sock.bind(('127.0.0.1', 0))
+        cls.sock.listen(5)
+        key = paramiko.RSAKey.generate(1024)
+        def serve():
+            while True:
+                try:
+                    client, _ = cls.sock.accept()
+                except OSError:
+                    return
+                t = paramiko.Transport(client)
+                t.add_server_key(key)
+                t.start_server(server=ExitStatusFirstServer())
+        threading.Thread(target=serve, daemon=True).start()
+        cls.conn = SSHConnection()
+        cls.conn.connect('127.0.0.1', 'xbot', 'xbot', cls.sock.getsockname()[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.disconnect()
+        cls.sock.close()
+
+    def test_exec(self):
+        self.assertEqual(self.conn.exec('cmd'), 'head\ntail')
+
+    def test_stream(self):
+        s = self.conn.stream('cmd', timeout=5)
+        self.assertEqual(list(s), ['head', 'tail'])
+        self.assertEqual(s.rc, 0)
+
+
+
+class EOFWithDataChannel(object):
+    """
+    Channel whose last bytes arrive together with EOF, right after the
+    reader has seen that no data is ready.
+    """
+    def __init__(self):
+        self.chunks = [b'head\n']
+        self.last = [b'tail\n']
+        self.eof_received = False
+        self.closed = False
+        self.in_buffer = mock.Mock()
+
+    def recv_ready(self):
+        if not self.chunks and self.last:
+            self.chunks, self.last, self.eof_received = self.last, [], True
+            return False
+        return bool(self.chunks)
+
+    def recv(self, n):
+        return self.chunks.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+
+class TestAsyncRead(unittest.TestCase):
+
+    def test_data_with_eof(self):
+        output = channel.OutputBuffer()
+        asyncio.run(AsyncSSHConnection()._read(EOFWithDataChannel(), output, {}, 'utf-8'))
+        self.assertEqual(output.getvalue(), 'head\ntail\n')
+
+
+
+class TestScopes(unittest.TestCase):
+
+    def test_cd_env(self):
+        conn, other = SSHConnection(), SSHConnection()
+        with conn.cd('/tmp'), conn.env(XBOT_X='1'):
+            self.assertEqual(conn._prepare('pwd', {}, None)[0], 'cd /tmp && pwd')
+            self.assertEqual(conn._prepare('pwd', {}, None)[1]['XBOT_X'], '1')
+            self.assertEqual(other._prepare('pwd', {}, None)[0], 'pwd')
+            self.assertNotIn('XBOT_X', other._prepare('pwd', {}, None)[1])
+        # nothing refers to the connections once the scopes are left.
+        self.assertEqual((ssh._cwds.get(), ssh._envs.get()), ({}, {}))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,470 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Asyncio SSH/SFTP module.
+"""
+
+import asyncio
+import threading
+
+from typing import AsyncGenerator, Callable, Generator, Union
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from paramiko import Channel, SFTPAttributes, SFTPFile
+
+from xbot.plugins.ssh.ssh import SSHConnection, SSHCommandResult
+from xbot.plugins.ssh.sftp import SFTPConnection
+from xbot.plugins.ssh.transfer import FileTransfer, TransferStats
+from xbot.plugins.ssh.sync import SyncReport
+from xbot.plugins.ssh.monitor import TransferObserver, TransferProgress
+from xbot.plugins.ssh.throttle import scheduler
+from xbot.plugins.ssh.channel import ChannelReader, OutputBuffer, open_command
+from xbot.plugins.ssh.compat import set_read_event
+
+
+class AsyncSSHConnection(object):
+    """
+    Asyncio SSH connection.
+
+    Commands are multiplexed as channels over one transport. The output of
+    running commands is awaited through the event loop (no thread is held
+    while a command runs), only the short channel setup is done in the
+    loop's default executor.
+    """
+    def __init__(self, shenvs: dict = {}):
+        """
+        :param shenvs: same as `SSHConnection`.
+        """
+        self._conn = SSHConnection(shenvs)
+
+    async def connect(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        port: int = 22,
+        timeout: int = 5
+    ) -> None:
+        """
+        Open the connection, arguments are same to `SSHConnection.connect`.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._conn.connect, host, user,
+                                   password, port, timeout)
+
+    async def disconnect(self) -> None:
+        """
+        Close the connection.
+        """
+        self._conn.disconnect()
+
+    async def exec(
+        self,
+        cmd: str,
+        expect: Union[int, str, None] = 0,
+        timeout: int = 15,
+        prompts: dict = {},
+        shenvs: dict = {},
+        cwd: str = None
+    ) -> SSHCommandResult:
+        """
+        Execute a command on the SSH server, arguments are same to `SSHConnection.exec`.
+
+        >>> await exec('echo hello', expect='hello')                # doctest: +SKIP
+        >>> await asyncio.gather(*[exec('uptime') for _ in range(100)])   # doctest: +SKIP
+        """
+        conn = self._conn
+        cmd, envs = conn._prepare(cmd, shenvs, cwd)
+        extra = {'hook': {}}
+        conn._logger.info(f"Command: '{cmd}', Expect: '{expect}'", extra=extra)
+        encoding = envs['LANG'].split('.')[-1]
+        loop = asyncio.get_running_loop()
+        transport = conn.transport
+        with scheduler.control(transport.getpeername()[0]):
+            channel = await loop.run_in_executor(None, open_command, transport,
+                                                 cmd, envs, True, timeout)
+            reader = ChannelReader(channel, timeout)
+            output = OutputBuffer(encoding)
+            try:
+                await asyncio.wait_for(
+                    self._read(channel, output, dict(prompts), encoding),
+                    reader.remaining)
+                if not channel.exit_status_ready():
+                    await loop.run_in_executor(None, reader.exit_status)
+                rc = channel.recv_exit_status()
+            except (asyncio.TimeoutError, TimeoutError):
+                channel.close()
+                result = SSHCommandResult(output.getvalue(), rc=-1)
+                extra['hook']['more'] = result
+                raise TimeoutError(f"Command '{cmd}' timedout({timeout}s):\n{result}") from None
+        output = output.getvalue()
+        result = SSHCommandResult(output, rc=rc, cmd=cmd)
+        extra['hook']['more'] = result
+        conn._checkresult(result, expect, output)
+        return result
+
+    async def sudo(self, cmd, *args, **kwargs) -> SSHCommandResult:
+        """
+        Execute a command with sudo, arguments are same to `exec`.
+        """
+        kwargs['prompts'] = {'[sudo] password': self._conn._password}
+        return await self.exec(f'sudo {cmd}', *args, **kwargs)
+
+    @contextmanager
+    def cd(self, path) -> Generator[None, str, None]:
+        """
+        change current directory of the current task.
+
+        >>> with cd('/my/workdir'):     # doctest: +SKIP
+        ...     d = await exec('pwd')   # doctest: +SKIP
+        ...                             # doctest: +SKIP
+        >>> d                           # doctest: +SKIP
+        '/my/workdir'                   # doctest: +SKIP
+        """
+        with self._conn.cd(path):
+            yield
+
+    @contextmanager
+    def env(self, **shenvs: str) -> Generator[None, str, None]:
+        """
+        set shell environment variables of the current task.
+        """
+        with self._conn.env(**shenvs):
+            yield
+
+    async def _read(
+        self,
+        channel: Channel,
+        output: OutputBuffer,
+        prompts: dict,
+        encoding: str
+    ) -> None:
+        """
+        Read output of `channel` into `output` until EOF.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def drain():
+            while channel.recv_ready():
+                output.write(channel.recv(ChannelReader.MAXCHUNK))
+                if prompts:
+                    lastline = output.lastline
+                    for k, v in prompts.items():
+                        if k in lastline:
+                            channel.sendall((v + '\n').encode(encoding))
+                            prompts.pop(k)
+                            break
+
+        def onready():
+            if done.done():
+                return
+            try:
+                drain()
+                if channel.eof_received or channel.closed:
+                    # data which arrived along with EOF after the drain.
+                    drain()
+                    while channel.recv_stderr_ready():
+                        output.write(channel.recv_stderr(ChannelReader.MAXCHUNK))
+                    output.write(b'', final=True)
+                    done.set_result(None)
+            except Exception as e:
+                done.set_exception(e)
+
+        waker = _Waker(loop, onready)
+        set_read_event(channel, waker)
+        onready()
+        try:
+            await done
+        finally:
+            waker.active = False
+
+
+class _Waker(object):
+    """
+    Event for paramiko buffers which schedules `callback` on the loop
+    whenever data or EOF arrives.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback):
+        self._loop = loop
+        self._callback = callback
+        self.active = True
+
+    def set(self) -> None:
+        if self.active:
+            try:
+                self._loop.call_soon_threadsafe(self._callback)
+            except RuntimeError:
+                pass
+
+    def clear(self) -> None:
+        pass
+
+
+class AsyncSFTPConnection(object):
+    """
+    Asyncio SFTP connection.
+
+    Metadata requests (`stat`, `exists`, `walk` ...) of one connection are
+    served by one worker thread in order. Transfers (`getfile`, `getdir`,
+    `sync` ...) run in other worker threads, each with its own SFTP channel
+    on the same transport, so a long transfer does not hold up metadata
+    requests nor other transfers.
+    """
+    def __init__(
+        self,
+        cachettl: float = 0,
+        cachesize: int = 4096,
+        ratelimit: float = 0,
+        transfers: int = 4
+    ):
+        """
+        :param cachettl: same as `SFTPConnection`.
+        :param cachesize: same as `SFTPConnection`.
+        :param ratelimit: same as `SFTPConnection`.
+        :param transfers: max number of transfers running at the same time.
+        """
+        self._conn = SFTPConnection(cachettl, cachesize, ratelimit)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._bulkexecutor = ThreadPoolExecutor(max_workers=transfers)
+        self._local = threading.local()
+        self._bulkconns = []
+
+    async def _call(self, func, *args):
+        """
+        Call `func` in the metadata worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _bulkcall(self, name: str, *args):
+        """
+        Call method `name` of the transfer connection of a transfer worker
+        thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._bulkexecutor, lambda: getattr(self._bulkconn(), name)(*args))
+
+    def _bulkconn(self) -> SFTPConnection:
+        """
+        Connection of the current transfer worker thread, attached to the
+        transport of the connection and sharing its cache, observers and
+        rate limit.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or not conn.active:
+            conn = SFTPConnection()
+            conn.attach(self._conn.transport)
+            conn._cache = self._conn._cache
+            conn._observers = self._conn._observers
+            conn._bucket = self._conn._bucket
+            self._local.conn = conn
+            self._bulkconns.append(conn)
+        return conn
+
+    async def connect(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        port: int = 22
+    ) -> None:
+        """
+        Open the connection.
+        """
+        await self._call(self._conn.connect, host, user, password, port)
+
+    async def disconnect(self) -> None:
+        """
+        Close the connection.
+        """
+        conns, self._bulkconns = self._bulkconns, []
+        for conn in conns:
+            if conn.active:
+                await self._call(conn.disconnect)
+        await self._call(self._conn.disconnect)
+        self._executor.shutdown(wait=False)
+        self._bulkexecutor.shutdown(wait=False)
+
+    def addobserver(self, observer: TransferObserver) -> None:
+        """
+        Same as `SFTPConnection.addobserver`.
+        """
+        self._conn.addobserver(observer)
+
+    def removeobserver(self, observer: TransferObserver) -> None:
+        """
+        Same as `SFTPConnection.removeobserver`.
+        """
+        self._conn.removeobserver(observer)
+
+    async def getfile(self, rfile: str, ldir: str, filename: str = None,
+                      chunksize: int = FileTransfer.CHUNKSIZE,
+                      concurrency: int = 4, resume: bool = False,
+                      verify: bool = False,
+                      callback: Callable[[TransferProgress], None] = None) -> TransferStats:
+        """
+        Same as `SFTPConnection.getfile`.
+        """
+        return await self._bulkcall('getfile', rfile, ldir, filename,
+                                  chunksize, concurrency, resume, verify, callback)
+
+    async def putfile(self, lfile: str, rdir: str, filename: str = None,
+                      chunksize: int = FileTransfer.CHUNKSIZE,
+                      concurrency: int = 4, resume: bool = False,
+                      verify: bool = False,
+                      callback: Callable[[TransferProgress], None] = None) -> TransferStats:
+        """
+        Same as `SFTPConnection.putfile`.
+        """
+        return await self._bulkcall('putfile', lfile, rdir, filename,
+                                  chunksize, concurrency, resume, verify, callback)
+
+    async def getdir(self, rdir: str, ldir: str, concurrency: int = 8,
+                     mode: str = 'sftp', compress: str = None,
+                     resume: bool = False,
+                     callback: Callable[[TransferProgress], None] = None) -> TransferStats:
+        """
+        Same as `SFTPConnection.getdir`.
+        """
+        return await self._bulkcall('getdir', rdir, ldir, concurrency,
+                                  mode, compress, resume, callback)
+
+    async def putdir(self, ldir: str, rdir: str, concurrency: int = 8,
+                     mode: str = 'sftp', compress: str = None,
+                     resume: bool = False,
+                     callback: Callable[[TransferProgress], None] = None) -> TransferStats:
+        """
+        Same as `SFTPConnection.putdir`.
+        """
+        return await self._bulkcall('putdir', ldir, rdir, concurrency,
+                                  mode, compress, resume, callback)
+
+    async def sync(self, ldir: str, rdir: str, delete: bool = False,
+                   dryrun: bool = False, checksum: bool = False,
+                   concurrency: int = 8) -> SyncReport:
+        """
+        Same as `SFTPConnection.sync`.
+        """
+        return await self._bulkcall('sync', ldir, rdir, delete, dryrun,
+                                  checksum, concurrency)
+
+    def join(self, *paths: str) -> str:
+        """
+        Same as `SFTPConnection.join`.
+        """
+        return self._conn.join(*paths)
+
+    def normpath(self, path: str) -> str:
+        """
+        Same as `SFTPConnection.normpath`.
+        """
+        return self._conn.normpath(path)
+
+    def basename(self, path: str) -> str:
+        """
+        Same as `SFTPConnection.basename`.
+        """
+        return self._conn.basename(path)
+
+    async def exists(self, path: str) -> bool:
+        """
+        Same as `SFTPConnection.exists`.
+        """
+        return await self._call(self._conn.exists, path)
+
+    async def scandir(self, path: str) -> list:
+        """
+        Same as `SFTPConnection.scandir`.
+        """
+        return await self._call(self._conn.scandir, path)
+
+    async def walk(self, path: str, entries: bool = False,
+                   concurrency: int = 8) -> AsyncGenerator[tuple, None]:
+        """
+        Same as `SFTPConnection.walk`.
+
+        >>> async for top, dirs, files in walk('/tmp'):    # doctest: +SKIP
+        ...     print(top, dirs, files)                     # doctest: +SKIP
+        """
+        gen = self._conn.walk(path, entries, concurrency)
+        sentinel = object()
+        while True:
+            w = await self._call(next, gen, sentinel)
+            if w is sentinel:
+                break
+            yield w
+
+    @asynccontextmanager
+    async def open(self, filepath: str, mode: str = 'r') -> AsyncGenerator['AsyncSFTPFile', None]:
+        """
+        Same as `SFTPConnection.open`, the file is opened, read, written
+        and closed in the metadata worker thread.
+
+        >>> async with open('/tmp/f', 'w') as f:    # doctest: +SKIP
+        ...     await f.write('xbot')               # doctest: +SKIP
+        """
+        cm = self._conn.open(filepath, mode)
+        f = await self._call(cm.__enter__)
+        try:
+            yield AsyncSFTPFile(f, self._call)
+        except BaseException as e:
+            if not await self._call(cm.__exit__, type(e), e, e.__traceback__):
+                raise
+        else:
+            await self._call(cm.__exit__, None, None, None)
+
+    async def makedirs(self, path: str) -> None:
+        """
+        Same as `SFTPConnection.makedirs`.
+        """
+        await self._call(self._conn.makedirs, path)
+
+    async def stat(self, path: str) -> SFTPAttributes:
+        """
+        Same as `SFTPConnection.stat`.
+        """
+        return await self._call(self._conn.stat, path)
+
+    async def mkdir(self, path: str, mode: int = 0o777) -> None:
+        """
+        Same as `SFTPConnection.mkdir`.
+        """
+        await self._call(self._conn.mkdir, path, mode)
+
+    async def remove(self, path: str) -> None:
+        """
+        Same as `SFTPConnection.remove`.
+        """
+        await self._call(self._conn.remove, path)
+
+
+class AsyncSFTPFile(object):
+    """
+    Remote file of an `AsyncSFTPConnection`, see `AsyncSFTPConnection.open`.
+    """
+    def __init__(self, f: SFTPFile, call: Callable):
+        """
+        :param f: the opened file.
+        :param call: coroutine function which calls a function in the
+            worker thread of the connection.
+        """
+        self._f = f
+        self._call = call
+
+    async def read(self, size: int = None) -> bytes:
+        return await self._call(self._f.read, size)
+
+    async def write(self, data: Union[str, bytes]) -> None:
+        await self._call(self._f.write, data)
+
+    async def seek(self, offset: int, whence: int = 0) -> None:
+        await self._call(self._f.seek, offset, whence)
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    async def stat(self) -> SFTPAttributes:
+        return await self._call(self._f.stat)
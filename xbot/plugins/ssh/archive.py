@@ -0,0 +1,192 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Tar over SSH transfer module.
+"""
+
+import os
+import time
+import shlex
+import tarfile
+
+from typing import Generator, Tuple, Union
+
+from paramiko import Channel, ChannelFile, Transport
+
+from xbot.plugins.ssh.channel import ChannelReader, open_command
+from xbot.plugins.ssh.monitor import FileTiming, TransferMonitor
+from xbot.plugins.ssh.throttle import Limiter, ThrottledFile
+from xbot.plugins.ssh.transfer import TransferStats
+
+
+class TarTransfer(object):
+    """
+    Transfer of directory trees as a tar stream through an exec channel.
+
+    The archive is built and unpacked on the fly on both sides (`tar` on
+    the server, `tarfile` locally) and never written to disk, so copying
+    a tree with many small files costs a few round-trips in total instead
+    of several per file.
+
+    >>> TarTransfer(sftp.transport, compress='gz').put('/home/mydir', '/tmp')    # doctest: +SKIP
+    TransferStats(files=20000, size=81920000, elapsed=3.318, throughput=23.55MB/s, filerate=6027.73/s)
+    """
+    # compress => (tar option, program, tarfile mode suffix)
+    COMPRESSORS = {
+        None: ('', None, ''),
+        'gz': ('z', 'gzip', 'gz'),
+        'bz2': ('j', 'bzip2', 'bz2'),
+        'xz': ('J', 'xz', 'xz'),
+    }
+    BUFSIZE = 1048576
+
+    def __init__(
+        self,
+        transport: Transport,
+        compress: str = None,
+        limiter: Limiter = None,
+        monitor: TransferMonitor = None
+    ):
+        """
+        :param transport: transport of the connection.
+        :param compress: None, 'gz', 'bz2' or 'xz'.
+        :param limiter: bandwidth limit of the stream.
+        :param monitor: fed with each file as it goes through the stream.
+        """
+        if compress not in self.COMPRESSORS:
+            raise ValueError(f'Unsupported compress: {compress}, '
+                             f'must be one of {list(self.COMPRESSORS)}')
+        self._transport = transport
+        self._compress = compress
+        self._limiter = limiter
+        self._monitor = monitor
+
+    def available(self) -> bool:
+        """
+        Whether `tar` (and the compressor) is available on the server.
+        """
+        _, program, _ = self.COMPRESSORS[self._compress]
+        programs = ' '.join(['tar'] + ([program] if program else []))
+        channel = open_command(self._transport, f'command -v {programs}',
+                               pty=False)
+        try:
+            return ChannelReader(channel, 30).exit_status() == 0
+        finally:
+            channel.close()
+
+    def get(self, rdir: str, ldir: str) -> TransferStats:
+        """
+        Get remote dir `rdir` into local dir `ldir`.
+        """
+        start = time.monotonic()
+        opt, _, suffix = self.COMPRESSORS[self._compress]
+        parent, _, name = rdir.rstrip('/').rpartition('/')
+        parent = parent or ('/' if rdir.startswith('/') else '.')
+        cmd = f'tar -c{opt}f - -C {shlex.quote(parent)} {shlex.quote(name)}'
+        channel = open_command(self._transport, cmd, pty=False)
+        stats = TransferStats()
+        kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+        try:
+            f = self._throttled(channel.makefile('rb', self.BUFSIZE))
+            try:
+                with tarfile.open(fileobj=f, mode=f'r|{suffix}') as tar:
+                    for member in tar:
+                        t = time.monotonic()
+                        tar.extract(member, ldir, **kwargs)
+                        if member.isfile():
+                            stats.files += 1
+                            stats.size += member.size
+                            self._filedone(f'{parent.rstrip("/")}/{member.name}',
+                                           member.size, time.monotonic() - t)
+            except tarfile.TarError:
+                self._check(channel, cmd)
+                raise
+            self._check(channel, cmd)
+        finally:
+            channel.close()
+        stats.elapsed = time.monotonic() - start
+        return stats
+
+    def put(self, ldir: str, rdir: str) -> TransferStats:
+        """
+        Put local dir `ldir` into remote dir `rdir`, `rdir` is created if
+        it does not exist.
+        """
+        start = time.monotonic()
+        opt, _, suffix = self.COMPRESSORS[self._compress]
+        ldir = os.path.normpath(ldir)
+        cmd = f'mkdir -p {shlex.quote(rdir)} && tar -x{opt}f - -C {shlex.quote(rdir)}'
+        channel = open_command(self._transport, cmd, pty=False)
+        stats = TransferStats()
+        try:
+            f = self._throttled(channel.makefile('wb', self.BUFSIZE))
+            try:
+                with tarfile.open(fileobj=f, mode=f'w|{suffix}') as tar:
+                    for path, arcname in self._members(ldir):
+                        t = time.monotonic()
+                        info = tar.gettarinfo(path, arcname)
+                        if info is None:
+                            # sockets, like tar.add does.
+                            continue
+                        if info.isfile():
+                            with open(path, 'rb') as lf:
+                                tar.addfile(info, lf)
+                            stats.files += 1
+                            stats.size += info.size
+                            self._filedone(f'{rdir.rstrip("/")}/{arcname}', info.size,
+                                           time.monotonic() - t)
+                        else:
+                            tar.addfile(info)
+                f.flush()
+            except OSError:
+                self._check(channel, cmd)
+                raise
+            channel.shutdown_write()
+            self._check(channel, cmd)
+        finally:
+            channel.close()
+        stats.elapsed = time.monotonic() - start
+        return stats
+
+    def _members(self, ldir: str) -> Generator[Tuple[str, str], None, None]:
+        """
+        Yield (path, name in the archive) of `ldir` and what it contains,
+        symlinks are not followed.
+        """
+        name = os.path.basename(ldir)
+        for top, dirs, files in os.walk(ldir):
+            rel = os.path.relpath(top, ldir)
+            arctop = name if rel == '.' else '/'.join([name] + rel.split(os.sep))
+            yield top, arctop
+            links = [d for d in dirs if os.path.islink(os.path.join(top, d))]
+            for n in sorted(files + links):
+                yield os.path.join(top, n), f'{arctop}/{n}'
+
+    def _filedone(self, path: str, size: int, elapsed: float) -> None:
+        """
+        Report a file which went through the stream to the monitor.
+
+        :param path: remote file.
+        :param elapsed: seconds taken by its data.
+        """
+        if not self._monitor:
+            return
+        self._monitor.update(size)
+        timing = FileTiming(path, size)
+        timing.add(0, elapsed, elapsed)
+        self._monitor.filedone(timing)
+
+    def _throttled(self, f: ChannelFile) -> Union[ChannelFile, ThrottledFile]:
+        return ThrottledFile(f, self._limiter) if self._limiter else f
+
+    def _check(self, channel: Channel, cmd: str) -> None:
+        """
+        Wait for the remote tar and raise if it failed.
+        """
+        rc = ChannelReader(channel).exit_status()
+        if rc != 0:
+            err = b''
+            while channel.recv_stderr_ready():
+                err += channel.recv_stderr(65536)
+            raise IOError(f"Command '{cmd}' failed({rc}): "
+                          f"{err.decode('utf-8', errors='ignore').strip()}")
@@ -0,0 +1,108 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Remote metadata cache module.
+"""
+
+import time
+import threading
+
+from typing import Optional, Union
+from collections import OrderedDict
+
+from paramiko import SFTPAttributes
+
+
+class StatCache(object):
+    """
+    LRU cache of remote stat results and known directories, entries
+    expire `ttl` seconds after they are stored.
+
+    >>> cache = StatCache(ttl=30, maxsize=2)
+    >>> cache.putdir('/a')
+    >>> cache.putdir('/a/b')
+    >>> cache.putdir('/c')
+    >>> cache.isdir('/a'), cache.isdir('/a/b')
+    (False, True)
+    >>> cache.invalidate('/a', recursive=True)
+    >>> cache.isdir('/a/b'), cache.isdir('/c')
+    (False, True)
+    """
+    DIR = True
+
+    def __init__(self, ttl: float = 30, maxsize: int = 4096):
+        """
+        :param ttl: seconds an entry is valid.
+        :param maxsize: maximum number of entries.
+        """
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str) -> Optional[Union[SFTPAttributes, bool]]:
+        """
+        Get the entry of `path`.
+
+        :return: `SFTPAttributes`, `DIR` for a directory known without
+            attributes, or None if not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[path]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, path: str, attr: Union[SFTPAttributes, bool]) -> None:
+        """
+        Store the attributes of `path`.
+        """
+        with self._lock:
+            self._entries[path] = (attr, time.monotonic() + self._ttl)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def putdir(self, path: str) -> None:
+        """
+        Remember that directory `path` exists, keeps its attributes if cached.
+        """
+        if not self.isdir(path):
+            self.put(path, self.DIR)
+
+    def isdir(self, path: str) -> bool:
+        """
+        Whether `path` is cached as a directory.
+        """
+        entry = self.get(path)
+        if entry is self.DIR:
+            return True
+        return entry is not None and (entry.st_mode or 0) & 0o170000 == 0o040000
+
+    def invalidate(self, path: str, recursive: bool = False) -> None:
+        """
+        Drop the entry of `path`, and the entries under it if `recursive`.
+        """
+        with self._lock:
+            self._entries.pop(path, None)
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for p in [p for p in self._entries if p.startswith(prefix)]:
+                    del self._entries[p]
+
+    def clear(self) -> None:
+        """
+        Drop all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,165 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Command channel helpers.
+"""
+
+import time
+import codecs
+import socket
+
+from typing import Optional
+
+from paramiko import Channel, Transport
+
+from xbot.plugins.ssh.compat import request_pty, wait_exit_status
+
+
+def open_command(
+    transport: Transport,
+    cmd: Optional[str],
+    envs: dict = {},
+    pty: bool = True,
+    timeout: Optional[float] = None
+) -> Channel:
+    """
+    Open a session channel and start `cmd` (or the login shell) on it.
+
+    The pty and environment requests are sent without waiting for their
+    replies, so starting a command costs the channel open plus one
+    round-trip instead of one round-trip per request.
+
+    :param transport: transport of the connection.
+    :param cmd: the command to be executed, None to start the login shell.
+    :param envs: environment variables for the command.
+    :param pty: whether to request a pseudo-terminal.
+    :param timeout: timeout (seconds) for opening the channel.
+    """
+    channel = transport.open_session(timeout=timeout)
+    if pty:
+        request_pty(channel)
+    for k, v in envs.items():
+        channel.set_environment_variable(k, v)
+    if cmd is None:
+        channel.invoke_shell()
+    else:
+        channel.exec_command(cmd)
+    return channel
+
+
+class ChannelReader(object):
+    """
+    Read output from a channel until EOF.
+
+    Each `read` blocks on the channel until data arrives (no polling), the
+    whole reading is bounded by a deadline on the monotonic clock, and the
+    chunk size grows while the channel keeps filling it. The output is
+    finished only at EOF, the exit status may arrive before the last data.
+    """
+    MINCHUNK = 4096
+    MAXCHUNK = 1048576
+
+    def __init__(self, channel: Channel, timeout: Optional[float] = None):
+        """
+        :param channel: channel of a started command.
+        :param timeout: total timeout (seconds), None means no timeout.
+        """
+        self._channel = channel
+        self._deadline = None if timeout is None else time.monotonic() + timeout
+        self._chunksize = self.MINCHUNK
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds left before the deadline, None if no deadline.
+        """
+        if self._deadline is None:
+            return None
+        return self._deadline - time.monotonic()
+
+    def read(self) -> bytes:
+        """
+        Read next chunk of output.
+
+        :return: data received, b'' when the output is finished.
+
+        :raises:
+            `TimeoutError` -- if the deadline is reached.
+        """
+        channel = self._channel
+        remaining = self.remaining
+        # Past the deadline, data or EOF already received is still returned.
+        channel.settimeout(remaining if remaining is None else max(remaining, 0))
+        try:
+            data = channel.recv(self._chunksize)
+        except socket.timeout:
+            raise TimeoutError from None
+        if len(data) == self._chunksize:
+            self._chunksize = min(self._chunksize * 2, self.MAXCHUNK)
+        return data
+
+    def exit_status(self) -> int:
+        """
+        Wait for the exit status within the remaining time.
+
+        :raises:
+            `TimeoutError` -- if the deadline is reached.
+        """
+        if not wait_exit_status(self._channel, self.remaining):
+            raise TimeoutError
+        return self._channel.recv_exit_status()
+
+
+class OutputBuffer(object):
+    """
+    Accumulate command output.
+
+    Data is decoded incrementally, so multibyte characters split across
+    chunks are kept, and text is kept as a list of chunks joined only once.
+    The last `TAILSIZE` characters are kept apart for prompt matching.
+    """
+    TAILSIZE = 4096
+
+    def __init__(self, encoding: str = 'utf-8'):
+        """
+        :param encoding: encoding of the output.
+        """
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+        self._chunks = []
+        self._tail = ''
+
+    def write(self, data: bytes, final: bool = False) -> str:
+        """
+        Decode and append `data`.
+
+        :param data: raw output.
+        :param final: whether it is the last data.
+        :return: text decoded from `data`.
+
+        >>> buf = OutputBuffer('utf-8')
+        >>> buf.write(b'password\\xef\\xbc'), buf.write(b'\\x9a')
+        ('password', '：')
+        >>> buf.lastline
+        'password：'
+        """
+        text = self._decoder.decode(data, final)
+        if text:
+            self._chunks.append(text)
+            self._tail = (self._tail + text[-self.TAILSIZE:])[-self.TAILSIZE:]
+        return text
+
+    @property
+    def lastline(self) -> str:
+        """
+        Last line of the output.
+        """
+        lines = self._tail.splitlines()
+        return lines[-1] if lines else ''
+
+    def getvalue(self) -> str:
+        """
+        The whole output decoded so far.
+        """
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
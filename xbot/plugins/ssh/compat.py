@@ -0,0 +1,177 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Compatibility layer over paramiko internals.
+
+Pipelined SFTP requests, raw channel requests and channel read events
+are not public in paramiko, all of their uses go through this module, so
+a paramiko release which changes them fails at import here instead of
+deep in a transfer.
+"""
+
+import abc
+import re
+
+from typing import Optional
+
+import paramiko
+
+from paramiko import Channel, Message, SFTPAttributes, SFTPClient, SFTPFile, Transport
+from paramiko.common import cMSG_CHANNEL_REQUEST
+from paramiko.buffered_pipe import BufferedPipe
+
+
+MINVERSION = (3, 3)
+VERSION = tuple(int(n) for n in re.findall(r'\d+', paramiko.__version__)[:2])
+
+
+def _check() -> None:
+    """
+    Check the version of paramiko and the internals used.
+
+    :raises:
+        `ImportError` -- if paramiko is too old or lacks an internal.
+    """
+    if VERSION < MINVERSION:
+        raise ImportError(f'paramiko>={".".join(map(str, MINVERSION))} is required, '
+                          f'found {paramiko.__version__}')
+    missing = [f'{cls.__name__}.{name}' for cls, name in (
+        (SFTPClient, '_async_request'),
+        (SFTPClient, '_read_response'),
+        (SFTPClient, '_convert_status'),
+        (SFTPClient, '_adjust_cwd'),
+        (SFTPClient, '_expecting'),
+        (SFTPFile, '_reqs'),
+        (SFTPAttributes, '_from_msg'),
+        (Transport, '_send_user_message'),
+        (Channel, 'remote_chanid'),
+        (Channel, 'in_buffer'),
+        (Channel, 'status_event'),
+        (BufferedPipe, 'set_event'),
+    ) if not _hasattr(cls, name)]
+    if missing:
+        raise ImportError(f'paramiko {paramiko.__version__} is not supported, '
+                          f'missing: {", ".join(missing)}')
+
+
+def _hasattr(cls: type, name: str) -> bool:
+    """
+    Whether `cls` has attribute `name`, or its instances get it in
+    `__init__`.
+    """
+    code = getattr(cls.__init__, '__code__', None)
+    return hasattr(cls, name) or bool(code and name in code.co_names)
+
+
+_check()
+
+
+class ReplyHandler(abc.ABC):
+    """
+    Handler of the replies of requests sent by `async_request`, subclasses
+    implement `onreply`.
+
+    paramiko only keeps a weak reference to the handler, the sender must
+    keep it alive until the replies are read.
+    """
+    @abc.abstractmethod
+    def onreply(self, t: int, msg: Message, num: int) -> None:
+        """
+        Handle reply `msg` of type `t` to request `num`.
+        """
+
+    def _async_response(self, t: int, msg: Message, num: int) -> None:
+        self.onreply(t, msg, num)
+
+
+def async_request(
+    sftpclient: SFTPClient,
+    handler: Optional[ReplyHandler],
+    t: int,
+    *args
+) -> int:
+    """
+    Send an SFTP request without waiting for its reply.
+
+    :param handler: called with (type, message, number) of the reply from
+        `read_response`, None to ignore the reply.
+    :return: number of the request.
+    """
+    return sftpclient._async_request(type(None) if handler is None else handler, t, *args)
+
+
+def read_response(sftpclient: SFTPClient, num: Optional[int] = None) -> None:
+    """
+    Read replies and dispatch them to their callbacks, until the reply of
+    request `num` (or any reply if None).
+    """
+    sftpclient._read_response(num)
+
+
+def convert_status(sftpclient: SFTPClient, msg: Message) -> None:
+    """
+    Raise the error of a status reply (`EOFError` for end of file), do
+    nothing for success.
+    """
+    sftpclient._convert_status(msg)
+
+
+def adjust_path(sftpclient: SFTPClient, path: str) -> str:
+    """
+    Path to send in requests, relative to the cwd of the client.
+    """
+    return sftpclient._adjust_cwd(path)
+
+
+def attributes(msg: Message, filename: str = None, longname: str = None) -> SFTPAttributes:
+    """
+    Attributes read from a reply.
+    """
+    return SFTPAttributes._from_msg(msg, filename, longname)
+
+
+def drain_writes(f: SFTPFile) -> None:
+    """
+    Wait for the replies of the pipelined writes of `f`, so that errors
+    are raised instead of being dropped.
+    """
+    sftp = f.sftp
+    while f._reqs:
+        num = f._reqs.popleft()
+        if num in sftp._expecting:
+            sftp._read_response(num)
+
+
+def request_pty(channel: Channel, term: str = 'vt100', width: int = 80, height: int = 24) -> None:
+    """
+    Request a pseudo-terminal without waiting for the reply.
+    """
+    m = Message()
+    m.add_byte(cMSG_CHANNEL_REQUEST)
+    m.add_int(channel.remote_chanid)
+    m.add_string('pty-req')
+    m.add_boolean(False)
+    m.add_string(term)
+    m.add_int(width)
+    m.add_int(height)
+    m.add_int(0)
+    m.add_int(0)
+    m.add_string(bytes())
+    channel.get_transport()._send_user_message(m)
+
+
+def set_read_event(channel: Channel, event) -> None:
+    """
+    Have `event.set()` called when data arrives on `channel`, `event` is
+    like a `threading.Event`.
+    """
+    channel.in_buffer.set_event(event)
+
+
+def wait_exit_status(channel: Channel, timeout: Optional[float] = None) -> bool:
+    """
+    Wait for the exit status of `channel`.
+
+    :return: False if it did not arrive within `timeout`.
+    """
+    return channel.status_event.wait(timeout)
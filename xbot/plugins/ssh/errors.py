@@ -17,3 +17,16 @@ class SSHCommandError(Exception):
     SSH command error.
     """
     pass
+
+
+class SFTPTransferError(Exception):
+    """
+    SFTP transfer error.
+    """
+    def __init__(self, msg: str, stats=None):
+        """
+        :param msg: error message.
+        :param stats: `TransferStats` of the failed transfer.
+        """
+        super().__init__(msg)
+        self.stats = stats
@@ -0,0 +1,176 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Parallel SSH module.
+"""
+
+from typing import Generator, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from xbot.plugins.ssh.ssh import SSHConnection, SSHCommandResult
+
+
+class GroupResult(dict):
+    """
+    Results of a group operation, maps host name to the result or the
+    exception raised on that host.
+    """
+    @property
+    def succeeded(self) -> dict:
+        """
+        Hosts without exception.
+        """
+        return {k: v for k, v in self.items() if not isinstance(v, Exception)}
+
+    @property
+    def failed(self) -> dict:
+        """
+        Hosts with exception.
+        """
+        return {k: v for k, v in self.items() if isinstance(v, Exception)}
+
+
+class HostGroup(object):
+    """
+    Group of SSH connections which runs commands on all hosts concurrently.
+
+    >>> group = HostGroup([                                             # doctest: +SKIP
+    ...     {'host': '192.168.8.8', 'user': 'xbot', 'password': 'xbot'},     # doctest: +SKIP
+    ...     {'host': '192.168.8.9', 'user': 'xbot', 'password': 'xbot'},     # doctest: +SKIP
+    ... ], concurrency=64)                                               # doctest: +SKIP
+    >>> results = group.exec('uptime')                                  # doctest: +SKIP
+    >>> results.failed                                                  # doctest: +SKIP
+    {'192.168.8.9': SSHConnectError(...)}
+    >>> for host, result in group.as_completed('df -h'):                # doctest: +SKIP
+    ...     print(host, result)                                         # doctest: +SKIP
+    """
+    def __init__(
+        self,
+        hosts: list,
+        concurrency: int = 32,
+        connect_timeout: int = 5,
+        shenvs: dict = {}
+    ):
+        """
+        :param hosts: list of dict with keys `host`, `user`, `password`,
+            and optional `port`(defaults to 22) and `name`(defaults to `host`).
+        :param concurrency: maximum number of hosts processed at the same time.
+        :param connect_timeout: connect timeout(s) used by `exec`.
+        :param shenvs: same as `SSHConnection`.
+        """
+        self._hosts = {}
+        self._conns = {}
+        for h in hosts:
+            name = h.get('name', h['host'])
+            if name in self._hosts:
+                raise ValueError(f'Duplicate host name: {name}')
+            self._hosts[name] = h
+            self._conns[name] = SSHConnection(dict(shenvs))
+        self._concurrency = concurrency
+        self._connect_timeout = connect_timeout
+
+    @property
+    def names(self) -> list:
+        """
+        Names of the hosts.
+        """
+        return list(self._hosts)
+
+    def getconn(self, name: str) -> SSHConnection:
+        """
+        Get the connection of host `name`.
+        """
+        return self._conns[name]
+
+    def connect(self, timeout: Union[int, dict] = 5) -> GroupResult:
+        """
+        Open the connections.
+
+        :param timeout: connect timeout(s), or a dict maps host name to it,
+            hosts missing from it fail with `KeyError`.
+        :return: maps host name to None or the exception.
+        """
+        return self._run(self._connect, timeout)
+
+    def disconnect(self) -> None:
+        """
+        Close the connections.
+        """
+        for conn in self._conns.values():
+            conn.disconnect()
+
+    def exec(
+        self,
+        cmd: str,
+        expect: Union[int, str, None] = 0,
+        timeout: Union[int, dict] = 15,
+        **kwargs
+    ) -> GroupResult:
+        """
+        Execute a command on all hosts, wait until all of them finish.
+
+        Hosts not connected yet are connected first.
+
+        :param cmd: the command to be executed.
+        :param expect: same as `SSHConnection.exec`.
+        :param timeout: command timeout(s), or a dict maps host name to it,
+            hosts missing from it fail with `KeyError`.
+        :param kwargs: other arguments of `SSHConnection.exec`.
+        :return: maps host name to `SSHCommandResult` or the exception.
+        """
+        return self._run(self._exec, timeout, cmd, expect, **kwargs)
+
+    def as_completed(
+        self,
+        cmd: str,
+        expect: Union[int, str, None] = 0,
+        timeout: Union[int, dict] = 15,
+        **kwargs
+    ) -> Generator[Tuple[str, Union[SSHCommandResult, Exception]], None, None]:
+        """
+        Execute a command on all hosts, yield (host name, result or exception)
+        as soon as each host finishes, arguments are same to `exec`.
+        """
+        yield from self._iter(self._exec, timeout, cmd, expect, **kwargs)
+
+    def _run(self, func, timeout: Union[int, dict], *args, **kwargs) -> GroupResult:
+        """
+        Call `func` for all hosts concurrently and wait for all of them.
+        """
+        results = dict(self._iter(func, timeout, *args, **kwargs))
+        return GroupResult((name, results[name]) for name in self._hosts)
+
+    def _iter(self, func, timeout: Union[int, dict], *args, **kwargs):
+        """
+        Call `func` for all hosts concurrently, yield (name, result) in
+        completion order.
+        """
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            futures = {
+                executor.submit(self._call, func, name, timeout,
+                                *args, **kwargs): name
+                for name in self._hosts
+            }
+            for f in as_completed(futures):
+                yield futures[f], f.result()
+
+    def _call(self, func, name: str, timeout: Union[int, dict], *args, **kwargs):
+        """
+        Call `func` for host `name`, return the exception instead of raising
+        (`KeyError` if `timeout` is a dict without `name`).
+        """
+        try:
+            if isinstance(timeout, dict):
+                timeout = timeout[name]
+            return func(name, timeout, *args, **kwargs)
+        except Exception as e:
+            return e
+
+    def _connect(self, name: str, timeout: int) -> None:
+        h = self._hosts[name]
+        self._conns[name].connect(h['host'], h['user'], h['password'],
+                                  port=h.get('port', 22), timeout=timeout)
+
+    def _exec(self, name: str, timeout: int, cmd: str, *args, **kwargs) -> SSHCommandResult:
+        self._connect(name, self._connect_timeout)
+        return self._conns[name].exec(cmd, *args, timeout=timeout, **kwargs)
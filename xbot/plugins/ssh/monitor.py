@@ -0,0 +1,364 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Transfer progress and metrics module.
+"""
+
+import abc
+import time
+import socket
+import logging
+import threading
+
+from typing import Callable, Optional
+from collections import deque
+
+
+class FileTiming(object):
+    """
+    Latency breakdown (seconds) of the transfer of one file, each phase
+    is the longest one among the workers of the file.
+    """
+    __slots__ = ('path', 'size', 'open', 'data', 'close')
+
+    def __init__(self, path: str, size: int = 0):
+        """
+        :param path: remote file.
+        :param size: number of bytes transferred.
+        """
+        self.path = path
+        self.size = size
+        self.open = 0.0
+        self.data = 0.0
+        self.close = 0.0
+
+    def add(self, opened: float, written: float, closed: float) -> None:
+        """
+        Add the phases of a worker, given as `time.monotonic()` values
+        relative to its start.
+        """
+        self.open = max(self.open, opened)
+        self.data = max(self.data, written - opened)
+        self.close = max(self.close, closed - written)
+
+    def __repr__(self) -> str:
+        return (f'FileTiming({self.path!r}, size={self.size}, open={self.open:.3f}, '
+                f'data={self.data:.3f}, close={self.close:.3f})')
+
+
+class TransferProgress(object):
+    """
+    Progress of a transfer, given to the observers.
+    """
+    WINDOW = 5.0
+
+    def __init__(self, op: str, path: str, files: int = 0, size: int = 0):
+        """
+        :param op: 'get' or 'put'.
+        :param path: remote file or dir.
+        :param files: number of files to transfer.
+        :param size: number of bytes to transfer.
+        """
+        self.op = op
+        self.path = path
+        self.files = files
+        self.size = size
+        self.filesdone = 0
+        self.sizedone = 0
+        self.start = time.monotonic()
+        self.end = None
+        # (time, sizedone) of the last `WINDOW` seconds.
+        self._samples = deque([(self.start, 0)])
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def throughput(self) -> float:
+        """
+        Average MB per second.
+        """
+        elapsed = self.elapsed
+        return self.sizedone / 1048576 / elapsed if elapsed else 0.0
+
+    @property
+    def rate(self) -> float:
+        """
+        MB per second of the last `WINDOW` seconds.
+        """
+        t, size = self._samples[0]
+        elapsed = (self.end or time.monotonic()) - t
+        return (self.sizedone - size) / 1048576 / elapsed if elapsed else 0.0
+
+    @property
+    def filerate(self) -> float:
+        """
+        Files per second.
+        """
+        elapsed = self.elapsed
+        return self.filesdone / elapsed if elapsed else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """
+        Seconds remaining at the current rate, None if unknown.
+
+        >>> p = TransferProgress('get', '/tmp/f', 1, 4 * 1048576)
+        >>> p.sizedone, p._samples = 1048576, deque([(p.start - 1, 0)])
+        >>> round(p.eta)
+        3
+        """
+        rate = self.rate
+        if self.end is not None:
+            return 0.0
+        return max(self.size - self.sizedone, 0) / 1048576 / rate if rate else None
+
+    def _sample(self) -> None:
+        now = time.monotonic()
+        self._samples.append((now, self.sizedone))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.WINDOW:
+            self._samples.popleft()
+
+    def __repr__(self) -> str:
+        percent = self.sizedone * 100 / self.size if self.size else 100.0
+        eta = self.eta
+        return (f'{self.op} {self.path}: {percent:.1f}% '
+                f'{self.sizedone / 1048576:.1f}/{self.size / 1048576:.1f}MB, '
+                f'{self.filesdone}/{self.files} files, {self.rate:.2f}MB/s '
+                f'(avg {self.throughput:.2f}MB/s, {self.filerate:.2f} files/s), '
+                f"ETA {'?' if eta is None else f'{eta:.0f}s'}")
+
+
+class TransferObserver(object):
+    """
+    Base of the observers of transfers, the hooks are called from the
+    worker threads of a transfer, so they must be quick and thread-safe.
+    """
+    def started(self, progress: TransferProgress) -> None:
+        pass
+
+    def updated(self, progress: TransferProgress) -> None:
+        """
+        Called at most every `TransferMonitor.INTERVAL` seconds while data
+        is transferred.
+        """
+        pass
+
+    def filedone(self, progress: TransferProgress, timing: FileTiming) -> None:
+        pass
+
+    def finished(self, progress: TransferProgress, error: Optional[BaseException]) -> None:
+        """
+        :param error: the error which stopped the transfer, None if it succeeded.
+        """
+        pass
+
+
+class CallbackObserver(TransferObserver):
+    """
+    Observer which calls `callback(progress)` on each update and at the end.
+    """
+    def __init__(self, callback: Callable[[TransferProgress], None]):
+        self._callback = callback
+
+    def updated(self, progress: TransferProgress) -> None:
+        self._callback(progress)
+
+    def finished(self, progress: TransferProgress, error: Optional[BaseException]) -> None:
+        self._callback(progress)
+
+
+class LogObserver(TransferObserver):
+    """
+    Observer which logs the progress of long transfers.
+    """
+    def __init__(self, logger: logging.LoggerAdapter, interval: float = 10.0):
+        """
+        :param logger: logger of the connection.
+        :param interval: seconds between two progress lines.
+        """
+        self._logger = logger
+        self._interval = interval
+        self._logged = {}
+        self._lock = threading.Lock()
+
+    def started(self, progress: TransferProgress) -> None:
+        with self._lock:
+            self._logged[id(progress)] = progress.start
+
+    def updated(self, progress: TransferProgress) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._logged.get(id(progress), now) < self._interval:
+                return
+            self._logged[id(progress)] = now
+        self._logger.info(f'{progress}')
+
+    def finished(self, progress: TransferProgress, error: Optional[BaseException]) -> None:
+        with self._lock:
+            self._logged.pop(id(progress), None)
+        if error is not None:
+            self._logger.error(f'{progress} failed: {error}')
+
+
+class MetricsSink(abc.ABC):
+    """
+    Destination of metrics, e.g. `StatsdSink`, subclasses implement `emit`.
+    """
+    @abc.abstractmethod
+    def emit(self, name: str, value: float, tags: dict) -> None:
+        """
+        Emit the value of metric `name` with `tags`.
+        """
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sink which sends metrics as statsd gauges over UDP, with the tags in
+    the DogStatsD format (`name:value|g|#key:value,...`).
+
+    >>> server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    >>> server.bind(('127.0.0.1', 0))
+    >>> sink = StatsdSink(*server.getsockname())
+    >>> sink.emit('sftp.transfer.bytes', 1024, {'op': 'get'})
+    >>> server.recv(512)
+    b'sftp.transfer.bytes:1024|g|#op:get'
+    >>> sink.close(); server.close()
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 8125):
+        """
+        :param host: host of the statsd server.
+        :param port: UDP port of the statsd server.
+        """
+        self._addr = (host, port)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, name: str, value: float, tags: dict) -> None:
+        line = f'{name}:{value}|g'
+        if tags:
+            line += '|#' + ','.join(f'{k}:{v}' for k, v in tags.items())
+        try:
+            self._sock.sendto(line.encode(), self._addr)
+        except OSError:
+            # metrics are best effort, never fail a transfer.
+            pass
+
+    def close(self) -> None:
+        """
+        Close the socket.
+        """
+        self._sock.close()
+
+
+class MetricsObserver(TransferObserver):
+    """
+    Observer which emits metrics of files and transfers to a sink.
+
+    Per file: `<prefix>.file.open`, `.data`, `.close` (seconds).
+    Per transfer: `<prefix>.transfer.bytes`, `.files`, `.seconds`,
+    `.throughput` (MB/s), `.filerate` (files/s) and `.errors`.
+
+    >>> class PrintSink(MetricsSink):
+    ...     def emit(self, name, value, tags):
+    ...         print(name, value, tags)
+    >>> observer = MetricsObserver(PrintSink())
+    >>> observer.filedone(TransferProgress('get', '/tmp'), FileTiming('/tmp/f'))
+    sftp.file.open 0.0 {'op': 'get'}
+    sftp.file.data 0.0 {'op': 'get'}
+    sftp.file.close 0.0 {'op': 'get'}
+    """
+    def __init__(self, sink: MetricsSink, prefix: str = 'sftp', tags: dict = {}):
+        """
+        :param sink: where to emit the metrics.
+        :param prefix: prefix of the metric names.
+        :param tags: tags added to all metrics, e.g. {'host': ...}.
+        """
+        self._sink = sink
+        self._prefix = prefix
+        self._tags = tags
+
+    def filedone(self, progress: TransferProgress, timing: FileTiming) -> None:
+        tags = dict(self._tags, op=progress.op)
+        for phase in ('open', 'data', 'close'):
+            self._sink.emit(f'{self._prefix}.file.{phase}', getattr(timing, phase), tags)
+
+    def finished(self, progress: TransferProgress, error: Optional[BaseException]) -> None:
+        tags = dict(self._tags, op=progress.op)
+        emit = lambda name, value: self._sink.emit(f'{self._prefix}.transfer.{name}', value, tags)
+        emit('bytes', progress.sizedone)
+        emit('files', progress.filesdone)
+        emit('seconds', progress.elapsed)
+        emit('throughput', progress.throughput)
+        emit('filerate', progress.filerate)
+        emit('errors', int(error is not None))
+
+
+class TransferMonitor(object):
+    """
+    Progress of a transfer fed by its workers and dispatched to observers.
+
+    >>> with TransferMonitor('put', '/tmp/f', [], files=1, size=10) as monitor:
+    ...     monitor.update(10)
+    >>> monitor.progress.sizedone
+    10
+    """
+    INTERVAL = 0.5
+
+    def __init__(
+        self,
+        op: str,
+        path: str,
+        observers: list,
+        files: int = 0,
+        size: int = 0
+    ):
+        """
+        :param op: 'get' or 'put'.
+        :param path: remote file or dir.
+        :param observers: list of `TransferObserver`.
+        :param files: number of files to transfer.
+        :param size: number of bytes to transfer.
+        """
+        self.progress = TransferProgress(op, path, files, size)
+        self._observers = observers
+        self._notified = self.progress.start
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'TransferMonitor':
+        for o in self._observers:
+            o.started(self.progress)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        self.progress.end = time.monotonic()
+        for o in self._observers:
+            o.finished(self.progress, exc_value)
+
+    def update(self, size: int) -> None:
+        """
+        Account `size` bytes transferred.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.progress.sizedone += size
+            if now - self._notified < self.INTERVAL:
+                return
+            self._notified = now
+            self.progress._sample()
+        for o in self._observers:
+            o.updated(self.progress)
+
+    def skip(self, size: int) -> None:
+        """
+        Account `size` bytes which need no transfer (e.g. already
+        transferred before a resume).
+        """
+        with self._lock:
+            self.progress.size -= size
+
+    def filedone(self, timing: FileTiming) -> None:
+        with self._lock:
+            self.progress.filesdone += 1
+        for o in self._observers:
+            o.filedone(self.progress, timing)
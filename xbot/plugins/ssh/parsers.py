@@ -0,0 +1,394 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Command output parsing module.
+
+Parsers turn outputs of common commands into a `Table`, whose columns
+are typed arrays (numbers) or lists of interned strings (text), so the
+output is split once and later queries work on whole columns.
+
+>>> t = parse('free', '''\\
+...               total        used        free      shared  buff/cache   available
+... Mem:       16282412     3520316     8868508      404116     3893588    12033012
+... Swap:       2097148           0     2097148''')
+>>> t.names
+['type', 'total', 'used', 'free', 'shared', 'buff_cache', 'available']
+>>> t.filter(type='Mem')['used'][0]
+3520316
+"""
+
+import re
+import sys
+
+from array import array
+from typing import Callable, Iterator, Optional, Sequence, Union
+
+
+class Table(object):
+    """
+    Columnar table.
+
+    >>> t = Table.fromrows(['user', 'pid', 'pcpu'],
+    ...                    [('root', '1', '0.3'), ('xbot', '7', '2.5'), ('xbot', '9', '1.0')])
+    >>> t['pid']
+    array('q', [1, 7, 9])
+    >>> t.filter(user='xbot', pcpu=lambda v: v > 2).rows()
+    [('xbot', 7, 2.5)]
+    >>> t.aggregate('pcpu', max, by='user')
+    {'root': 0.3, 'xbot': 2.5}
+    """
+    def __init__(self, columns: dict):
+        """
+        :param columns: maps column name to its values, all of the same length.
+        """
+        self._columns = columns
+        self._len = len(next(iter(columns.values()))) if columns else 0
+
+    @classmethod
+    def fromrows(cls, names: Sequence[str], rows: Sequence[Sequence[str]]) -> 'Table':
+        """
+        Build a table from rows of strings, columns whose values are all
+        integers (or numbers) become `array('q')` (or `array('d')`).
+
+        :param names: column names.
+        :param rows: fields of each row, as many as `names`.
+        """
+        columns = zip(*rows) if rows else [()] * len(names)
+        return cls({n: _column(c) for n, c in zip(names, columns)})
+
+    @property
+    def names(self) -> list:
+        """
+        Column names.
+        """
+        return list(self._columns)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, name: str) -> Union[array, list]:
+        """
+        Values of column `name` (do not modify them).
+        """
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise KeyError(f'No column named {name!r} in {self.names}') from None
+
+    def __iter__(self) -> Iterator[tuple]:
+        return zip(*self._columns.values())
+
+    def __repr__(self) -> str:
+        return f'Table({self._len} rows: {", ".join(self._columns)})'
+
+    def rows(self) -> list:
+        """
+        Values of each row as tuples.
+        """
+        return list(self)
+
+    def todicts(self) -> list:
+        """
+        Values of each row as dicts.
+        """
+        names = self.names
+        return [dict(zip(names, row)) for row in self]
+
+    def select(self, *names: str) -> 'Table':
+        """
+        Table of columns `names` only.
+        """
+        return Table({n: self[n] for n in names})
+
+    def filter(self, **conds: Union[Callable, object]) -> 'Table':
+        """
+        Table of the rows which match all `conds`.
+
+        :param conds: maps column name to the value to be equal to, or to
+            a function of the value which returns True to keep the row.
+        """
+        indexes = range(self._len)
+        for name, cond in conds.items():
+            col = self[name]
+            if callable(cond):
+                indexes = [i for i in indexes if cond(col[i])]
+            else:
+                indexes = [i for i in indexes if col[i] == cond]
+        return self._take(indexes)
+
+    def sort(self, name: str, reverse: bool = False) -> 'Table':
+        """
+        Table sorted by column `name`.
+        """
+        col = self[name]
+        return self._take(sorted(range(self._len), key=col.__getitem__, reverse=reverse))
+
+    def aggregate(
+        self,
+        name: str,
+        func: Callable = sum,
+        by: Optional[str] = None
+    ) -> Union[object, dict]:
+        """
+        Aggregate column `name` with `func` (sum, min, max, len,
+        statistics.mean, etc.).
+
+        :param by: column to group rows by.
+        :return: result of `func`, or maps each value of `by` to the result
+            of its group.
+        """
+        col = self[name]
+        if by is None:
+            return func(col)
+        groups = {}
+        for key, value in zip(self[by], col):
+            groups.setdefault(key, []).append(value)
+        return {key: func(values) for key, values in groups.items()}
+
+    def _take(self, indexes: Sequence[int]) -> 'Table':
+        """
+        Table of rows `indexes`.
+        """
+        columns = {}
+        for name, col in self._columns.items():
+            values = [col[i] for i in indexes]
+            columns[name] = array(col.typecode, values) if isinstance(col, array) else values
+        table = Table(columns)
+        table._len = len(indexes)
+        return table
+
+
+def _column(values: Sequence[str]) -> Union[array, list]:
+    """
+    Typed array of `values`, or list of interned strings if they are not
+    all numbers.
+    """
+    for typecode, convert in (('q', int), ('d', float)):
+        try:
+            return array(typecode, map(convert, values))
+        except (ValueError, OverflowError):
+            pass
+    return [sys.intern(v) for v in values]
+
+
+def _colname(name: str) -> str:
+    """
+    Identifier from a column header, e.g. '%CPU' -> 'pcpu'.
+    """
+    return re.sub(r'\W+', '_', name.lower().replace('%', 'p')).strip('_')
+
+
+# Maps parser name to function of lines which returns a `Table`.
+PARSERS = {}
+
+
+def register(name: str) -> Callable:
+    """
+    Decorator which registers a parser.
+
+    >>> @register('uptime')                         # doctest: +SKIP
+    ... def parse_uptime(lines: Sequence[str]) -> Table:
+    ...     ...
+    """
+    def decorator(func: Callable[[Sequence[str]], Table]) -> Callable:
+        PARSERS[name] = func
+        return func
+    return decorator
+
+
+def parse(name: str, output: Union[str, Sequence[str]]) -> Table:
+    """
+    Parse a command output.
+
+    :param name: name of the parser, see `PARSERS`.
+    :param output: output or its lines.
+    """
+    try:
+        parser = PARSERS[name]
+    except KeyError:
+        raise ValueError(f'Unknown parser {name!r}, available: {sorted(PARSERS)}') from None
+    if isinstance(output, str):
+        output = output.splitlines()
+    return parser(output)
+
+
+@register('table')
+@register('ps')
+def parse_table(lines: Sequence[str]) -> Table:
+    """
+    Output whose first line is a header of one-word column names (`ps`,
+    `ps aux`, `ps -eo ...`), the last column takes the rest of the line.
+
+    >>> parse('ps', '''\\
+    ...   PID  PPID %CPU   RSS COMMAND
+    ...     1     0  0.3  9216 /sbin/init splash
+    ...     2     0  0.0     0 [kthreadd]''').todicts()[0]
+    {'pid': 1, 'ppid': 0, 'pcpu': 0.3, 'rss': 9216, 'command': '/sbin/init splash'}
+    """
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return Table({})
+    names = []
+    for h in lines[0].split():
+        name, n = _colname(h), 2
+        while name in names:
+            name, n = f'{_colname(h)}_{n}', n + 1
+        names.append(name)
+    rows = [fields for fields in (line.split(None, len(names) - 1) for line in lines[1:])
+            if len(fields) == len(names)]
+    return Table.fromrows(names, rows)
+
+
+def _bytes(size: str) -> str:
+    """
+    Number of bytes of a human-readable size of `df -h` or `ls -h`
+    (powers of 1024), other values are kept.
+
+    >>> _bytes('1.5K'), _bytes('20G'), _bytes('0'), _bytes('-')
+    ('1536', '21474836480', '0', '-')
+    """
+    m = re.fullmatch(r'(\d+(?:[.,]\d+)?)([KMGTPEZY])i?B?', size)
+    if not m:
+        return size
+    power = 'KMGTPEZY'.index(m.group(2)) + 1
+    return str(int(float(m.group(1).replace(',', '.')) * 1024 ** power))
+
+
+@register('df')
+def parse_df(lines: Sequence[str]) -> Table:
+    """
+    Output of `df -P` (or `df -k`, `df -h`), 'Use%' (or 'Capacity') is an
+    integer column `usep`. Sizes are in the blocks of the header (1024
+    bytes for `-P` and `-k`), or in bytes for `-h`.
+
+    >>> parse('df', '''\\
+    ... Filesystem      Size  Used Avail Use% Mounted on
+    ... /dev/vda         20G  1.5G   18G   8% /''').rows()
+    [('/dev/vda', 21474836480, 1610612736, 19327352832, 8, '/')]
+    """
+    names = ['filesystem', 'size', 'used', 'avail', 'usep', 'mount']
+    rows = []
+    for line in lines[1:]:
+        fields = line.split(None, 5)
+        if len(fields) == 6:
+            fields[1:4] = [_bytes(f) for f in fields[1:4]]
+            fields[4] = fields[4].rstrip('%').replace('-', '0')
+            rows.append(fields)
+    return Table.fromrows(names, rows)
+
+
+@register('free')
+def parse_free(lines: Sequence[str]) -> Table:
+    """
+    Output of `free` (`-b`, `-k`, ...), the first column `type` is 'Mem'
+    or 'Swap', the values missing from a row (e.g. `shared` of 'Swap')
+    are 0.
+
+    >>> parse('free', '''\\
+    ...               total        used        free      shared  buff/cache   available
+    ... Mem:       16282412     3520316     8868508      404116     3893588    12033012
+    ... Swap:       2097148           0     2097148''').filter(type='Swap').rows()
+    [('Swap', 2097148, 0, 2097148, 0, 0, 0)]
+    """
+    if not lines:
+        return Table({})
+    names = ['type'] + [_colname(h) for h in lines[0].split()]
+    rows = []
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) < 2 or len(fields) > len(names) or not fields[0].endswith(':'):
+            continue
+        fields[0] = fields[0].rstrip(':')
+        rows.append(fields + ['0'] * (len(names) - len(fields)))
+    return Table.fromrows(names, rows)
+
+
+@register('ss')
+def parse_ss(lines: Sequence[str]) -> Table:
+    """
+    Output of `ss` (e.g. `ss -tan`, `ss -tanp`), column `process` is ''
+    without `-p`.
+
+    >>> t = parse('ss', '''\\
+    ... State  Recv-Q Send-Q Local Address:Port Peer Address:Port Process
+    ... LISTEN 0      128        127.0.0.1:22        0.0.0.0:*
+    ... ESTAB  0      36        10.0.0.2:22       10.0.0.9:50312''')
+    >>> t.filter(state='ESTAB')['peer']
+    ['10.0.0.9:50312']
+    """
+    if not lines:
+        return Table({})
+    names = ['state', 'recvq', 'sendq', 'local', 'peer', 'process']
+    if lines[0].split()[0] == 'Netid':
+        names.insert(0, 'netid')
+    rows = []
+    for line in lines[1:]:
+        fields = line.split(None, len(names) - 1)
+        if len(fields) == len(names) - 1:
+            fields.append('')
+        if len(fields) == len(names):
+            rows.append(fields)
+    return Table.fromrows(names, rows)
+
+
+@register('ip addr')
+def parse_ipaddr(lines: Sequence[str]) -> Table:
+    """
+    Output of `ip addr`, one row per address.
+
+    >>> t = parse('ip addr', '''\\
+    ... 1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN group default qlen 1000
+    ...     link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+    ...     inet 127.0.0.1/8 scope host lo
+    ...        valid_lft forever preferred_lft forever
+    ... 2: eth0@if5: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc noqueue state UP group default
+    ...     inet 10.0.0.2/24 brd 10.0.0.255 scope global eth0
+    ...     inet6 fe80::1/64 scope link''')
+    >>> t.filter(family='inet', scope='global').rows()
+    [(2, 'eth0', 'UP', 1500, 'inet', '10.0.0.2', 24, 'global')]
+    """
+    names = ['index', 'ifname', 'state', 'mtu', 'family', 'address', 'prefixlen', 'scope']
+    rows, link = [], None
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if not line[0].isspace():
+            opts = dict(zip(fields[3::2], fields[4::2]))
+            link = [fields[0].rstrip(':'), fields[1].rstrip(':').split('@')[0],
+                    opts.get('state', 'UNKNOWN'), opts.get('mtu', '0')]
+        elif link and fields[0] in ('inet', 'inet6'):
+            address, _, prefixlen = fields[1].partition('/')
+            opts = dict(zip(fields[2::2], fields[3::2]))
+            rows.append(link + [fields[0], address, prefixlen or '0', opts.get('scope', '')])
+    return Table.fromrows(names, rows)
+
+
+@register('meminfo')
+def parse_meminfo(lines: Sequence[str]) -> Table:
+    """
+    Content of `/proc/meminfo`, column `value` is in bytes.
+    """
+    rows = []
+    for line in lines:
+        name, _, value = line.partition(':')
+        fields = value.split()
+        if fields:
+            size = int(fields[0]) * (1024 if fields[1:] == ['kB'] else 1)
+            rows.append((name.strip(), str(size)))
+    return Table.fromrows(['name', 'value'], rows)
+
+
+@register('loadavg')
+def parse_loadavg(lines: Sequence[str]) -> Table:
+    """
+    Content of `/proc/loadavg`.
+    """
+    names = ['load1', 'load5', 'load15', 'running', 'total', 'lastpid']
+    rows = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 5:
+            running, _, total = fields[3].partition('/')
+            rows.append(fields[:3] + [running, total, fields[4]])
+    return Table.fromrows(names, rows)
@@ -0,0 +1,295 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Connection pool module.
+"""
+
+import time
+import weakref
+import threading
+
+from typing import Generator, Union
+from collections import deque
+from contextlib import contextmanager
+
+from xbot.framework.logger import getlogger
+from xbot.plugins.ssh.ssh import SSHConnection
+from xbot.plugins.ssh.sftp import SFTPConnection
+
+
+logger = getlogger(__name__)
+
+
+class PoolStats(object):
+    """
+    Counters of a connection pool.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+        self.handshakes = 0
+        self.handshake_time = 0.0
+
+    @property
+    def hitrate(self) -> float:
+        """
+        Ratio of checkouts served by an idle connection.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __repr__(self) -> str:
+        return (f'PoolStats(hits={self.hits}, misses={self.misses}, '
+                f'reconnects={self.reconnects}, evictions={self.evictions}, '
+                f'handshakes={self.handshakes}, '
+                f'handshake_time={self.handshake_time:.3f})')
+
+
+class SSHConnectionPool(object):
+    """
+    Pool of connections keyed by (host, port, user).
+
+    >>> pool = SSHConnectionPool(maxsize=4)                             # doctest: +SKIP
+    >>> with pool.connection('192.168.8.8', 'xbot', 'xbot') as conn:    # doctest: +SKIP
+    ...     conn.exec('uptime')                                         # doctest: +SKIP
+    >>> pool.stats                                                      # doctest: +SKIP
+    PoolStats(hits=0, misses=1, reconnects=0, evictions=0, handshakes=1, handshake_time=0.085)
+    """
+    # Max seconds between two evictions by the reaper thread.
+    REAPINTERVAL = 10
+
+    def __init__(
+        self,
+        maxsize: int = 8,
+        idletime: float = 300,
+        keepalive: float = 30,
+        connclass: type = SSHConnection,
+        probetimeout: float = 5
+    ):
+        """
+        :param maxsize: maximum number of connections per key.
+        :param idletime: idle connections older than this (seconds) are closed.
+        :param keepalive: connections idle longer than this (seconds) are
+            probed before reuse, also used as transport keepalive interval.
+        :param connclass: `SSHConnection` or `SFTPConnection`.
+        :param probetimeout: seconds to wait for the reply of a keepalive
+            probe, the connection is reopened if it does not come.
+        """
+        self._maxsize = maxsize
+        self._idletime = idletime
+        self._keepalive = keepalive
+        self._connclass = connclass
+        self._probetimeout = probetimeout
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._counts = {}
+        self._keys = {}
+        self.stats = PoolStats()
+        self._closed = threading.Event()
+        interval = min(max(idletime, 0.1), self.REAPINTERVAL)
+        threading.Thread(target=_reap, args=(weakref.ref(self), interval, self._closed),
+                         daemon=True).start()
+
+    def checkout(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        port: int = 22,
+        timeout: float = None
+    ) -> Union[SSHConnection, SFTPConnection]:
+        """
+        Get a connection from the pool, open a new one if no idle one.
+
+        :param host: hostname or ip.
+        :param user: user name.
+        :param password: user password.
+        :param port: SSH port.
+        :param timeout: seconds to wait when `maxsize` is reached,
+            None means wait forever.
+
+        :raises:
+            `TimeoutError` -- if no connection is available within `timeout`.
+        """
+        key = (host, port, user)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.evict()
+        with self._lock:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    conn, lastused = idle.pop()
+                    self.stats.hits += 1
+                    break
+                if self._counts.get(key, 0) < self._maxsize:
+                    self._counts[key] = self._counts.get(key, 0) + 1
+                    conn, lastused = None, None
+                    self.stats.misses += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'No connection available for {user}@{host}:{port} '
+                                       f'in {timeout}s (maxsize={self._maxsize}).')
+                self._lock.wait(remaining)
+        try:
+            if conn is None:
+                conn = self._connclass()
+                self._connect(conn, host, user, password, port)
+            elif not self._healthy(conn, lastused):
+                with self._lock:
+                    self.stats.reconnects += 1
+                conn.disconnect()
+                self._connect(conn, host, user, password, port)
+        except Exception:
+            with self._lock:
+                self._counts[key] -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._keys[id(conn)] = key
+        return conn
+
+    def checkin(self, conn: Union[SSHConnection, SFTPConnection]) -> None:
+        """
+        Return a connection to the pool, dead connections are dropped.
+
+        :raises:
+            `ValueError` -- if `conn` was not checked out from this pool.
+        """
+        with self._lock:
+            key = self._keys.pop(id(conn), None)
+            if key is None:
+                raise ValueError(f'{conn!r} was not checked out from this pool.')
+            if conn.active:
+                self._idle.setdefault(key, deque()).append((conn, time.monotonic()))
+            else:
+                self._counts[key] -= 1
+            self._lock.notify()
+
+    @contextmanager
+    def connection(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        port: int = 22,
+        timeout: float = None
+    ) -> Generator[Union[SSHConnection, SFTPConnection], None, None]:
+        """
+        Checkout a connection and checkin it at exit, arguments are same to `checkout`.
+        """
+        conn = self.checkout(host, user, password, port, timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def evict(self, dead: bool = False) -> None:
+        """
+        Close idle connections unused for more than `idletime`, called on
+        each checkout and periodically by a thread of the pool (until
+        `close`).
+
+        :param dead: also close idle connections whose transport is dead
+            (checkout reconnects them instead).
+        """
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            for key, idle in self._idle.items():
+                alive = deque()
+                for conn, lastused in idle:
+                    if now - lastused > self._idletime or (dead and not conn.active):
+                        expired.append(conn)
+                        self._counts[key] -= 1
+                        self.stats.evictions += 1
+                    else:
+                        alive.append((conn, lastused))
+                idle.clear()
+                idle.extend(alive)
+            if expired:
+                self._lock.notify_all()
+        for conn in expired:
+            conn.disconnect()
+
+    def close(self) -> None:
+        """
+        Close all idle connections and stop evicting them.
+        """
+        self._closed.set()
+        with self._lock:
+            conns = [c for idle in self._idle.values() for c, _ in idle]
+            for key, idle in self._idle.items():
+                self._counts[key] -= len(idle)
+            self._idle.clear()
+        for conn in conns:
+            conn.disconnect()
+
+    def _connect(
+        self,
+        conn: Union[SSHConnection, SFTPConnection],
+        host: str,
+        user: str,
+        password: str,
+        port: int
+    ) -> None:
+        """
+        Open `conn` and account the handshake.
+        """
+        start = time.monotonic()
+        conn.connect(host, user, password, port)
+        with self._lock:
+            self.stats.handshakes += 1
+            self.stats.handshake_time += time.monotonic() - start
+        conn.transport.set_keepalive(int(self._keepalive))
+
+    def _healthy(
+        self,
+        conn: Union[SSHConnection, SFTPConnection],
+        lastused: float
+    ) -> bool:
+        """
+        Check whether `conn` is alive, probe the server with a keepalive
+        request if it has been idle for more than `keepalive`.
+
+        The request is waited for in another thread for `probetimeout`
+        seconds, so a half-open link does not block the caller (the thread
+        ends when the connection is closed).
+        """
+        if not conn.active:
+            return False
+        if time.monotonic() - lastused <= self._keepalive:
+            return True
+        transport = conn.transport
+        errors = []
+        def probe():
+            try:
+                transport.global_request('keepalive@openssh.com', wait=True)
+            except Exception as e:
+                errors.append(e)
+        prober = threading.Thread(target=probe, daemon=True)
+        prober.start()
+        prober.join(self._probetimeout)
+        if prober.is_alive():
+            logger.debug(f'Keepalive probe timedout({self._probetimeout}s)')
+            return False
+        if errors:
+            logger.debug(f'Keepalive probe failed: {errors[0]}')
+            return False
+        return conn.active
+
+
+def _reap(ref: weakref.ref, interval: float, closed: threading.Event) -> None:
+    """
+    Call `evict` of the pool every `interval` seconds until it is closed
+    or collected, so idle connections do not outlive `idletime` when
+    nothing is checked out.
+    """
+    while not closed.wait(interval):
+        pool = ref()
+        if pool is None:
+            return
+        pool.evict(dead=True)
+        del pool
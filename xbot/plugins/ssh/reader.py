@@ -0,0 +1,153 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Remote file random-access reading module.
+"""
+
+import io
+
+from typing import Optional
+from collections import OrderedDict
+
+from paramiko import SFTPFile
+
+
+class RemoteReader(io.RawIOBase):
+    """
+    Raw reader of a remote file with an LRU cache of blocks.
+
+    Missing blocks of a read are requested together with pipelined
+    requests, so a read costs at most one round-trip whatever its size.
+    When reads are sequential, the following blocks are prefetched in the
+    same round-trip, the read-ahead doubles on each sequential miss up to
+    `readahead` blocks and falls back to none on a random access.
+
+    Wrapped in a `io.BufferedReader` (see `SFTPConnection.openreader`),
+    it can be given to `tarfile`, `zipfile`, `gzip`, etc.
+
+    >>> with zipfile.ZipFile(RemoteReader(sftpclient.open('/tmp/a.zip'))) as z:  # doctest: +SKIP
+    ...     z.read('a.txt')                                                    # doctest: +SKIP
+    """
+    BLOCKSIZE = 65536
+
+    def __init__(
+        self,
+        sftpfile: SFTPFile,
+        size: Optional[int] = None,
+        blocksize: int = BLOCKSIZE,
+        cachesize: int = 256,
+        readahead: int = 16
+    ):
+        """
+        :param sftpfile: the remote file opened for reading.
+        :param size: size of the file, fetched if None.
+        :param blocksize: size of the blocks (bytes).
+        :param cachesize: maximum number of cached blocks.
+        :param readahead: maximum number of blocks prefetched.
+        """
+        super().__init__()
+        self._file = sftpfile
+        self._size = sftpfile.stat().st_size if size is None else size
+        self._blocksize = max(blocksize, 1)
+        self._cachesize = max(cachesize, readahead + 1)
+        self._readahead = readahead
+        self._cache = OrderedDict()
+        self._pos = 0
+        self._next = 0
+        self._window = 0
+        self.hits = 0
+        self.fetches = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'Invalid whence: {whence}')
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+        self._pos = offset
+        return offset
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        view = memoryview(b).cast('B')
+        n = min(len(view), self._size - self._pos)
+        if n <= 0:
+            return 0
+        bs = self._blocksize
+        first, last = self._pos // bs, (self._pos + n - 1) // bs
+        blocks = self._blocks(first, last)
+        done = 0
+        for i in range(first, last + 1):
+            data = blocks[i]
+            start = self._pos + done - i * bs
+            chunk = data[start:start + n - done]
+            if not chunk:
+                break
+            view[done:done + len(chunk)] = chunk
+            done += len(chunk)
+        self._pos += done
+        return done
+
+    def close(self) -> None:
+        if not self.closed:
+            self._cache.clear()
+            self._file.close()
+        super().close()
+
+    def _blocks(self, first: int, last: int) -> dict:
+        """
+        Get blocks `first` to `last`, from the cache or the server.
+
+        :return: maps index to data of the blocks.
+        """
+        sequential = first in (self._next - 1, self._next)
+        self._next = last + 1
+        blocks, missing = {}, []
+        for i in range(first, last + 1):
+            data = self._cache.get(i)
+            if data is None:
+                missing.append(i)
+            else:
+                self._cache.move_to_end(i)
+                blocks[i] = data
+        if not missing:
+            self.hits += 1
+            return blocks
+        if sequential:
+            self._window = min(max(self._window * 2, 1), self._readahead)
+        else:
+            self._window = 0
+        nblocks = -(-self._size // self._blocksize)
+        ahead = [i for i in range(last + 1, min(last + 1 + self._window, nblocks))
+                 if i not in self._cache]
+        fetch = missing + ahead
+        bs = self._blocksize
+        chunks = [(i * bs, min(bs, self._size - i * bs)) for i in fetch]
+        self.fetches += 1
+        for i, data in zip(fetch, self._file.readv(chunks)):
+            self._cache[i] = data
+            self._cache.move_to_end(i)
+            if i <= last:
+                blocks[i] = data
+        while len(self._cache) > self._cachesize:
+            self._cache.popitem(last=False)
+        return blocks
@@ -0,0 +1,69 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+SSH session module.
+"""
+
+from xbot.plugins.ssh.ssh import SSHConnection
+from xbot.plugins.ssh.sftp import SFTPConnection
+
+
+class SSHSession(object):
+    """
+    SSH and SFTP connections to one host sharing one transport.
+
+    >>> session = SSHSession()                                  # doctest: +SKIP
+    >>> session.connect('192.168.8.8', 'xbot', 'xbot')          # doctest: +SKIP
+    >>> session.ssh.exec('mkdir -p /tmp/mydir')                 # doctest: +SKIP
+    >>> session.sftp.putfile('/home/myfile', '/tmp/mydir')      # doctest: +SKIP
+    """
+    def __init__(self, shenvs: dict = {}):
+        """
+        :param shenvs: same as `SSHConnection`.
+        """
+        self._ssh = SSHConnection(dict(shenvs))
+        self._sftp = SFTPConnection()
+
+    def connect(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        port: int = 22,
+        timeout: int = 5
+    ) -> None:
+        """
+        Open the connection, arguments are same to `SSHConnection.connect`.
+        """
+        self._ssh.connect(host, user, password, port, timeout)
+
+    def disconnect(self) -> None:
+        """
+        Close the SFTP channel and the transport.
+        """
+        if self._sftp.active:
+            self._sftp.disconnect()
+        self._ssh.disconnect()
+
+    @property
+    def ssh(self) -> SSHConnection:
+        """
+        SSH connection.
+        """
+        return self._ssh
+
+    @property
+    def sftp(self) -> SFTPConnection:
+        """
+        SFTP connection, its channel is opened on first access.
+        """
+        if not self._sftp.active and self._ssh.active:
+            self._sftp.attach(self._ssh.transport)
+        return self._sftp
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether the connection is open.
+        """
+        return self._ssh.active
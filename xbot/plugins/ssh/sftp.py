@@ -4,15 +4,25 @@
 SFTP module
 """
 
+import io
 import os
-import stat
+import time
 
-from typing import Generator
+from typing import Callable, Generator, Optional, Tuple, Union
 from contextlib import contextmanager
 
-from paramiko import Transport, SFTPClient, SFTPFile
+from paramiko import Transport, SFTPClient, SFTPFile, SFTPAttributes
 
 from xbot.framework.logger import getlogger, ExtraAdapter
+from xbot.plugins.ssh.transfer import FileTransfer, TreeTransfer, TransferStats
+from xbot.plugins.ssh.sync import DirSync, SyncReport
+from xbot.plugins.ssh.walk import Walker
+from xbot.plugins.ssh.cache import StatCache
+from xbot.plugins.ssh.archive import TarTransfer
+from xbot.plugins.ssh.throttle import Limiter, TokenBucket
+from xbot.plugins.ssh.reader import RemoteReader
+from xbot.plugins.ssh.monitor import (TransferMonitor, TransferObserver, TransferProgress,
+                                      CallbackObserver, LogObserver)
 
 
 logger = getlogger(__name__)
@@ -22,9 +32,27 @@ class SFTPConnection(object):
     """
     SFTP connection.
     """
-    def __init__(self):
+    def __init__(
+        self,
+        cachettl: float = 0,
+        cachesize: int = 4096,
+        ratelimit: float = 0
+    ):
+        """
+        :param cachettl: seconds stat results and known dirs are cached,
+            0 disables the cache, see `StatCache`.
+        :param cachesize: maximum number of cached paths.
+        :param ratelimit: bandwidth limit (bytes per second) of the
+            transfers of the connection, 0 means no limit. Limits per host
+            and global are set with `throttle.scheduler.setlimit`.
+        """
         self._sftpclient = None
+        self._owntransport = True
+        self._cache = StatCache(cachettl, cachesize) if cachettl > 0 else None
+        self._hastar = {}
         self._logger = ExtraAdapter(logger, {})
+        self._observers = [LogObserver(self._logger)]
+        self._bucket = TokenBucket(ratelimit) if ratelimit > 0 else None
 
     def connect(
         self,
@@ -43,20 +71,109 @@ class SFTPConnection(object):
         t = Transport((host, port))
         t.connect(username=user, password=password)
         self._sftpclient = SFTPClient.from_transport(t)
+        self._owntransport = True
+        self._hastar = {}
+
+    def attach(self, transport: Transport) -> None:
+        """
+        Open the connection on the transport of another connection,
+        e.g. `SSHConnection.transport`, to save a TCP connect and a handshake.
+
+        :param transport: an authenticated transport.
+
+        >>> ssh.connect('192.168.8.8', 'xbot', 'xbot')  # doctest: +SKIP
+        >>> sftp.attach(ssh.transport)                  # doctest: +SKIP
+        """
+        if self.active:
+            return
+        host, port = transport.getpeername()[:2]
+        user = transport.get_username()
+        self._logger.extra['prefix'] = f'sftp://{user}@{host}:{port}'
+        self._logger.info('Attaching...')
+        self._sftpclient = SFTPClient.from_transport(transport)
+        self._owntransport = False
+        self._hastar = {}
 
     def disconnect(self) -> None:
         """
-        Close the connection.
+        Close the connection, the transport is kept if it is attached.
         """
+        transport = self.transport
         self._sftpclient.close()
+        if self._owntransport:
+            transport.close()
+        if self._cache is not None:
+            self._cache.clear()
+
+    @property
+    def transport(self) -> Optional[Transport]:
+        """
+        Transport of the connection, None if never connected.
+        """
+        if self._sftpclient:
+            return self._sftpclient.get_channel().get_transport()
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether the connection is open.
+        """
+        return bool(self._sftpclient and self._sftpclient.sock.active
+                    and self.transport.active)
+
+    @property
+    def cache(self) -> Optional[StatCache]:
+        """
+        The stat cache, None if disabled.
+        """
+        return self._cache
+
+    def addobserver(self, observer: TransferObserver) -> None:
+        """
+        Observe all transfers of the connection, e.g. with a
+        `MetricsObserver`, the progress of long transfers is logged by
+        default.
 
-    def getfile(self, rfile: str, ldir: str, filename: str = None) -> None:
+        >>> sftp.addobserver(MetricsObserver(StatsdSink('192.168.8.9')))   # doctest: +SKIP
+        """
+        self._observers.append(observer)
+
+    def removeobserver(self, observer: TransferObserver) -> None:
+        """
+        Stop observing transfers with `observer`.
+        """
+        self._observers.remove(observer)
+
+    def getfile(
+        self,
+        rfile: str,
+        ldir: str,
+        filename: str = None,
+        chunksize: int = FileTransfer.CHUNKSIZE,
+        concurrency: int = 4,
+        resume: bool = False,
+        verify: bool = False,
+        callback: Callable[[TransferProgress], None] = None
+    ) -> TransferStats:
         """
         Get `rfile` from SFTP server into `ldir`.
+
+        Large files are split into ranges of `chunksize` bytes transferred
+        over up to `concurrency` channels, see `FileTransfer`.
         
         :param rfile: remote file.
         :param ldir: local dir.
         :param filename: specify when you want to rename.
+        :param chunksize: size of the ranges (bytes).
+        :param concurrency: maximum number of channels.
+        :param resume: continue an interrupted transfer of the same file.
+        :param verify: compare checksums of the data with the ones computed
+            on the server, the result is in `verified` of the statistics.
+        :param callback: called with the `TransferProgress` while
+            transferring and at the end.
+        :return: statistics of the transfer.
+        :raises:
+            `.SFTPTransferError` -- if the verification fails.
 
         >>> getfile('/tmp/myfile', '/home')  # /home/myfile
         >>> getfile('/tmp/myfile', 'D:\\')  # D:\\myfile
@@ -66,15 +183,44 @@ class SFTPConnection(object):
         filename = filename or self.basename(rfile)
         lfile = os.path.join(ldir, filename)
         self._logger.info(f'Getting file {lfile} <= {rfile}')
-        self._sftpclient.get(rfile, lfile)
+        attr = self._sftpclient.stat(rfile)
+        with self._monitor('get', rfile, 1, attr.st_size, callback) as monitor:
+            transfer = FileTransfer(self._sftpclient, chunksize, concurrency,
+                                    resume, verify, monitor, self._limiter())
+            stats = transfer.get(rfile, lfile, attr)
+        self._logger.info(f'Got file {lfile}: {stats}')
+        return stats
 
-    def putfile(self, lfile: str, rdir: str, filename: str = None) -> None:
+    def putfile(
+        self,
+        lfile: str,
+        rdir: str,
+        filename: str = None,
+        chunksize: int = FileTransfer.CHUNKSIZE,
+        concurrency: int = 4,
+        resume: bool = False,
+        verify: bool = False,
+        callback: Callable[[TransferProgress], None] = None
+    ) -> TransferStats:
         """
         Put `lfile` into the `rdir` of SFTP server.
 
+        Large files are split into ranges of `chunksize` bytes transferred
+        over up to `concurrency` channels, see `FileTransfer`.
+
         :param lfile: local file.
         :param rdir: remote dir.
         :param filename: specify when you want to rename.
+        :param chunksize: size of the ranges (bytes).
+        :param concurrency: maximum number of channels.
+        :param resume: continue an interrupted transfer of the same file.
+        :param verify: compare checksums of the data with the ones computed
+            on the server, the result is in `verified` of the statistics.
+        :param callback: called with the `TransferProgress` while
+            transferring and at the end.
+        :return: statistics of the transfer.
+        :raises:
+            `.SFTPTransferError` -- if the verification fails.
 
         >>> putfile('/home/myfile', '/tmp')  # /tmp/myfile
         >>> putfile('D:\\myfile', '/tmp')  # /tmp/myfile
@@ -84,61 +230,193 @@ class SFTPConnection(object):
         filename = filename or os.path.basename(lfile)
         rfile = self.join(rdir, filename)
         self._logger.info(f'Putting file {lfile} => {rfile}')
-        self._sftpclient.put(lfile, rfile)
+        size = os.path.getsize(lfile)
+        with self._monitor('put', rfile, 1, size, callback) as monitor:
+            transfer = FileTransfer(self._sftpclient, chunksize, concurrency,
+                                    resume, verify, monitor, self._limiter())
+            try:
+                stats = transfer.put(lfile, rfile)
+            finally:
+                self._touch(rfile)
+        self._logger.info(f'Put file {rfile}: {stats}')
+        return stats
             
-    def getdir(self, rdir: str, ldir: str) -> None:
+    def getdir(
+        self,
+        rdir: str,
+        ldir: str,
+        concurrency: int = 8,
+        mode: str = 'sftp',
+        compress: str = None,
+        resume: bool = False,
+        callback: Callable[[TransferProgress], None] = None
+    ) -> TransferStats:
         """
         Get `rdir` from SFTP server into `ldir`.
+
+        Files are transferred by a pool of workers, see `TreeTransfer`, or
+        as a tar stream through an exec channel if `mode` is 'tar', see
+        `TarTransfer` (falls back to 'sftp' if the server has no `tar`).
         
         :param rdir: remote dir.
         :param ldir: local dir.
+        :param concurrency: number of files transferred at the same time.
+        :param mode: 'sftp' or 'tar'.
+        :param compress: compression of 'tar' mode, None, 'gz', 'bz2' or 'xz'.
+        :param resume: continue an interrupted transfer in 'sftp' mode, the
+            files already transferred are skipped.
+        :param callback: called with the `TransferProgress` while
+            transferring and at the end.
+        :return: statistics of the transfer.
 
         >>> getdir('/tmp/mydir', '/home')  # /home/mydir
         >>> getdir('/tmp/mydir', 'D:\\')  # D:\\mydir
         """
+        start = time.monotonic()
         rdir = self.normpath(rdir)
-        ldir = os.path.join(ldir, '')
-        self._logger.info(f'Getting dir {ldir} <= {rdir}')
-        for top, dirs, files in self.walk(rdir):
-            basename = self.basename(top)
-            ldir = os.path.join(ldir, basename)
-            if not os.path.exists(ldir):
-                os.makedirs(ldir)
-            for f in files:
-                r = self.join(top, f)
-                l = os.path.join(ldir, f)
-                self._sftpclient.get(r, l)
-            for d in dirs:
-                l = os.path.join(ldir, d)
-                if not os.path.exists(l):
-                    os.makedirs(l)
-
-    def putdir(self, ldir: str, rdir: str) -> None:
+        lparent, ldir = ldir, os.path.join(ldir, self.basename(rdir))
+        if self._tarmode(mode, compress):
+            self._logger.info(f'Getting dir {ldir} <= {rdir} (tar)')
+            os.makedirs(lparent, exist_ok=True)
+            with self._monitor('get', rdir, 0, 0, callback) as monitor:
+                transfer = TarTransfer(self.transport, compress, self._limiter(), monitor)
+                stats = transfer.get(rdir, lparent)
+        else:
+            self._logger.info(f'Getting dir {ldir} <= {rdir}')
+            items = []
+            for top, dirs, files in self.walk(rdir, entries=True):
+                segs = top[len(rdir):].split('/')
+                ltop = os.path.join(ldir, *segs)
+                os.makedirs(ltop, exist_ok=True)
+                items.extend((f.path, os.path.join(ltop, f.name), f.attr)
+                             for f in files)
+            size = sum(attr.st_size for _, _, attr in items)
+            with self._monitor('get', rdir, len(items), size, callback) as monitor:
+                transfer = TreeTransfer(self._sftpclient, concurrency, resume=resume,
+                                        monitor=monitor, limiter=self._limiter())
+                stats = transfer.get(items)
+        stats.elapsed = time.monotonic() - start
+        self._logger.info(f'Got dir {ldir}: {stats}')
+        return stats
+
+    def putdir(
+        self,
+        ldir: str,
+        rdir: str,
+        concurrency: int = 8,
+        mode: str = 'sftp',
+        compress: str = None,
+        resume: bool = False,
+        callback: Callable[[TransferProgress], None] = None
+    ) -> TransferStats:
         """
         Put `ldir` into the `rdir` of SFTP server.
 
+        Directories are created level by level with pipelined requests and
+        files are transferred by a pool of workers, see `TreeTransfer`, or
+        the tree is sent as a tar stream through an exec channel if `mode`
+        is 'tar', see `TarTransfer` (falls back to 'sftp' if the server has
+        no `tar`).
+
         :param ldir: local dir.
         :param rdir: remote dir.
+        :param concurrency: number of files transferred at the same time.
+        :param mode: 'sftp' or 'tar'.
+        :param compress: compression of 'tar' mode, None, 'gz', 'bz2' or 'xz'.
+        :param resume: continue an interrupted transfer in 'sftp' mode, the
+            files already transferred are skipped.
+        :param callback: called with the `TransferProgress` while
+            transferring and at the end.
+        :return: statistics of the transfer.
 
         >>> putdir('/tmp/mydir', '/home')  # /home/mydir
         >>> putdir('D:\\mydir', '/home')  # /home/mydir
         """
+        start = time.monotonic()
         ldir = os.path.normpath(ldir)
-        rdir = self.join(rdir, '')
-        self._logger.info(f'Putting dir {ldir} => {rdir}')
-        for top, dirs, files in os.walk(os.path.normpath(ldir)):
-            basename = os.path.basename(top)
-            rdir = self.join(rdir, basename)
+        rdir = self.normpath(rdir) or '/'
+        root = self.join(rdir, os.path.basename(ldir))
+        if self._tarmode(mode, compress):
+            self._logger.info(f'Putting dir {ldir} => {rdir} (tar)')
+            files = [os.path.join(top, f) for top, _, fs in os.walk(ldir) for f in fs]
+            files = [f for f in files if os.path.isfile(f) and not os.path.islink(f)]
+            size = sum(os.path.getsize(f) for f in files)
+            try:
+                with self._monitor('put', root, len(files), size, callback) as monitor:
+                    transfer = TarTransfer(self.transport, compress, self._limiter(), monitor)
+                    stats = transfer.put(ldir, rdir)
+            finally:
+                if self._cache is not None:
+                    self._cache.invalidate(root, recursive=True)
+        else:
+            self._logger.info(f'Putting dir {ldir} => {rdir}')
             if not self.exists(rdir):
                 self.makedirs(rdir)
-            for f in files:
-                l = os.path.join(top, f)
-                r = self.join(rdir, f)
-                self._sftpclient.put(l, r)
-            for d in dirs:
-                r = self.join(rdir, d)
-                if not self.exists(r):
-                    self.makedirs(r)
+            rdirs, pairs = [root], []
+            for top, dirs, files in os.walk(ldir):
+                rel = os.path.relpath(top, ldir)
+                rtop = root if rel == '.' else self.join(root, *rel.split(os.sep))
+                rdirs.extend(self.join(rtop, d) for d in dirs)
+                pairs.extend((os.path.join(top, f), self.join(rtop, f)) for f in files)
+            size = sum(os.path.getsize(l) for l, _ in pairs)
+            monitor = self._monitor('put', root, len(pairs), size, callback)
+            transfer = TreeTransfer(self._sftpclient, concurrency, resume=resume,
+                                    monitor=monitor, limiter=self._limiter())
+            if self._cache is not None:
+                transfer.mkdirs([d for d in rdirs if not self._cache.isdir(d)])
+            else:
+                transfer.mkdirs(rdirs)
+            try:
+                with monitor:
+                    stats = transfer.put(pairs)
+            finally:
+                if self._cache is not None:
+                    self._cache.invalidate(root, recursive=True)
+                    for d in rdirs:
+                        self._cache.putdir(d)
+        stats.elapsed = time.monotonic() - start
+        self._logger.info(f'Put dir {root}: {stats}')
+        return stats
+
+    def sync(
+        self,
+        ldir: str,
+        rdir: str,
+        delete: bool = False,
+        dryrun: bool = False,
+        checksum: bool = False,
+        concurrency: int = 8
+    ) -> SyncReport:
+        """
+        Synchronize `ldir` into the `rdir` of SFTP server, only new or
+        changed files (or blocks of large files) are sent, see `DirSync`.
+
+        :param ldir: local dir.
+        :param rdir: remote dir.
+        :param delete: delete remote files and dirs which are not in `ldir`.
+        :param dryrun: only report what would be done.
+        :param checksum: compare files of same size by checksums instead of mtime.
+        :param concurrency: number of files transferred at the same time.
+        :return: report of the synchronization.
+
+        >>> sync('/tmp/mydir', '/home', delete=True)  # /home/mydir
+        SyncReport(dryrun=False, dirs=0, created=1, updated=2, patched=1, deleted=1, unchanged=1024, sent=1343488, elapsed=0.912)
+        """
+        ldir = os.path.normpath(ldir)
+        rdir = self.normpath(rdir) or '/'
+        root = self.join(rdir, os.path.basename(ldir))
+        self._logger.info(f'Syncing dir {ldir} => {root}')
+        if not dryrun and not self.exists(rdir):
+            self.makedirs(rdir)
+        try:
+            sync = DirSync(self._sftpclient, concurrency, checksum,
+                           limiter=self._limiter())
+            report = sync.run(ldir, root, delete, dryrun)
+        finally:
+            if self._cache is not None and not dryrun:
+                self._cache.invalidate(root, recursive=True)
+        self._logger.info(f'Synced dir {root}: {report}')
+        return report
 
     def join(self, *paths: str) -> str:
         """
@@ -161,33 +439,73 @@ class SFTPConnection(object):
         """
         return path.rsplit('/', 1)[-1]
 
-    def exists(self, path: str) -> str:
+    def exists(self, path: str) -> bool:
         """
         Similar to os.path.exists().
         """
+        if self._cache is not None and self._cache.get(path) is not None:
+            return True
         try:
-            self._sftpclient.stat(path)
+            self.stat(path)
             return True
         except FileNotFoundError:
             return False
 
-    def walk(self, path: str):
+    def stat(self, path: str) -> SFTPAttributes:
         """
-        Similar to os.walk().
+        Similar to os.stat(), the result is cached if the cache is enabled.
         """
-        dirs, files =  [], []
-        for a in self._sftpclient.listdir_attr(path):
-            if stat.S_ISDIR(a.st_mode):
-                dirs.append(a.filename)
-            else:
-                files.append(a.filename)
-        yield path, dirs, files
+        if self._cache is not None:
+            attr = self._cache.get(path)
+            if attr is not None and attr is not StatCache.DIR:
+                return attr
+        attr = self._sftpclient.stat(path)
+        if self._cache is not None:
+            self._cache.put(path, attr)
+        return attr
+
+    def scandir(self, path: str) -> list:
+        """
+        Similar to os.scandir(), the entries keep the attributes of the listing.
+
+        :return: list of `SFTPEntry`.
+
+        >>> [(e.name, e.attr.st_size) for e in scandir('/tmp') if e.is_file()]
+        [('myfile', 1024)]
+        """
+        return Walker(self._sftpclient).scandir(path)
+
+    def walk(
+        self,
+        path: str,
+        entries: bool = False,
+        concurrency: int = 8
+    ) -> Generator[Tuple[str, list, list], None, None]:
+        """
+        Similar to os.walk(), several dirs are listed at the same time,
+        see `Walker`.
 
-        for d in dirs:
-            for w in self.walk(self.join(path, d)):
-                yield w
+        :param path: top dir.
+        :param entries: yield `SFTPEntry` instead of names in dirs and files.
+        :param concurrency: maximum number of dirs listed at the same time.
 
-    def makedirs(self, path: str) -> str:
+        >>> for top, dirs, files in walk('/tmp', entries=True):
+        ...     print(top, [(f.name, f.attr.st_size) for f in files])
+        """
+        for top, dirs, files in Walker(self._sftpclient, concurrency).walk(path):
+            if self._cache is not None:
+                self._cache.putdir(top)
+                for e in dirs + files:
+                    if not e.is_symlink():
+                        self._cache.put(e.path, e.attr)
+            if entries:
+                yield top, dirs, files
+            else:
+                names = [d.name for d in dirs]
+                yield top, names, [f.name for f in files]
+                dirs[:] = [d for d in dirs if d.name in names]
+
+    def makedirs(self, path: str) -> None:
         """
         Similar to os.makedirs().
         """
@@ -195,8 +513,29 @@ class SFTPConnection(object):
         curpath = '/'
         for p in path.split('/'):
             curpath = self.join(curpath, p)
+            if self._cache is not None and self._cache.isdir(curpath):
+                continue
             if not self.exists(curpath):
-                self._sftpclient.mkdir(curpath)
+                self.mkdir(curpath)
+
+    def mkdir(self, path: str, mode: int = 0o777) -> None:
+        """
+        Similar to os.mkdir().
+        """
+        self._sftpclient.mkdir(path, mode)
+        self._touch(path)
+        if self._cache is not None:
+            self._cache.putdir(path)
+
+    def remove(self, path: str) -> None:
+        """
+        Similar to os.remove().
+        """
+        self._logger.info('Remove %s' % path)
+        try:
+            self._sftpclient.remove(path)
+        finally:
+            self._touch(path)
 
     @contextmanager
     def open(self, filepath: str, mode: str = 'r') -> Generator[SFTPFile, str, None]:
@@ -209,3 +548,89 @@ class SFTPConnection(object):
             yield f
         finally:
             f.close()
+            if set(mode) & set('wax+'):
+                self._touch(filepath)
+
+    def openreader(
+        self,
+        filepath: str,
+        blocksize: int = RemoteReader.BLOCKSIZE,
+        cachesize: int = 256,
+        readahead: int = 16,
+        buffered: bool = True
+    ) -> Union[io.BufferedReader, RemoteReader]:
+        """
+        Open a remote file for random-access reading with read-ahead and
+        a block cache, see `RemoteReader`.
+
+        :param filepath: remote file.
+        :param blocksize: size of the blocks (bytes).
+        :param cachesize: maximum number of cached blocks.
+        :param readahead: maximum number of blocks prefetched.
+        :param buffered: wrap the reader in a `io.BufferedReader`.
+
+        >>> with openreader('/var/log/messages.1.gz') as f:     # doctest: +SKIP
+        ...     lines = gzip.open(f).readlines()               # doctest: +SKIP
+        >>> with tarfile.open(fileobj=openreader('/tmp/a.tar')) as tar:   # doctest: +SKIP
+        ...     tar.getnames()                                           # doctest: +SKIP
+        """
+        self._logger.info(f'Open reader of {filepath}')
+        f = self._sftpclient.open(filepath, 'rb')
+        try:
+            raw = RemoteReader(f, None, blocksize, cachesize, readahead)
+        except Exception:
+            f.close()
+            raise
+        return io.BufferedReader(raw, blocksize) if buffered else raw
+
+    def _monitor(
+        self,
+        op: str,
+        path: str,
+        files: int,
+        size: int,
+        callback: Callable[[TransferProgress], None] = None
+    ) -> TransferMonitor:
+        """
+        Monitor of a transfer, dispatched to the observers of the
+        connection and `callback`.
+        """
+        observers = list(self._observers)
+        if callback:
+            observers.append(CallbackObserver(callback))
+        return TransferMonitor(op, path, observers, files, size)
+
+    def _limiter(self) -> Limiter:
+        """
+        Bandwidth limit of a transfer, see `throttle.Scheduler`.
+        """
+        return Limiter(self.transport.getpeername()[0], self._bucket)
+
+    def _tarmode(self, mode: str, compress: Optional[str]) -> bool:
+        """
+        Whether to transfer a dir in 'tar' mode, checks (once per
+        compressor) that the server supports it.
+        """
+        if mode not in ('sftp', 'tar'):
+            raise ValueError(f"Unsupported mode: {mode}, must be 'sftp' or 'tar'")
+        if mode == 'sftp':
+            return False
+        transfer = TarTransfer(self.transport, compress)
+        if compress not in self._hastar:
+            self._hastar[compress] = transfer.available()
+            if not self._hastar[compress]:
+                self._logger.warning(f'tar (compress={compress}) is unavailable '
+                                     'on server, fall back to sftp mode')
+        return self._hastar[compress]
+
+    def _touch(self, path: str) -> None:
+        """
+        Drop the cached entry of `path` which was changed, the parent dir
+        is kept as known dir only since its mtime changed.
+        """
+        if self._cache is None:
+            return
+        self._cache.invalidate(path)
+        parent = path.rstrip('/').rsplit('/', 1)[0] or '/'
+        if self._cache.get(parent) is not None:
+            self._cache.put(parent, StatCache.DIR)
@@ -5,31 +5,47 @@ SSH module.
 """
 
 import textwrap
-import threading
+import contextvars
+import codecs
 import socket
+import shlex
+import threading
+import uuid
 
-from typing import Generator, Optional, Union
-from datetime import datetime
-from select import select
+from typing import Generator, List, Optional, Sequence, Tuple, Union
+from collections import deque
 from contextlib import contextmanager
 
-from paramiko import SSHClient, AutoAddPolicy
+from paramiko import SSHClient, AutoAddPolicy, Channel, Transport
 from paramiko.ssh_exception import (AuthenticationException, 
                                     NoValidConnectionsError, 
                                     SSHException)
 
 from xbot.framework.logger import getlogger, ExtraAdapter
 from xbot.plugins.ssh.errors import SSHConnectError, SSHCommandError
-from xbot.plugins.ssh.utils import (remove_ansi_escape_chars, 
-                                    remove_unprintable_chars)
+from xbot.plugins.ssh.throttle import scheduler
+from xbot.plugins.ssh.channel import (ChannelReader, OutputBuffer, 
+                                      open_command)
+from xbot.plugins.ssh.utils import sanitize
+from xbot.plugins.ssh.parsers import Table, parse
 
 
 logger = getlogger(__name__)
 
+# Working directory and environment variables of `SSHConnection.cd` and
+# `SSHConnection.env` in the current thread (or asyncio task), keyed by
+# connection. ContextVars are never freed, so there is one per module
+# instead of one per connection.
+_cwds = contextvars.ContextVar('cwds', default={})
+_envs = contextvars.ContextVar('envs', default={})
+
 
 class SSHCommandResult(str):
     """
     Result of SSH command.
+
+    Lines, split fields and lookups are computed on first use and cached,
+    so repeated queries on a large output do not split it again.
     """
     def __new__(cls, out: str, rc: int = 0, cmd: str = '') -> str:
         """
@@ -37,12 +53,13 @@ class SSHCommandResult(str):
         :param rc: return code.
         :param cmd: command.
         """
-        out = remove_ansi_escape_chars(out)
-        out = remove_unprintable_chars(out)
-        out = '\n'.join(out.splitlines())
-        o = str.__new__(cls, out.strip())
+        o = str.__new__(cls, sanitize(out))
         o.__rc = rc
         o.__cmd = cmd
+        o.__lines = None
+        o.__fields = {}
+        o.__matches = {}
+        o.__indexes = {}
         return o
     
     @property
@@ -59,17 +76,60 @@ class SSHCommandResult(str):
         """
         return self.__cmd
 
+    @property
+    def lines(self) -> Tuple[str, ...]:
+        """
+        Lines of the output.
+        """
+        if self.__lines is None:
+            self.__lines = tuple(self.splitlines())
+        return self.__lines
+
+    @property
+    def header(self) -> list:
+        """
+        Column names, i.e. fields of the first line.
+
+        >>> SSHCommandResult('PID TTY CMD\\n1 ? init').header
+        ['PID', 'TTY', 'CMD']
+        """
+        fields = self.fields()
+        return [f.strip() for f in fields[0]] if fields else []
+
+    def fields(self, sep: str = None) -> list:
+        """
+        Fields of each line (do not modify the returned list).
+
+        :param sep: char to split lines.
+        """
+        fields = self.__fields.get(sep)
+        if fields is None:
+            fields = self.__fields[sep] = [line.split(sep) for line in self.lines]
+        return fields
+
+    def getline(self, key: Union[str, int]) -> Optional[str]:
+        """
+        Get the last line which contains `key`, or the line numbered
+        `key` if it is an int.
+
+        :param key: string to filter a line, or line number (`IndexError`
+            if out of range).
+        """
+        lineno = self._lineno(key)
+        return None if lineno is None else self.lines[lineno]
+
     def getfield(
         self,
-        key: str,
-        col: int,
+        key: Union[str, int],
+        col: Union[int, str],
         sep: str = None
     ) -> Optional[str]:
         """
         Get a specified field from the output.
 
-        :param key: string to filter a line.
-        :param col: column number in the filtered line.
+        :param key: string to filter a line, or line number (`IndexError`
+            if out of range).
+        :param col: column number or name (see `header`) in the filtered line.
         :param sep: char to split the filtered line.
 
         >>> r = SSHCommandResult('''\\
@@ -82,28 +142,22 @@ class SSHCommandResult(str):
         '45'
         >>> r.getfield('checkpointer', 1, sep=':')
         'postgres   51    postgres'
+        >>> r.getfield('writer', 'PID')
+        '53'
         """
-        matchline = ''
-        lines = self.splitlines()
-        if isinstance(key, str):
-            for line in self.splitlines():
-                if key in line:
-                    matchline = line
-        elif isinstance(key, int):
-            matchline = lines[key-1]
-        if matchline:
-            fields = matchline.split(sep)
-            return fields[col-1].strip()
+        lineno = self._lineno(key)
+        if lineno is not None and self.lines[lineno]:
+            return self.fields(sep)[lineno][self._colno(col, sep)-1].strip()
 
     def getcol(
         self,
-        col: int,
+        col: Union[int, str],
         sep: str = None
     ) -> list:
         """
         Get a specified column from the output.
 
-        :param col: column number.
+        :param col: column number or name (see `header`).
         :param sep: char to split lines.
 
         >>> r = SSHCommandResult('''\\
@@ -114,13 +168,334 @@ class SSHCommandResult(str):
         ... postgres   53    postgres: wal writer process''', 0, '')
         >>> r.getcol(2)
         ['PID', '45', '51', '52', '53']
+        >>> r.getcol('PID')
+        ['PID', '45', '51', '52', '53']
         """
-        fields = []
-        for line in self.splitlines():
-            segs = line.split(sep)
-            if col <= len(segs):
-                fields.append(segs[col-1])
-        return fields
+        col = self._colno(col, sep)
+        return [segs[col-1] for segs in self.fields(sep) if col <= len(segs)]
+
+    def getcols(
+        self,
+        *cols: Union[int, str],
+        sep: str = None
+    ) -> list:
+        """
+        Get specified columns from the output, lines which lack one of
+        the columns are skipped.
+
+        :param cols: column numbers or names (see `header`).
+        :param sep: char to split lines.
+        :return: a tuple of fields per line.
+
+        >>> r = SSHCommandResult('PID TTY CMD\\n1 ? init\\n2 ? kthreadd')
+        >>> r.getcols('PID', 3)
+        [('PID', 'CMD'), ('1', 'init'), ('2', 'kthreadd')]
+        """
+        cols = [self._colno(c, sep) for c in cols]
+        maxcol = max(cols, default=0)
+        return [tuple(segs[c-1] for c in cols)
+                for segs in self.fields(sep) if maxcol <= len(segs)]
+
+    def getrow(
+        self,
+        value: str,
+        col: Union[int, str] = 1,
+        sep: str = None
+    ) -> Optional[list]:
+        """
+        Get the fields of the last line whose column `col` equals `value`,
+        columns are indexed once per (`col`, `sep`), so each lookup is O(1).
+
+        :param value: value of the column.
+        :param col: column number or name (see `header`).
+        :param sep: char to split lines.
+
+        >>> r = SSHCommandResult('PID TTY CMD\\n1 ? init\\n2 ? kthreadd')
+        >>> r.getrow('2')
+        ['2', '?', 'kthreadd']
+        >>> r.getrow('init', 'CMD')[0]
+        '1'
+        """
+        col = self._colno(col, sep)
+        index = self.__indexes.get((col, sep))
+        if index is None:
+            index = self.__indexes[(col, sep)] = {
+                segs[col-1].strip(): segs for segs in self.fields(sep) if col <= len(segs)
+            }
+        return index.get(value)
+
+    def parse(self, parser: str) -> Table:
+        """
+        Parse the output into a columnar table.
+
+        :param parser: name of the parser, see `parsers.PARSERS`.
+
+        >>> r = sshconn.exec('df -P')                               # doctest: +SKIP
+        >>> r.parse('df').filter(usep=lambda v: v > 90)['mount']    # doctest: +SKIP
+        ['/data']
+        """
+        return parse(parser, self.lines)
+
+    def _lineno(self, key: Union[str, int]) -> Optional[int]:
+        """
+        Index of the line filtered by `key` (see `getline`).
+        """
+        if isinstance(key, int):
+            return key - 1
+        if key not in self.__matches:
+            lineno = None
+            for i in range(len(self.lines) - 1, -1, -1):
+                if key in self.lines[i]:
+                    lineno = i
+                    break
+            self.__matches[key] = lineno
+        return self.__matches[key]
+
+    def _colno(self, col: Union[int, str], sep: str = None) -> int:
+        """
+        Column number of `col`, a number or a name in the header.
+        """
+        if isinstance(col, int):
+            return col
+        fields = self.fields(sep)
+        header = [f.strip() for f in fields[0]] if fields else []
+        if col not in header:
+            raise ValueError(f'No column named {col!r} in {header}')
+        return header.index(col) + 1
+
+
+class SSHCommandStream(object):
+    """
+    Output stream of SSH command.
+
+    Output is read from the channel only when the next item is requested,
+    so a slow consumer makes the server stop sending once the channel
+    window is full instead of buffering in memory.
+    """
+    def __init__(
+        self,
+        channel: Channel,
+        cmd: str,
+        timeout: Optional[int] = None,
+        encoding: str = 'utf-8',
+        lines: bool = True
+    ):
+        """
+        :param channel: channel of the started command.
+        :param cmd: command.
+        :param timeout: command timeout (seconds), None means no timeout.
+        :param encoding: encoding of the output.
+        :param lines: yield lines if True, otherwise yield chunks as they arrive.
+        """
+        self._channel = channel
+        self._reader = ChannelReader(channel, timeout)
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+        self._timeout = timeout
+        self._lines = lines
+        self._pending = deque()
+        self._partial = ''
+        self._finished = False
+        self.__rc = None
+        self.__cmd = cmd
+
+    @property
+    def rc(self) -> Optional[int]:
+        """
+        Return code, None before the stream ends.
+        """
+        return self.__rc
+
+    @property
+    def cmd(self) -> str:
+        """
+        Command.
+        """
+        return self.__cmd
+
+    def __iter__(self) -> 'SSHCommandStream':
+        return self
+
+    def __next__(self) -> str:
+        while not self._pending:
+            if self._finished:
+                raise StopIteration
+            self._fill()
+        return self._pending.popleft()
+
+    def __enter__(self) -> 'SSHCommandStream':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the channel (the command is terminated if still running).
+        """
+        self._finished = True
+        self._channel.close()
+
+    def _fill(self) -> None:
+        """
+        Read next chunk of output into pending items.
+        """
+        try:
+            data = self._reader.read()
+            text = self._decoder.decode(data, not data)
+            if not data:
+                self.__rc = self._reader.exit_status()
+        except TimeoutError:
+            self.close()
+            raise TimeoutError(
+                f"Command '{self.cmd}' timedout({self._timeout}s)") from None
+        if not data:
+            self._finished = True
+            self._channel.close()
+        if not self._lines:
+            if text:
+                self._pending.append(text)
+            return
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        self._pending.extend(l.rstrip('\r') for l in lines)
+        if self._finished and self._partial:
+            self._pending.append(self._partial.rstrip('\r'))
+            self._partial = ''
+
+
+class ShellSession(object):
+    """
+    Long-lived shell on one channel of an SSH connection.
+
+    Commands are written to the stdin of the shell, so `cd`, `export`,
+    variables and functions persist between them, and a command costs one
+    round-trip without opening a channel or starting a shell. The output of
+    each command is followed by a unique sentinel which carries its return
+    code, stderr is merged into stdout.
+
+    Commands read stdin from /dev/null, so interactive commands (prompts,
+    sudo password) are not supported, use `SSHConnection.exec` for them.
+
+    >>> with sshconn.shell() as sh:         # doctest: +SKIP
+    ...     sh.exec('cd /tmp')              # doctest: +SKIP
+    ...     sh.exec('pwd')                  # doctest: +SKIP
+    '/tmp'
+    """
+    def __init__(
+        self,
+        conn: 'SSHConnection',
+        envs: dict,
+        cwd: str = '',
+        timeout: Optional[int] = None
+    ):
+        """
+        :param conn: the SSH connection.
+        :param envs: shell environment variables.
+        :param cwd: initial working directory.
+        :param timeout: timeout (seconds) for opening the channel.
+        """
+        self._conn = conn
+        self._encoding = envs['LANG'].split('.')[-1]
+        self._channel = open_command(conn.transport, None, envs, pty=False,
+                                     timeout=timeout)
+        self._token = uuid.uuid4().hex
+        self._count = 0
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        # Sent with the first command, no round-trip is spent on them.
+        init = 'exec 2>&1\n'
+        if cwd:
+            init += f'cd {cwd}\n'
+        self._channel.sendall(init.encode(self._encoding))
+
+    @property
+    def closed(self) -> bool:
+        """
+        Whether the shell is closed or exited.
+        """
+        return self._channel.closed or self._channel.exit_status_ready()
+
+    def __enter__(self) -> 'ShellSession':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the channel (the shell is terminated).
+        """
+        self._channel.close()
+
+    def exec(
+        self,
+        cmd: str,
+        expect: Union[int, str, None] = 0,
+        timeout: int = 15
+    ) -> SSHCommandResult:
+        """
+        Execute a command in the shell.
+
+        :param cmd: the command to be executed.
+        :param expect: same as `SSHConnection.exec`.
+        :param timeout: command timeout (seconds), the shell is closed
+            when it is reached.
+        :return: output(stdout and stderr) of command.
+
+        :raises:
+            `.SSHCommandError` -- if the result is not as expected or the
+                shell is closed.
+            `TimeoutError` -- if the command execution is timedout.
+        """
+        with self._lock:
+            if self.closed:
+                raise SSHCommandError(f"Shell closed, can not execute '{cmd}'")
+            self._count += 1
+            sentinel = f'{self._token}_{self._count}'
+            marker = f'__xbot_{sentinel}:'.encode()
+            # `command` keeps the shell alive on syntax errors of `cmd`, the
+            # marker is split in the input so it is only found in the output.
+            line = (f'command eval {shlex.quote(cmd)} </dev/null; '
+                    f"printf '%s%s:%d\\n' __xbot_ {sentinel} \"$?\"\n")
+            extra = {'hook': {}}
+            self._conn._logger.info(f"Shell command: '{cmd}', Expect: '{expect}'", extra=extra)
+            reader = ChannelReader(self._channel, timeout)
+            buf, start = self._buffer, 0
+            with scheduler.control(self._conn.transport.getpeername()[0]):
+                self._channel.sendall(line.encode(self._encoding))
+                try:
+                    while True:
+                        i = buf.find(marker, start)
+                        if i >= 0:
+                            j = buf.find(b'\n', i)
+                            if j >= 0:
+                                break
+                            start = i
+                        else:
+                            start = max(len(buf) - len(marker) + 1, 0)
+                        data = reader.read()
+                        if not data:
+                            break
+                        buf += data
+                    if i >= 0 and j >= 0:
+                        output = buf[:i].decode(self._encoding, errors='ignore')
+                        rc = int(buf[i + len(marker):j])
+                        self._buffer = buf[j + 1:]
+                    else:
+                        # The shell exited (e.g. `exit 3`).
+                        output = buf.decode(self._encoding, errors='ignore')
+                        rc = reader.exit_status()
+                        self._buffer = bytearray()
+                        self.close()
+                except TimeoutError:
+                    self.close()
+                    result = SSHCommandResult(buf.decode(self._encoding, errors='ignore'), rc=-1)
+                    extra['hook']['more'] = result
+                    raise TimeoutError(f"Command '{cmd}' timedout({timeout}s):\n{result}") from None
+        result = SSHCommandResult(output, rc=rc, cmd=cmd)
+        extra['hook']['more'] = result
+        self._conn._checkresult(result, expect, output)
+        return result
 
 
 class SSHConnection(object):
@@ -141,8 +516,7 @@ class SSHConnection(object):
                      'LANGUAGE': 'en_US.UTF-8'}.items():
             self._shenvs[k] = self._shenvs.get(k, v)
         self._password = None
-        self._cdlock = threading.Lock()
-        self._cwd = ''
+        self._transport = None
 
     def connect(
         self,
@@ -161,14 +535,18 @@ class SSHConnection(object):
         :param port: SSH port.
         :param timeout: connect timeout(s).
         """
-        transport = self._sshclient.get_transport()
-        if transport and transport.active:
+        if self.active:
             return
+        self._transport = None
         self._logger.extra['prefix'] = f'ssh://{user}@{host}:{port}'
         self._logger.info('Connecting...')
         try:
             self._sshclient.connect(host, port=port, username=user, 
                                     password=password, timeout=timeout)
+            # Commands are made of small request packets, do not let Nagle
+            # delay them.
+            sock = self._sshclient.get_transport().sock
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self._password = password
         except AuthenticationException:
             raise SSHConnectError(
@@ -194,11 +572,49 @@ class SSHConnection(object):
                 ) from None
             raise e from None
 
+    def attach(self, transport: Transport, password: str = None) -> None:
+        """
+        Open the connection on the transport of another connection,
+        e.g. `SFTPConnection.transport`, to save a TCP connect and a handshake.
+
+        :param transport: an authenticated transport.
+        :param password: user password, only needed by `sudo`.
+
+        >>> sftp.connect('192.168.8.8', 'xbot', 'xbot')      # doctest: +SKIP
+        >>> ssh.attach(sftp.transport, 'xbot')              # doctest: +SKIP
+        """
+        if self.active:
+            return
+        host, port = transport.getpeername()[:2]
+        user = transport.get_username()
+        self._logger.extra['prefix'] = f'ssh://{user}@{host}:{port}'
+        self._logger.info('Attaching...')
+        self._transport = transport
+        self._password = password
+
     def disconnect(self) -> None:
         """
-        Close the connection.
+        Close the connection, the transport is kept if it is attached.
+        """
+        if self._transport:
+            self._transport = None
+        else:
+            self._sshclient.close()
+
+    @property
+    def transport(self) -> Optional[Transport]:
+        """
+        Transport of the connection, None if never connected.
         """
-        self._sshclient.close()
+        return self._transport or self._sshclient.get_transport()
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether the connection is open.
+        """
+        transport = self.transport
+        return bool(transport and transport.active)
 
     def exec(
         self,
@@ -206,11 +622,15 @@ class SSHConnection(object):
         expect: Union[int, str, None] = 0,
         timeout: int = 15,
         prompts: dict = {},
-        shenvs: dict = {}
+        shenvs: dict = {},
+        cwd: str = None
     ) -> SSHCommandResult:
         """
         Execute a command on the SSH server.
 
+        Commands may be executed concurrently from several threads, each
+        one runs on its own channel of the shared transport.
+
         :param cmd: the command to be executed.
         :param expect: expected result of command execution.
             0: expect the return code of command is 0.
@@ -219,6 +639,7 @@ class SSHConnection(object):
         :param timeout: command timeout (seconds).
         :param prompts: prompts and answers for interactive command.
         :param shenvs: shell environment variables for command.
+        :param cwd: working directory for command, defaults to the one set by `cd`.
         :return: output(stdout and stderr) of command.
 
         :raises: 
@@ -233,53 +654,233 @@ class SSHConnection(object):
         >>> exec('echo hello', expect='world')  # SSHCommandError   # doctest: +SKIP
         >>> exec('sudo whoami', prompts={'password:': 'mypwd'})     # doctest: +SKIP
         """
-        if self._cwd:
-            cmd = f'cd {self._cwd} && {cmd}'
+        cmd, envs = self._prepare(cmd, shenvs, cwd)
         extra = {'hook': {}}
         self._logger.info(f"Command: '{cmd}', Expect: '{expect}'", extra=extra)
-        envs = self._shenvs.copy()
-        envs.update(shenvs)
-        stdin, stdout, _ = self._sshclient.exec_command(cmd, get_pty=True, environment=envs)
-        start = datetime.now()
-        output = ''
+        transport = self.transport
+        with scheduler.control(transport.getpeername()[0]):
+            channel = open_command(transport, cmd, envs, timeout=timeout)
+            reader = ChannelReader(channel, timeout)
+            encoding = envs['LANG'].split('.')[-1]
+            output = OutputBuffer(encoding)
+            prompts = dict(prompts)
+            try:
+                while True:
+                    data = reader.read()
+                    output.write(data, final=not data)
+                    if not data:
+                        break
+                    if prompts:
+                        lastline = output.lastline
+                        written = None
+                        for k, v in prompts.items():
+                            if k in lastline:
+                                channel.sendall((v + '\n').encode(encoding))
+                                written = k
+                                break
+                        if written:
+                            prompts.pop(written)
+                rc = reader.exit_status()
+            except TimeoutError:
+                channel.close()
+                result = SSHCommandResult(output.getvalue(), rc=-1)
+                extra['hook']['more'] = result
+                raise TimeoutError(f"Command '{cmd}' timedout({timeout}s):\n{result}") from None
+        output = output.getvalue()
+        result = SSHCommandResult(output, rc=rc, cmd=cmd)
+        extra['hook']['more'] = result
+        self._checkresult(result, expect, output)
+        return result
+
+    def batch(
+        self,
+        cmds: Sequence[str],
+        expect: Union[int, str, None, list] = 0,
+        timeout: int = 15,
+        shenvs: dict = {},
+        cwd: str = None
+    ) -> List[SSHCommandResult]:
+        """
+        Execute independent commands in one remote script, so they cost
+        one channel and one round-trip instead of one each.
+
+        Each command runs in a subshell with stdin from /dev/null, its
+        output (stdout and stderr) and return code are framed by a unique
+        sentinel and split back into a result per command.
+
+        :param cmds: the commands to be executed.
+        :param expect: same as `exec` for all commands, or a list of them,
+            one per command.
+        :param timeout: timeout (seconds) of the whole batch.
+        :param shenvs: shell environment variables for commands.
+        :param cwd: working directory for commands, defaults to the one set by `cd`.
+        :return: results of the commands, in order.
+
+        :raises:
+            `.SSHCommandError` -- if a result is not as expected.
+            `TimeoutError` -- if the batch execution is timedout.
+
+        >>> r = batch(['cat /proc/loadavg', 'stat -c %s /etc/hosts'])   # doctest: +SKIP
+        >>> r[1]                                                        # doctest: +SKIP
+        '158'
+        """
+        expects = expect if isinstance(expect, list) else [expect] * len(cmds)
+        if len(expects) != len(cmds):
+            raise ValueError(f'{len(expects)} expects for {len(cmds)} commands')
+        if not cmds:
+            return []
+        _, envs = self._prepare('', shenvs, '')
+        token = uuid.uuid4().hex
+        prepared, script = [], []
+        for i, cmd in enumerate(cmds):
+            cmd, _ = self._prepare(cmd, shenvs, cwd)
+            prepared.append(cmd)
+            script.append(f'(eval {shlex.quote(cmd)}) </dev/null 2>&1; '
+                          f"printf '%s%s:%d\\n' __xbot_ {token}_{i} \"$?\"")
+        hooks = []
+        for cmd, e in zip(prepared, expects):
+            hooks.append({'hook': {}})
+            self._logger.info(f"Batch command: '{cmd}', Expect: '{e}'", extra=hooks[-1])
+        transport = self.transport
         encoding = envs['LANG'].split('.')[-1]
-        while (datetime.now() - start).seconds <= timeout:
-            rlist, _, _ = select([stdout.channel], [], [], 0.1)
-            if stdout.channel in rlist:
-                data = stdout.channel.recv(1024).decode(encoding=encoding, errors='ignore')
-                output += data
-                if data == '':
-                    break
-            if prompts and output:
-                lastline = output.splitlines()[-1]
-                written = None
-                for k, v in prompts.items():
-                    if k in lastline:
-                        stdin.write(v + '\n')
-                        stdin.flush()
-                        written = k
+        output = OutputBuffer(encoding)
+        with scheduler.control(transport.getpeername()[0]):
+            channel = open_command(transport, '\n'.join(script), envs, pty=False,
+                                   timeout=timeout)
+            reader = ChannelReader(channel, timeout)
+            try:
+                while True:
+                    data = reader.read()
+                    output.write(data, final=not data)
+                    if not data:
                         break
-                if written:
-                    prompts.pop(written)
-        else:
-            result = SSHCommandResult(output, rc=-1)
+            except TimeoutError:
+                done = len(self._splitbatch(output.getvalue(), token, prepared))
+                running = f"'{prepared[done]}'" if done < len(prepared) else '(waiting for EOF)'
+                raise TimeoutError(
+                    f'Batch timedout({timeout}s) after {done}/{len(cmds)} commands, '
+                    f'running: {running}'
+                ) from None
+            finally:
+                channel.close()
+        results = self._splitbatch(output.getvalue(), token, prepared)
+        if len(results) < len(cmds):
+            raise SSHCommandError(
+                f'Batch stopped after {len(results)}/{len(cmds)} commands, '
+                f"failed: '{prepared[len(results)]}'"
+            )
+        for (result, out), e, extra in zip(results, expects, hooks):
             extra['hook']['more'] = result
-            raise TimeoutError(f"Command '{cmd}' timedout({timeout}s):\n{result}")
-        result = SSHCommandResult(output, rc=stdout.channel.recv_exit_status(), cmd=cmd)
-        extra['hook']['more'] = result
+            self._checkresult(result, e, out)
+        return [result for result, _ in results]
+
+    @staticmethod
+    def _splitbatch(
+        output: str,
+        token: str,
+        cmds: List[str]
+    ) -> List[Tuple[SSHCommandResult, str]]:
+        """
+        Split the output of `batch` at its sentinels.
+
+        :return: (result, raw output) of the finished commands.
+
+        >>> SSHConnection._splitbatch('a\\n__xbot_t_0:0\\nb__xbot_t_1:3\\nc', 't', ['x', 'y', 'z'])
+        [('a', 'a\\n'), ('b', 'b')]
+        """
+        results, start = [], 0
+        for i, cmd in enumerate(cmds):
+            marker = f'__xbot_{token}_{i}:'
+            pos = output.find(marker, start)
+            end = output.find('\n', pos)
+            if pos < 0 or end < 0:
+                break
+            out = output[start:pos]
+            rc = int(output[pos + len(marker):end])
+            results.append((SSHCommandResult(out, rc=rc, cmd=cmd), out))
+            start = end + 1
+        return results
+
+    def _checkresult(
+        self,
+        result: SSHCommandResult,
+        expect: Union[int, str, None],
+        output: str
+    ) -> None:
+        """
+        Raise `.SSHCommandError` if `result` is not as expected.
+
+        :param result: result of command.
+        :param expect: same as `expect` of `exec`.
+        :param output: raw output of command.
+        """
         if expect != None:
             if (isinstance(expect, int) and expect != result.rc) or \
                     (isinstance(expect, str) and expect not in result):
                 msg = textwrap.dedent(f"""\
                 Expections not met:
-                Command: {cmd}
+                Command: {result.cmd}
                 Excpect: {expect}
                 ReturnCode: {result.rc}
                 Output:
                     {output}
                 """)
                 raise SSHCommandError(msg)
-        return result
+
+    def stream(
+        self,
+        cmd: str,
+        timeout: Optional[int] = None,
+        shenvs: dict = {},
+        lines: bool = True,
+        cwd: str = None
+    ) -> SSHCommandStream:
+        """
+        Execute a command on the SSH server and iterate its output as it arrives.
+
+        :param cmd: the command to be executed.
+        :param timeout: command timeout (seconds), None means no timeout.
+        :param shenvs: shell environment variables for command.
+        :param lines: yield lines if True, otherwise yield chunks as they arrive.
+        :param cwd: working directory for command, defaults to the one set by `cd`.
+        :return: iterator of output(stdout and stderr), `rc` is set when it ends.
+
+        :raises:
+            `TimeoutError` -- if the command execution is timedout.
+
+        >>> with stream('tail -f /var/log/messages') as s:     # doctest: +SKIP
+        ...     for line in s:                              # doctest: +SKIP
+        ...         if 'error' in line:                     # doctest: +SKIP
+        ...             break                               # doctest: +SKIP
+        >>> s = stream('journalctl -b')                     # doctest: +SKIP
+        >>> n = sum(1 for _ in s)                           # doctest: +SKIP
+        >>> s.rc                                            # doctest: +SKIP
+        0
+        """
+        cmd, envs = self._prepare(cmd, shenvs, cwd)
+        self._logger.info(f"Stream command: '{cmd}'")
+        channel = open_command(self.transport, cmd, envs,
+                               timeout=timeout)
+        encoding = envs['LANG'].split('.')[-1]
+        return SSHCommandStream(channel, cmd, timeout, encoding, lines)
+
+    def shell(self, shenvs: dict = {}, timeout: int = 15) -> ShellSession:
+        """
+        Start a persistent shell to execute many commands with little
+        overhead each, it starts in the directory set by `cd`.
+
+        :param shenvs: shell environment variables for the shell.
+        :param timeout: timeout (seconds) for opening the channel.
+        :return: see `ShellSession`.
+
+        >>> with shell() as sh:                         # doctest: +SKIP
+        ...     sh.exec('cd /tmp && export X=1')        # doctest: +SKIP
+        ...     sh.exec('echo $PWD $X')                 # doctest: +SKIP
+        '/tmp 1'
+        """
+        _, envs = self._prepare('', shenvs, '')
+        self._logger.info('Starting shell...')
+        return ShellSession(self, envs, _cwds.get().get(self, ''), timeout)
 
     def sudo(self, cmd, *args, **kwargs) -> SSHCommandResult:
         """
@@ -293,17 +894,54 @@ class SSHConnection(object):
         """
         change current directory.
 
+        It only applies to the current thread (or asyncio task), so other
+        threads can execute commands in other directories at the same time.
+
         >>> with cd('/my/workdir'):     # doctest: +SKIP
         ...     d = exec('pwd')         # doctest: +SKIP
         ...                             # doctest: +SKIP
         >>> d                           # doctest: +SKIP
         '/my/workdir'                   # doctest: +SKIP
         """
-        self._cdlock.acquire()
+        cwds = _cwds.get().copy()
+        cwds[self] = path
+        token = _cwds.set(cwds)
         try:
-            self._cwd = path
             yield
         finally:
-            self._cwd = ''
-            self._cdlock.release()
+            _cwds.reset(token)
+
+    @contextmanager
+    def env(self, **shenvs: str) -> Generator[None, str, None]:
+        """
+        set shell environment variables, scoped like `cd`.
 
+        >>> with env(LANG='C'):         # doctest: +SKIP
+        ...     exec('locale')          # doctest: +SKIP
+        """
+        envs = _envs.get().copy()
+        envs[self] = dict(envs.get(self, {}), **shenvs)
+        token = _envs.set(envs)
+        try:
+            yield
+        finally:
+            _envs.reset(token)
+
+    def _prepare(
+        self,
+        cmd: str,
+        shenvs: dict,
+        cwd: Optional[str]
+    ) -> Tuple[str, dict]:
+        """
+        Apply the working directory and merge environment variables.
+
+        :return: (command, environment variables).
+        """
+        cwd = _cwds.get().get(self, '') if cwd is None else cwd
+        if cwd:
+            cmd = f'cd {cwd} && {cmd}'
+        envs = self._shenvs.copy()
+        envs.update(_envs.get().get(self, {}))
+        envs.update(shenvs)
+        return cmd, envs
@@ -0,0 +1,312 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Directory synchronization module.
+"""
+
+import os
+import time
+import socket
+import hashlib
+
+from paramiko import SFTPClient, SFTPAttributes
+from paramiko.sftp import CMD_SETSTAT, CMD_REMOVE, CMD_RMDIR
+
+from xbot.plugins.ssh.channel import ChannelReader, open_command
+from xbot.plugins.ssh.compat import adjust_path
+from xbot.plugins.ssh.transfer import FileTransfer, TreeTransfer, pipeline
+from xbot.plugins.ssh.walk import Walker
+from xbot.plugins.ssh.throttle import Limiter
+
+
+class SyncReport(object):
+    """
+    Report of a synchronization, paths are relative to the synchronized dir.
+    """
+    def __init__(self, dryrun: bool = False):
+        """
+        :param dryrun: whether nothing was changed.
+        """
+        self.dryrun = dryrun
+        self.dirs = []
+        self.created = []
+        self.updated = []
+        self.patched = []
+        self.deleted = []
+        self.unchanged = 0
+        self.sent = 0
+        self.elapsed = 0.0
+
+    @property
+    def changed(self) -> bool:
+        """
+        Whether the remote dir differs (or differed) from the local dir.
+        """
+        return bool(self.dirs or self.created or self.updated
+                    or self.patched or self.deleted)
+
+    def __repr__(self) -> str:
+        return (f'SyncReport(dryrun={self.dryrun}, dirs={len(self.dirs)}, '
+                f'created={len(self.created)}, updated={len(self.updated)}, '
+                f'patched={len(self.patched)}, deleted={len(self.deleted)}, '
+                f'unchanged={self.unchanged}, sent={self.sent}, '
+                f'elapsed={self.elapsed:.3f})')
+
+
+class DirSync(object):
+    """
+    One-way synchronization of a local dir to a remote dir.
+
+    Files are compared by size and mtime, or by block checksums if
+    `checksum` is True. Changed files larger than `DELTASIZE` which exist
+    on both sides are compared block by block, the checksums of the remote
+    blocks are computed on the server (`split` and `md5sum` through an exec
+    channel of the same transport), and only the blocks that differ are
+    sent. Other new or changed files are sent as a whole. The mtime of the
+    remote files is set to the local one, so they are skipped next time.
+    """
+    BLOCKSIZE = 131072
+    DELTASIZE = 1048576
+
+    def __init__(
+        self,
+        sftpclient: SFTPClient,
+        concurrency: int = 8,
+        checksum: bool = False,
+        blocksize: int = BLOCKSIZE,
+        limiter: Limiter = None,
+        hashtimeout: float = FileTransfer.VERIFYTIMEOUT
+    ):
+        """
+        :param sftpclient: client of the connection.
+        :param concurrency: number of files transferred at the same time.
+        :param checksum: compare files of same size by checksums instead of mtime.
+        :param blocksize: size of the blocks compared by checksums.
+        :param limiter: bandwidth limit of the transfers.
+        :param hashtimeout: seconds allowed to compute the checksums of
+            remote files, whole files are sent if it expires.
+        """
+        self._sftpclient = sftpclient
+        self._concurrency = concurrency
+        self._checksum = checksum
+        self._blocksize = blocksize
+        self._limiter = limiter
+        self._hashtimeout = hashtimeout
+
+    def run(
+        self,
+        ldir: str,
+        rdir: str,
+        delete: bool = False,
+        dryrun: bool = False
+    ) -> SyncReport:
+        """
+        Make remote dir `rdir` same as local dir `ldir`.
+
+        :param ldir: local dir.
+        :param rdir: remote dir, its parent must exist.
+        :param delete: delete remote files and dirs which are not in `ldir`.
+        :param dryrun: only report what would be done.
+        """
+        start = time.monotonic()
+        report = SyncReport(dryrun)
+        ldirs, lfiles = self._lscan(ldir)
+        rdirs, rfiles = self._rscan(rdir)
+        for rel in ldirs:
+            if rel in rfiles:
+                raise IOError(f'Not a directory: {self._rpath(rdir, rel)}')
+            if rel not in rdirs:
+                report.dirs.append(rel)
+        for rel in lfiles:
+            if rel in rdirs:
+                raise IOError(f'Is a directory: {self._rpath(rdir, rel)}')
+
+        # (rel, ranges or None for whole file)
+        sends, touches, hashing = [], [], []
+        for rel, (size, mtime) in lfiles.items():
+            rattr = rfiles.get(rel)
+            if rattr is None:
+                report.created.append(rel)
+                sends.append((rel, None))
+            elif self._checksum and size == rattr.st_size:
+                hashing.append(rel)
+            elif size != rattr.st_size or mtime != rattr.st_mtime:
+                if min(size, rattr.st_size) >= self.DELTASIZE:
+                    hashing.append(rel)
+                else:
+                    report.updated.append(rel)
+                    sends.append((rel, None))
+            else:
+                report.unchanged += 1
+        rhashes = self._rhashes([self._rpath(rdir, rel) for rel in hashing])
+        for rel in hashing:
+            lfile = os.path.join(ldir, *rel.split('/'))
+            blocks = rhashes.get(self._rpath(rdir, rel))
+            if blocks is None:
+                report.updated.append(rel)
+                sends.append((rel, None))
+                continue
+            ranges = self._diff(lfile, blocks)
+            if ranges or lfiles[rel][0] != rfiles[rel].st_size:
+                report.patched.append(rel)
+                sends.append((rel, ranges))
+            else:
+                report.unchanged += 1
+                if lfiles[rel][1] != rfiles[rel].st_mtime:
+                    touches.append(rel)
+        if delete:
+            report.deleted.extend(rel for rel in rfiles if rel not in lfiles)
+            report.deleted.extend(rel for rel in rdirs if rel not in ldirs)
+        report.sent = sum(lfiles[rel][0] if ranges is None else sum(r[1] for r in ranges)
+                          for rel, ranges in sends)
+        if not dryrun:
+            self._apply(ldir, rdir, report, sends, rdirs)
+            self._touch(rdir, [rel for rel, _ in sends] + touches, lfiles)
+        report.elapsed = time.monotonic() - start
+        return report
+
+    def _apply(
+        self,
+        ldir: str,
+        rdir: str,
+        report: SyncReport,
+        sends: list,
+        rdirs: set
+    ) -> None:
+        """
+        Delete extra entries, create dirs and send files.
+        """
+        client = self._sftpclient
+        files = [rel for rel in report.deleted if rel not in rdirs]
+        self._check(files, pipeline(client, [
+            (CMD_REMOVE, adjust_path(client, self._rpath(rdir, rel))) for rel in files]))
+        levels = {}
+        for rel in report.deleted:
+            if rel in rdirs:
+                levels.setdefault(rel.count('/'), []).append(rel)
+        for _, level in sorted(levels.items(), reverse=True):
+            self._check(level, pipeline(client, [
+                (CMD_RMDIR, adjust_path(client, self._rpath(rdir, rel))) for rel in level]))
+        transfer = TreeTransfer(client, self._concurrency, limiter=self._limiter)
+        transfer.mkdirs([self._rpath(rdir, rel) for rel in report.dirs])
+        lpath = lambda rel: os.path.join(ldir, *rel.split('/'))
+        transfer.put([(lpath(rel), self._rpath(rdir, rel))
+                      for rel, ranges in sends if ranges is None])
+        transfer.patch([(lpath(rel), self._rpath(rdir, rel), ranges)
+                        for rel, ranges in sends if ranges is not None])
+
+    def _touch(self, rdir: str, rels: list, lfiles: dict) -> None:
+        """
+        Set the mtime of remote files to the one of local files.
+        """
+        client = self._sftpclient
+        requests = []
+        for rel in rels:
+            attr = SFTPAttributes()
+            attr.st_atime = attr.st_mtime = lfiles[rel][1]
+            requests.append((CMD_SETSTAT, adjust_path(client, self._rpath(rdir, rel)), attr))
+        self._check(rels, pipeline(client, requests))
+
+    def _check(self, rels: list, replies: list) -> None:
+        """
+        Raise the first error of pipelined requests.
+        """
+        for rel, r in zip(rels, replies):
+            if isinstance(r, Exception):
+                raise IOError(f'{rel}: {r}')
+
+    def _lscan(self, ldir: str) -> tuple:
+        """
+        :return: (set of dirs, dict maps file to (size, mtime)).
+        """
+        dirs, files = {''}, {}
+        for top, ds, fs in os.walk(ldir):
+            rel = os.path.relpath(top, ldir)
+            prefix = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+            dirs.update(prefix + d for d in ds)
+            for f in fs:
+                st = os.stat(os.path.join(top, f))
+                files[prefix + f] = (st.st_size, int(st.st_mtime))
+        return dirs, files
+
+    def _rscan(self, rdir: str) -> tuple:
+        """
+        :return: (set of dirs, dict maps file to `SFTPAttributes`).
+        """
+        dirs, files = set(), {}
+        n = len(rdir.rstrip('/')) + 1
+        try:
+            for _, ds, fs in Walker(self._sftpclient, self._concurrency).walk(rdir):
+                dirs.update(d.path[n:] for d in ds)
+                files.update((f.path[n:], f.attr) for f in fs)
+        except FileNotFoundError:
+            return set(), {}
+        dirs.add('')
+        return dirs, files
+
+    def _rpath(self, rdir: str, rel: str) -> str:
+        return f"{rdir.rstrip('/')}/{rel}".rstrip('/')
+
+    def _rhashes(self, rfiles: list) -> dict:
+        """
+        Compute block checksums of remote files on the server.
+
+        :return: maps file to list of md5 of its blocks, or None if they
+            can not be computed, empty if they are not computed within
+            `hashtimeout`.
+        """
+        if not rfiles:
+            return {}
+        cmd = ('while IFS= read -r f; do printf "#%s\\n" "$f"; '
+               f'split -b {self._blocksize} --filter=md5sum -- "$f" 2>/dev/null '
+               '|| printf "!\\n"; done')
+        transport = self._sftpclient.get_channel().get_transport()
+        deadline = time.monotonic() + self._hashtimeout
+        try:
+            channel = open_command(transport, cmd, pty=False, timeout=self._hashtimeout)
+            try:
+                channel.settimeout(max(deadline - time.monotonic(), 0))
+                channel.sendall(('\n'.join(rfiles) + '\n').encode('utf-8'))
+                channel.shutdown_write()
+                reader = ChannelReader(channel, deadline - time.monotonic())
+                chunks = []
+                data = reader.read()
+                while data:
+                    chunks.append(data)
+                    data = reader.read()
+                rc = reader.exit_status()
+            finally:
+                channel.close()
+        except (TimeoutError, socket.timeout):
+            return {}
+        hashes, cur = {}, None
+        if rc != 0:
+            return hashes
+        for line in b''.join(chunks).decode('utf-8', errors='ignore').splitlines():
+            if line.startswith('#'):
+                cur = line[1:]
+                hashes[cur] = []
+            elif line == '!':
+                hashes[cur] = None
+            elif cur is not None and hashes[cur] is not None:
+                hashes[cur].append(line.split()[0])
+        return hashes
+
+    def _diff(self, lfile: str, blocks: list) -> list:
+        """
+        Compare blocks of local file `lfile` with checksums `blocks`.
+
+        :return: list of (offset, length) of the blocks which differ,
+            adjacent blocks are merged.
+        """
+        ranges = []
+        size = self._blocksize
+        with open(lfile, 'rb') as f:
+            for i, data in enumerate(iter(lambda: f.read(size), b'')):
+                if i < len(blocks) and hashlib.md5(data).hexdigest() == blocks[i]:
+                    continue
+                if ranges and ranges[-1][0] + ranges[-1][1] == i * size:
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1] + len(data))
+                else:
+                    ranges.append((i * size, len(data)))
+        return ranges
@@ -0,0 +1,179 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Bandwidth throttling module.
+"""
+
+import time
+import threading
+
+from typing import Generator, Optional
+from collections import Counter
+from contextlib import contextmanager
+
+
+class TokenBucket(object):
+    """
+    Token bucket which refills `rate` tokens (bytes) per second up to
+    `burst`, tokens may be borrowed, the borrower then waits until they
+    are refilled.
+
+    >>> bucket = TokenBucket(100, burst=100)
+    >>> bucket.reserve(100)
+    0.0
+    >>> round(bucket.reserve(50), 1)
+    0.5
+    """
+    def __init__(self, rate: float, burst: float = None):
+        """
+        :param rate: bytes per second.
+        :param burst: maximum bytes available at once, defaults to `rate`.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: float) -> float:
+        """
+        Take `n` tokens.
+
+        :return: seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= n
+            return max(-self._tokens / self.rate, 0.0)
+
+
+class Scheduler(object):
+    """
+    Bandwidth limits of bulk data, global and per host, and priority of
+    control-plane commands over bulk data.
+
+    While a command (`SSHConnection.exec`) runs on a host, each byte of
+    bulk data to the host costs 1 / `BULKSHARE` tokens, so transfers to
+    the host slow down to `BULKSHARE` of their limits (including their
+    share of the global limit) and leave the rest of the link to the
+    commands. Transfers to other hosts are not slowed down. Priority only
+    has an effect when a limit is set.
+
+    >>> scheduler.setlimit(100 * 1048576)                       # doctest: +SKIP
+    >>> scheduler.setlimit(20 * 1048576, host='192.168.8.8')    # doctest: +SKIP
+    """
+    BULKSHARE = 0.25
+
+    def __init__(self):
+        self._global = None
+        self._hosts = {}
+        self._control = Counter()
+        self._lock = threading.Lock()
+
+    def setlimit(self, rate: float, host: str = None, burst: float = None) -> None:
+        """
+        Limit bulk data to `rate` bytes per second, 0 removes the limit.
+
+        Without any limit (of the host, global or of the connection),
+        transfers are not slowed down while commands run, see `Scheduler`.
+
+        :param host: address of the host (as in `Transport.getpeername`),
+            None for the global limit.
+        :param burst: same as `TokenBucket`.
+        """
+        bucket = TokenBucket(rate, burst) if rate > 0 else None
+        with self._lock:
+            if host is None:
+                self._global = bucket
+            elif bucket:
+                self._hosts[host] = bucket
+            else:
+                self._hosts.pop(host, None)
+
+    @contextmanager
+    def control(self, host: str) -> Generator[None, None, None]:
+        """
+        Mark a control-plane command running on `host`.
+        """
+        with self._lock:
+            self._control[host] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._control[host] -= 1
+                if not self._control[host]:
+                    del self._control[host]
+
+    def consume(self, host: str, n: int, bucket: TokenBucket = None) -> None:
+        """
+        Wait until `n` bytes of bulk data may be sent to or received from
+        `host`.
+
+        :param bucket: limit of the connection.
+
+        >>> s = Scheduler()
+        >>> s.setlimit(1000)
+        >>> with s.control('192.168.8.8'):
+        ...     s.consume('192.168.8.9', 100)
+        ...     s.consume('192.168.8.8', 100)
+        >>> round(s._global._tokens, -1)
+        500.0
+        """
+        with self._lock:
+            buckets = [b for b in (bucket, self._hosts.get(host), self._global) if b is not None]
+            busy = host in self._control
+        cost = n / self.BULKSHARE if busy else n
+        wait = 0.0
+        for b in buckets:
+            wait = max(wait, b.reserve(cost))
+        if wait > 0:
+            time.sleep(wait)
+
+
+# The scheduler of the process.
+scheduler = Scheduler()
+
+
+class Limiter(object):
+    """
+    Bandwidth limit of the bulk data of one connection.
+    """
+    __slots__ = ('host', 'bucket')
+
+    def __init__(self, host: str, bucket: Optional[TokenBucket] = None):
+        """
+        :param host: address of the host.
+        :param bucket: limit of the connection.
+        """
+        self.host = host
+        self.bucket = bucket
+
+    def consume(self, n: int) -> None:
+        """
+        Wait until `n` bytes may be transferred.
+        """
+        scheduler.consume(self.host, n, self.bucket)
+
+
+class ThrottledFile(object):
+    """
+    File object whose reads and writes are throttled by a `Limiter`.
+    """
+    def __init__(self, f, limiter: Limiter):
+        self._f = f
+        self._limiter = limiter
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self._limiter.consume(len(data))
+        return data
+
+    def write(self, data: bytes) -> int:
+        self._limiter.consume(len(data))
+        return self._f.write(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self._f, name)
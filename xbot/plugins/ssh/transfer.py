@@ -0,0 +1,931 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Chunked SFTP transfer module.
+"""
+
+import os
+import json
+import mmap
+import errno
+import shlex
+import stat
+import time
+import zlib
+import hashlib
+import socket
+import tempfile
+import weakref
+import threading
+import contextlib
+
+from typing import Any, BinaryIO, Callable, Generator, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from paramiko import SFTPClient, SFTPFile, SFTPAttributes, SSHException, Transport
+from paramiko.sftp import CMD_STATUS, CMD_MKDIR, CMD_STAT
+
+from xbot.plugins.ssh.channel import ChannelReader, open_command
+from xbot.plugins.ssh.compat import (ReplyHandler, adjust_path, async_request, attributes,
+                                     convert_status, drain_writes, read_response)
+from xbot.plugins.ssh.errors import SFTPTransferError
+from xbot.plugins.ssh.monitor import FileTiming, TransferMonitor
+from xbot.plugins.ssh.throttle import Limiter
+
+
+class TransferStats(object):
+    """
+    Statistics of a transfer.
+    """
+    def __init__(self, files: int = 0, size: int = 0, elapsed: float = 0.0):
+        """
+        :param files: number of files transferred.
+        :param size: number of bytes transferred.
+        :param elapsed: seconds elapsed.
+        """
+        self.files = files
+        self.size = size
+        self.elapsed = elapsed
+        # True or False if the data was verified, None if not.
+        self.verified = None
+
+    @property
+    def throughput(self) -> float:
+        """
+        MB per second.
+
+        >>> TransferStats(1, 8 * 1024 * 1024, 2).throughput
+        4.0
+        """
+        return self.size / 1048576 / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def filerate(self) -> float:
+        """
+        Files per second.
+        """
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self) -> str:
+        return (f'TransferStats(files={self.files}, size={self.size}, '
+                f'elapsed={self.elapsed:.3f}, throughput={self.throughput:.2f}MB/s, '
+                f'filerate={self.filerate:.2f}/s)')
+
+
+class ChannelPool(object):
+    """
+    Extra SFTP channels of the workers of the transfers on one transport.
+
+    The server limits the sessions of a connection (`MaxSessions`, 10 by
+    default for OpenSSH), so at most `MAXCHANNELS` channels are open at
+    once for all transfers on a transport, the others share them. A
+    released channel is kept for the next worker while channels are in
+    use, and closed when none is.
+
+    >>> with ChannelPool.of(transport).clients(7) as clients:  # doctest: +SKIP
+    ...     len(clients)
+    6
+    """
+    MAXCHANNELS = 6
+
+    _pools = weakref.WeakKeyDictionary()
+    _poolslock = threading.Lock()
+
+    def __init__(self, transport: Transport, size: int = MAXCHANNELS):
+        """
+        :param transport: an authenticated transport.
+        :param size: maximum number of open channels.
+        """
+        self._transport = transport
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._inuse = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, transport: Transport) -> 'ChannelPool':
+        """
+        The pool of `transport`.
+        """
+        with cls._poolslock:
+            pool = cls._pools.get(transport)
+            if pool is None:
+                pool = cls._pools[transport] = cls(transport, cls.MAXCHANNELS)
+            return pool
+
+    @contextlib.contextmanager
+    def clients(self, n: int) -> Generator[list, None, None]:
+        """
+        Take up to `n` clients, fewer (maybe none) if the pool is full or
+        the server refuses to open more channels.
+
+        The clients are closed instead of being kept if an exception is
+        raised, as their requests may be left unanswered.
+        """
+        clients = []
+        while len(clients) < n:
+            client = self._acquire()
+            if client is None:
+                break
+            clients.append(client)
+        ok = False
+        try:
+            yield clients
+            ok = True
+        finally:
+            self._release(clients, ok)
+
+    def _acquire(self) -> Optional[SFTPClient]:
+        if not self._semaphore.acquire(blocking=False):
+            return None
+        with self._lock:
+            self._inuse += 1
+            while self._idle:
+                client = self._idle.pop()
+                if not client.get_channel().closed:
+                    return client
+        try:
+            return SFTPClient.from_transport(self._transport)
+        except (SSHException, EOFError, OSError):
+            self._release([None], False)
+            return None
+
+    def _release(self, clients: list, keep: bool) -> None:
+        closing = []
+        with self._lock:
+            for client in clients:
+                if client is None:
+                    pass
+                elif keep:
+                    self._idle.append(client)
+                else:
+                    closing.append(client)
+                self._inuse -= 1
+            if not self._inuse:
+                closing.extend(self._idle)
+                self._idle.clear()
+        for _ in clients:
+            self._semaphore.release()
+        for client in closing:
+            client.close()
+
+
+class FileTransfer(object):
+    """
+    Transfer of files split into ranges.
+
+    The ranges of a file are spread over up to `concurrency` workers, each
+    worker has its own SFTP channel on the same transport (the first one
+    uses the given client, the others come from the `ChannelPool`, fewer
+    workers are used if it runs out of channels), so the transfer is not
+    limited by the window of one channel. Inside a channel, reads are prefetched with `readv` and
+    writes are pipelined, so many requests are in flight at once. Local
+    data is read and written at the offsets of the ranges.
+
+    >>> FileTransfer(sftpclient, concurrency=8).get('/tmp/big.iso', '/home/big.iso')  # doctest: +SKIP
+    TransferStats(files=1, size=4294967296, elapsed=21.337, throughput=191.97MB/s, filerate=0.05/s)
+    """
+    CHUNKSIZE = 8388608
+    BLOCKSIZE = 1048576
+    DEPTH = 64
+    VERIFYTIMEOUT = 600
+
+    def __init__(
+        self,
+        sftpclient: SFTPClient,
+        chunksize: int = CHUNKSIZE,
+        concurrency: int = 4,
+        resume: bool = False,
+        verify: bool = False,
+        monitor: TransferMonitor = None,
+        limiter: Limiter = None,
+        verifytimeout: float = VERIFYTIMEOUT
+    ):
+        """
+        :param sftpclient: client of the connection.
+        :param chunksize: size of the ranges (bytes).
+        :param concurrency: maximum number of channels used for one file.
+        :param resume: make the transfer resumable, see `get` and `put`.
+        :param verify: verify the transferred data, see `get` and `put`.
+        :param monitor: fed with the progress of the transfer.
+        :param limiter: bandwidth limit of the transfer.
+        :param verifytimeout: seconds to wait for the md5 computed by the
+            server, the transfer is not verified (`verified` is None) when
+            it is reached.
+        """
+        self._sftpclient = sftpclient
+        self._chunksize = max(chunksize, 1)
+        self._concurrency = max(concurrency, 1)
+        self._resume = resume
+        self._verify = verify
+        self._monitor = monitor
+        self._limiter = limiter
+        self._verifytimeout = verifytimeout
+
+    def get(self, rfile: str, lfile: str, attr: SFTPAttributes = None) -> TransferStats:
+        """
+        Get remote file `rfile` to local file `lfile`.
+
+        If resumable, data is written to `lfile`.part and the completed
+        ranges are saved in `lfile`.part.json, a later call continues with
+        the ranges not completed (or whose checksum does not match) and
+        skips the file if `lfile` has the size and mtime of `rfile`.
+
+        If verified, the md5 of each range is computed while it is written
+        and compared with the ones computed on the server meanwhile, see
+        `_rdigests`.
+
+        :param attr: attributes of `rfile` if already known, saves a stat.
+        :raises:
+            `.SFTPTransferError` -- if the verification fails.
+        """
+        start = time.monotonic()
+        if attr is None:
+            attr = self._sftpclient.stat(rfile)
+        size = attr.st_size
+        target, checkpoint = lfile, None
+        if self._resume:
+            st = os.stat(lfile) if os.path.isfile(lfile) else None
+            if st and st.st_size == size and int(st.st_mtime) == attr.st_mtime:
+                self._filedone(rfile, size, 0, [])
+                return TransferStats(1, 0, time.monotonic() - start)
+            target = lfile + '.part'
+            checkpoint = Checkpoint(lfile + '.part.json', {
+                'rfile': rfile, 'size': size, 'mtime': attr.st_mtime,
+                'chunksize': self._chunksize})
+        ranges = self._ranges(size)
+        done = self._completed(checkpoint, target, ranges) if checkpoint else {}
+        with open(target, 'r+b' if done else 'wb') as f:
+            _preallocate(f, size)
+        todo = [r for r in ranges if r[0] not in done]
+        digests = {} if self._verify else None
+        if self._verify:
+            executor = ThreadPoolExecutor(1)
+            rdigests = executor.submit(self._rdigests, rfile)
+            executor.shutdown(wait=False)
+
+        def work(client: SFTPClient, ranges: list) -> tuple:
+            # (offset, length, offset of the range, end of the range)
+            blocks = [(o, min(self.BLOCKSIZE, offset + length - o), offset, offset + length)
+                      for offset, length in ranges
+                      for o in range(offset, offset + length, self.BLOCKSIZE)]
+            readv = [b[:2] for b in blocks]
+            t0 = time.monotonic()
+            with client.open(rfile, 'rb') as rf, open(target, 'r+b', buffering=0) as lf:
+                t1 = time.monotonic()
+                crc, md5 = 0, hashlib.md5()
+                for (offset, length, first, end), data in zip(blocks, rf.readv(readv, self.DEPTH)):
+                    if len(data) != length:
+                        raise IOError(f'Short read of {rfile} at {offset}: '
+                                      f'{len(data)} of {length} bytes')
+                    _pwrite(lf, data, offset)
+                    if self._limiter:
+                        self._limiter.consume(length)
+                    if self._monitor:
+                        self._monitor.update(length)
+                    if checkpoint:
+                        crc = zlib.crc32(data, crc)
+                    if digests is not None:
+                        md5.update(data)
+                    if offset + length == end:
+                        if checkpoint:
+                            checkpoint.add(first, crc)
+                        if digests is not None:
+                            digests[first] = md5.hexdigest()
+                        crc, md5 = 0, hashlib.md5()
+                t2 = time.monotonic()
+            return t1 - t0, t2 - t0, time.monotonic() - t0
+
+        timings = []
+        try:
+            if todo:
+                timings = self._run(work, todo)
+        finally:
+            if checkpoint:
+                checkpoint.save()
+        stats = TransferStats(1, sum(r[1] for r in todo), time.monotonic() - start)
+        if digests is not None:
+            self._check(rfile, stats, ranges, digests, target, rdigests.result(), checkpoint)
+        if checkpoint:
+            os.replace(target, lfile)
+            os.utime(lfile, (attr.st_atime or attr.st_mtime, attr.st_mtime))
+            checkpoint.remove()
+        stats.elapsed = time.monotonic() - start
+        self._filedone(rfile, size, stats.size, timings)
+        return stats
+
+    def put(self, lfile: str, rfile: str) -> TransferStats:
+        """
+        Put local file `lfile` to remote file `rfile`.
+
+        If resumable, data is written to `rfile`.part and the completed
+        ranges are saved in a local checkpoint (under the temp dir), a
+        later call continues with the ranges not completed (or changed
+        locally since) and skips the file if `rfile` has the size and
+        mtime of `lfile`.
+
+        If verified, the md5 of each range is computed while it is sent
+        and compared with the ones computed on the server afterwards, see
+        `_rdigests`, so the local file is read only once.
+
+        :raises:
+            `.SFTPTransferError` -- if the verification fails.
+        """
+        start = time.monotonic()
+        st = os.stat(lfile)
+        size, mtime = st.st_size, int(st.st_mtime)
+        ranges = self._ranges(size)
+        target, checkpoint, done = rfile, None, {}
+        if self._resume:
+            try:
+                rattr = self._sftpclient.stat(rfile)
+                if rattr.st_size == size and rattr.st_mtime == mtime:
+                    self._filedone(rfile, size, 0, [])
+                    return TransferStats(1, 0, time.monotonic() - start)
+            except FileNotFoundError:
+                pass
+            target = rfile + '.part'
+            host, port = self._sftpclient.get_channel().get_transport().getpeername()[:2]
+            key = hashlib.sha1(f'{host}:{port}:{rfile}'.encode('utf-8')).hexdigest()
+            checkpoint = Checkpoint(os.path.join(Checkpoint.DIR, key + '.json'), {
+                'lfile': os.path.abspath(lfile), 'size': size, 'mtime': mtime,
+                'chunksize': self._chunksize})
+            done = self._completed(checkpoint, lfile, ranges)
+            try:
+                if done and self._sftpclient.stat(target).st_size != size:
+                    done = {}
+            except FileNotFoundError:
+                done = {}
+        mode = 'r+b' if done else 'wb'
+        if not done and (checkpoint or len(ranges) > 1 and self._concurrency > 1):
+            with self._sftpclient.open(target, 'wb') as f:
+                f.truncate(size)
+            mode = 'r+b'
+        todo = [r for r in ranges if r[0] not in done]
+        digests = {} if self._verify else None
+
+        def work(client: SFTPClient, ranges: list) -> tuple:
+            t0 = time.monotonic()
+            with client.open(target, mode) as rf, _mapped(lfile) as buf:
+                t1 = time.monotonic()
+                self._write(buf, rf, ranges, checkpoint and checkpoint.add, digests)
+                t2 = time.monotonic()
+            return t1 - t0, t2 - t0, time.monotonic() - t0
+
+        timings = []
+        try:
+            if todo:
+                timings = self._run(work, todo)
+            elif not ranges:
+                self._sftpclient.open(target, 'wb').close()
+        finally:
+            if checkpoint:
+                checkpoint.save()
+        stats = TransferStats(1, sum(r[1] for r in todo), time.monotonic() - start)
+        if digests is not None:
+            self._check(rfile, stats, ranges, digests, lfile, self._rdigests(target), checkpoint)
+        if checkpoint:
+            try:
+                self._sftpclient.posix_rename(target, rfile)
+            except IOError:
+                if os.path.basename(rfile) in self._sftpclient.listdir(
+                        os.path.dirname(rfile) or '.'):
+                    self._sftpclient.remove(rfile)
+                self._sftpclient.rename(target, rfile)
+            self._sftpclient.utime(rfile, (mtime, mtime))
+            checkpoint.remove()
+        stats.elapsed = time.monotonic() - start
+        self._filedone(rfile, size, stats.size, timings)
+        return stats
+
+    def patch(self, lfile: str, rfile: str, ranges: list) -> TransferStats:
+        """
+        Put only `ranges` of local file `lfile` to existing remote file
+        `rfile`, then truncate it to the size of `lfile`.
+
+        :param ranges: list of (offset, length).
+        """
+        start = time.monotonic()
+        size = os.path.getsize(lfile)
+        with self._sftpclient.open(rfile, 'r+b') as rf, _mapped(lfile) as buf:
+            self._write(buf, rf, ranges)
+            if rf.stat().st_size != size:
+                rf.truncate(size)
+        return TransferStats(1, sum(r[1] for r in ranges), time.monotonic() - start)
+
+    def _write(
+        self,
+        buf: memoryview,
+        rf: SFTPFile,
+        ranges: list,
+        ondone: Callable[[int, int], None] = None,
+        digests: dict = None
+    ) -> None:
+        """
+        Write `ranges` of local data `buf` to remote file `rf` with
+        pipelined requests, blocks are sent as slices of `buf`, so they
+        are not copied.
+
+        :param ondone: called with (offset, crc32) of each range once the
+            server has acknowledged it.
+        :param digests: filled with offset => md5 of each range if given.
+        """
+        rf.set_pipelined(True)
+        for start, length in ranges:
+            rf.seek(start)
+            offset, end, crc, md5 = start, start + length, 0, hashlib.md5()
+            if end > len(buf):
+                raise IOError(f'Short read of local file at {len(buf)}')
+            while offset < end:
+                data = buf[offset:min(offset + self.BLOCKSIZE, end)]
+                if self._limiter:
+                    self._limiter.consume(len(data))
+                rf.write(data)
+                offset += len(data)
+                if self._monitor:
+                    self._monitor.update(len(data))
+                if ondone:
+                    crc = zlib.crc32(data, crc)
+                if digests is not None:
+                    md5.update(data)
+            if digests is not None:
+                digests[start] = md5.hexdigest()
+            if ondone:
+                rf.flush()
+                drain_writes(rf)
+                ondone(start, crc)
+        rf.flush()
+        drain_writes(rf)
+
+    def _completed(self, checkpoint: 'Checkpoint', path: str, ranges: list) -> dict:
+        """
+        Load the completed ranges of `checkpoint` and keep those whose
+        data in local file `path` still matches the checksum.
+
+        :return: maps offset to crc32 of the verified ranges.
+        """
+        done = checkpoint.load()
+        if not done or not os.path.isfile(path):
+            return {}
+        lengths = dict(ranges)
+        verified = {}
+        with open(path, 'rb') as f:
+            for offset, crc in done.items():
+                if offset not in lengths:
+                    continue
+                f.seek(offset)
+                remaining, value = lengths[offset], 0
+                while remaining > 0:
+                    data = f.read(min(self.BLOCKSIZE, remaining))
+                    if not data:
+                        break
+                    value = zlib.crc32(data, value)
+                    remaining -= len(data)
+                if remaining == 0 and value == crc:
+                    verified[offset] = crc
+        checkpoint.reset(verified)
+        return verified
+
+    def _rdigests(self, rfile: str) -> Optional[list]:
+        """
+        Compute md5 of the ranges of remote file `rfile` on the server,
+        with `split` and `md5sum` through an exec channel of the same
+        transport, or with the "check-file" extension (on its own SFTP
+        channel, it runs beside the workers) if that fails.
+
+        :return: list of hex digests, or None if they can not be computed
+            within `verifytimeout`.
+        """
+        cmd = f'split -b {self._chunksize} --filter=md5sum -- {shlex.quote(rfile)}'
+        transport = self._sftpclient.get_channel().get_transport()
+        deadline = time.monotonic() + self._verifytimeout
+        try:
+            channel = open_command(transport, cmd, pty=False, timeout=self._verifytimeout)
+            try:
+                channel.shutdown_write()
+                reader = ChannelReader(channel, deadline - time.monotonic())
+                chunks = []
+                data = reader.read()
+                while data:
+                    chunks.append(data)
+                    data = reader.read()
+                if reader.exit_status() == 0:
+                    lines = b''.join(chunks).decode('utf-8', errors='ignore').splitlines()
+                    return [line.split()[0] for line in lines]
+            finally:
+                channel.close()
+        except TimeoutError:
+            return None
+        except SSHException:
+            pass
+        try:
+            client = SFTPClient.from_transport(transport)
+            try:
+                client.get_channel().settimeout(max(deadline - time.monotonic(), 0))
+                with client.open(rfile, 'rb') as f:
+                    data = f.check('md5', 0, 0, self._chunksize)
+            finally:
+                client.close()
+            return [data[i:i + 16].hex() for i in range(0, len(data), 16)]
+        except (IOError, SSHException, socket.timeout):
+            return None
+
+    def _check(
+        self,
+        rfile: str,
+        stats: TransferStats,
+        ranges: list,
+        digests: dict,
+        path: str,
+        rdigests: Optional[list],
+        checkpoint: 'Checkpoint' = None
+    ) -> None:
+        """
+        Compare md5 of the ranges with `rdigests` and set `stats.verified`,
+        the ranges not in `digests` (completed by an earlier transfer) are
+        read from local file `path`. The ranges which differ are dropped
+        from `checkpoint`, so they are transferred again when resumed.
+
+        :raises:
+            `.SFTPTransferError` -- if a range differs.
+        """
+        if rdigests is None:
+            return
+        bad = []
+        for i, (offset, length) in enumerate(ranges):
+            digest = digests.get(offset)
+            if digest is None:
+                digest = self._digest(path, offset, length)
+            if i >= len(rdigests) or rdigests[i] != digest:
+                bad.append(offset)
+        if len(rdigests) != len(ranges) and not bad:
+            bad.append(len(ranges) * self._chunksize)
+        stats.verified = not bad
+        if bad:
+            if checkpoint:
+                checkpoint.discard(bad)
+            raise SFTPTransferError(f'Verification of {rfile} failed, ranges at '
+                                    f'{bad} differ', stats)
+
+    def _digest(self, path: str, offset: int, length: int) -> str:
+        """
+        md5 of `length` bytes at `offset` of local file `path`.
+        """
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(self.BLOCKSIZE, length))
+                if not data:
+                    break
+                md5.update(data)
+                length -= len(data)
+        return md5.hexdigest()
+
+    def _ranges(self, size: int) -> list:
+        """
+        Split `size` bytes into (offset, length) ranges.
+
+        >>> FileTransfer(None, chunksize=4)._ranges(10)
+        [(0, 4), (4, 4), (8, 2)]
+        """
+        return [(o, min(self._chunksize, size - o))
+                for o in range(0, size, self._chunksize)]
+
+    def _filedone(self, path: str, size: int, transferred: int, timings: list) -> None:
+        """
+        Report a file to the monitor.
+
+        :param size: size of the file.
+        :param transferred: bytes transferred, the others were skipped.
+        :param timings: list of (opened, written, closed) of the workers.
+        """
+        if not self._monitor:
+            return
+        self._monitor.skip(size - transferred)
+        timing = FileTiming(path, transferred)
+        for t in timings:
+            timing.add(*t)
+        self._monitor.filedone(timing)
+
+    def _run(self, work: Callable[[SFTPClient, list], Any], ranges: list) -> list:
+        """
+        Spread `ranges` over the workers and call `work` in each of them.
+
+        :return: results of `work`.
+        """
+        n = min(self._concurrency, len(ranges))
+        if n <= 1:
+            return [work(self._sftpclient, ranges)]
+        transport = self._sftpclient.get_channel().get_transport()
+        with ChannelPool.of(transport).clients(n - 1) as clients:
+            clients = [self._sftpclient] + clients
+            n = len(clients)
+            if n == 1:
+                return [work(self._sftpclient, ranges)]
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                futures = [executor.submit(work, c, ranges[i::n])
+                           for i, c in enumerate(clients)]
+                return [f.result() for f in futures]
+
+
+class Checkpoint(object):
+    """
+    Completed ranges of a resumable transfer, saved as JSON.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), 'f.part.json')
+    >>> c = Checkpoint(path, {'size': 8})
+    >>> c.add(0, 1234); c.save()
+    >>> Checkpoint(path, {'size': 8}).load(), Checkpoint(path, {'size': 9}).load()
+    ({0: 1234}, {})
+    """
+    DIR = os.path.join(tempfile.gettempdir(), 'xbot-resume')
+    INTERVAL = 1.0
+
+    def __init__(self, path: str, meta: dict):
+        """
+        :param path: path of the checkpoint file.
+        :param meta: what identifies the transfer, a saved checkpoint with
+            other meta is ignored.
+        """
+        self._path = path
+        self._meta = meta
+        self._done = {}
+        self._saved = time.monotonic()
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        """
+        :return: maps offset to crc32 of the completed ranges.
+        """
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('meta') != self._meta:
+            return {}
+        return {int(k): v for k, v in data.get('done', {}).items()}
+
+    def reset(self, done: dict) -> None:
+        with self._lock:
+            self._done = dict(done)
+
+    def discard(self, offsets: list) -> None:
+        """
+        Forget the ranges at `offsets` and save.
+        """
+        with self._lock:
+            for offset in offsets:
+                self._done.pop(offset, None)
+        self.save()
+
+    def add(self, offset: int, crc: int) -> None:
+        """
+        Record a completed range, saved at most every `INTERVAL` seconds.
+        """
+        with self._lock:
+            self._done[offset] = crc
+            if time.monotonic() - self._saved < self.INTERVAL:
+                return
+        self.save()
+
+    def save(self) -> None:
+        with self._lock:
+            data = {'meta': self._meta, 'done': self._done}
+            os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self._path)
+            self._saved = time.monotonic()
+
+    def remove(self) -> None:
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class TreeTransfer(object):
+    """
+    Transfer of many files with a pool of workers.
+
+    Each worker has its own SFTP channel on the same transport (the first
+    one uses the given client, the others come from the `ChannelPool`) and
+    transfers one file after another, so up to `concurrency` files are in
+    flight at once, fewer if the pool runs out of channels. Remote directories
+    are created level by level with pipelined requests, which costs one
+    round-trip per level instead of several per directory.
+
+    >>> TreeTransfer(sftpclient, concurrency=16).put(pairs)     # doctest: +SKIP
+    TransferStats(files=20000, size=81920000, elapsed=35.128, throughput=2.22MB/s, filerate=569.34/s)
+    """
+    def __init__(
+        self,
+        sftpclient: SFTPClient,
+        concurrency: int = 8,
+        chunksize: int = FileTransfer.CHUNKSIZE,
+        resume: bool = False,
+        monitor: TransferMonitor = None,
+        limiter: Limiter = None
+    ):
+        """
+        :param sftpclient: client of the connection.
+        :param concurrency: number of workers.
+        :param chunksize: same as `FileTransfer`.
+        :param resume: same as `FileTransfer`, for `get` and `put`.
+        :param monitor: same as `FileTransfer`.
+        :param limiter: same as `FileTransfer`.
+        """
+        self._sftpclient = sftpclient
+        self._concurrency = max(concurrency, 1)
+        self._chunksize = chunksize
+        self._resume = resume
+        self._monitor = monitor
+        self._limiter = limiter
+
+    def get(self, items: list) -> TransferStats:
+        """
+        Get remote files to local files.
+
+        :param items: list of (remote file, local file, `SFTPAttributes` or
+            None), larger files first.
+        """
+        def func(client: SFTPClient, rfile: str, lfile: str, attr: SFTPAttributes) -> int:
+            transfer = FileTransfer(client, self._chunksize, 1, self._resume,
+                                    monitor=self._monitor, limiter=self._limiter)
+            return transfer.get(rfile, lfile, attr).size
+        items = sorted(items, key=lambda i: i[2].st_size if i[2] else 0, reverse=True)
+        return self._run(func, items)
+
+    def put(self, pairs: list) -> TransferStats:
+        """
+        Put local files to remote files, larger files first.
+
+        :param pairs: list of (local file, remote file).
+        """
+        def func(client: SFTPClient, lfile: str, rfile: str) -> int:
+            transfer = FileTransfer(client, self._chunksize, 1, self._resume,
+                                    monitor=self._monitor, limiter=self._limiter)
+            return transfer.put(lfile, rfile).size
+        pairs = sorted(pairs, key=lambda p: os.path.getsize(p[0]), reverse=True)
+        return self._run(func, pairs)
+
+    def patch(self, items: list) -> TransferStats:
+        """
+        Put changed ranges of local files to existing remote files.
+
+        :param items: list of (local file, remote file, ranges), see
+            `FileTransfer.patch`.
+        """
+        def func(client: SFTPClient, lfile: str, rfile: str, ranges: list) -> int:
+            transfer = FileTransfer(client, self._chunksize, 1, limiter=self._limiter)
+            return transfer.patch(lfile, rfile, ranges).size
+        return self._run(func, items)
+
+    def mkdirs(self, paths: list) -> None:
+        """
+        Create remote directories, existing ones are skipped.
+
+        The parent of each path must exist or be in `paths`.
+
+        :raises:
+            `IOError` -- if a path can not be created as a directory.
+        """
+        client = self._sftpclient
+        levels = {}
+        for p in paths:
+            levels.setdefault(p.rstrip('/').count('/'), []).append(p)
+        for _, level in sorted(levels.items()):
+            attr = SFTPAttributes()
+            attr.st_mode = 0o777
+            replies = pipeline(client, [(CMD_MKDIR, adjust_path(client, p), attr)
+                                        for p in level])
+            failed = [p for p, r in zip(level, replies) if isinstance(r, Exception)]
+            if not failed:
+                continue
+            replies = pipeline(client, [(CMD_STAT, adjust_path(client, p))
+                                        for p in failed])
+            for p, r in zip(failed, replies):
+                if isinstance(r, Exception) or \
+                        not stat.S_ISDIR(attributes(r[1]).st_mode):
+                    raise IOError(f'Can not create dir {p}')
+
+    def _run(self, func: Callable[..., int], items: list) -> TransferStats:
+        """
+        Call `func(client, *item)` for each item in the workers.
+        """
+        start = time.monotonic()
+        queue = deque(items)
+
+        def worker(client: SFTPClient) -> int:
+            size = 0
+            try:
+                while True:
+                    try:
+                        item = queue.popleft()
+                    except IndexError:
+                        return size
+                    size += func(client, *item)
+            except Exception:
+                queue.clear()
+                raise
+
+        n = min(self._concurrency, len(items))
+        if n <= 1:
+            size = worker(self._sftpclient)
+        else:
+            transport = self._sftpclient.get_channel().get_transport()
+            with ChannelPool.of(transport).clients(n - 1) as clients:
+                clients = [self._sftpclient] + clients
+                with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+                    futures = [executor.submit(worker, c) for c in clients]
+                    size = sum(f.result() for f in futures)
+        return TransferStats(len(items), size, time.monotonic() - start)
+
+
+class _Replies(ReplyHandler):
+    """
+    Collector of the replies of asynchronous SFTP requests.
+    """
+    def __init__(self, sftpclient: SFTPClient):
+        self._sftpclient = sftpclient
+        self.replies = {}
+
+    def onreply(self, t: int, msg, num: int) -> None:
+        if t == CMD_STATUS:
+            try:
+                convert_status(self._sftpclient, msg)
+            except Exception as e:
+                self.replies[num] = e
+                return
+        self.replies[num] = (t, msg)
+
+
+def pipeline(sftpclient: SFTPClient, requests: list) -> list:
+    """
+    Send SFTP requests at once and wait for all of the replies.
+
+    :param sftpclient: client not used by other threads meanwhile.
+    :param requests: list of (command, *arguments).
+    :return: (type, message) of the replies, or the exception for failed
+        requests, in the order of `requests`.
+    """
+    replies = _Replies(sftpclient)
+    nums = [async_request(sftpclient, replies, *r) for r in requests]
+    while len(replies.replies) < len(nums):
+        read_response(sftpclient)
+    return [replies.replies[n] for n in nums]
+
+
+@contextlib.contextmanager
+def _mapped(path: str) -> Generator[memoryview, None, None]:
+    """
+    Map local file `path` read-only.
+
+    :return: memoryview of the whole file (empty for an empty file).
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b'')
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield memoryview(m)
+        finally:
+            try:
+                m.close()
+            except BufferError:
+                # slices are still referenced (e.g. by a traceback), the
+                # map is closed when they are collected.
+                pass
+
+
+def _preallocate(f: BinaryIO, size: int) -> None:
+    """
+    Set the size of local file `f` to `size`, the blocks are allocated
+    (so a full disk fails here instead of during the transfer) where the
+    platform supports it.
+    """
+    f.truncate(size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+
+
+def _pwrite(f: BinaryIO, data: bytes, offset: int) -> None:
+    """
+    Write `data` at `offset` of unbuffered local file `f`.
+    """
+    if hasattr(os, 'pwrite'):
+        while data:
+            n = os.pwrite(f.fileno(), data, offset)
+            data, offset = data[n:], offset + n
+    else:
+        f.seek(offset)
+        f.write(data)
@@ -8,6 +8,15 @@ import re
 import string
 
 
+_ANSI_ESCAPES = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
+# ASCII characters which are not in `string.printable` => None.
+_UNPRINTABLE = {c: None for c in range(128) if chr(c) not in string.printable}
+
+# Printable line boundaries of `str.splitlines` other than '\r' and '\n' => '\n'.
+_LINEBREAKS = {ord('\x0b'): '\n', ord('\x0c'): '\n'}
+
+
 def remove_ansi_escape_chars(s: str) -> str:
     """
     Remove ansi esacpe characters from `s`.
@@ -15,8 +24,9 @@ def remove_ansi_escape_chars(s: str) -> str:
     >>> remove_ansi_escape_chars('\x1b[31mhello\x1b[0m')
     'hello'
     """
-    escapes = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-    return escapes.sub('', s)
+    if '\x1b' not in s:
+        return s
+    return _ANSI_ESCAPES.sub('', s)
 
 
 def remove_unprintable_chars(s: str) -> str:
@@ -26,5 +36,27 @@ def remove_unprintable_chars(s: str) -> str:
     >>> remove_unprintable_chars('hello\xe9')
     'hello'
     """
-    return ''.join(c for c in s if c in string.printable)
+    if not s.isascii():
+        s = s.encode('ascii', errors='ignore').decode('ascii')
+    return s.translate(_UNPRINTABLE)
+
+
+def sanitize(s: str) -> str:
+    """
+    Remove ansi escape and unprintable characters from `s`, join its
+    lines with '\\n' and strip it.
+
+    Same result as the functions above followed by `splitlines`, `join`
+    and `strip`, but each step is a single pass in C (regex, codec and
+    translate table) and the steps with nothing to do are skipped.
+
+    >>> sanitize('\x1b[01;34mdir\x1b[0m\\r\\n 50%\\r100%\xe9\\r\\n')
+    'dir\\n 50%\\n100%'
+    """
+    s = remove_unprintable_chars(remove_ansi_escape_chars(s))
+    if '\r' in s:
+        s = s.replace('\r\n', '\n').replace('\r', '\n')
+    if '\x0b' in s or '\x0c' in s:
+        s = s.translate(_LINEBREAKS)
+    return s.strip()
 
@@ -0,0 +1,182 @@
+# Copyright (c) 2023-2024, zhaowcheng <zhaowcheng@163.com>
+
+"""
+Remote directory walking module.
+"""
+
+import stat
+
+from typing import Generator, Optional, Tuple
+from collections import deque
+
+from paramiko import SFTPClient, SFTPAttributes
+from paramiko.sftp import (CMD_OPENDIR, CMD_READDIR, CMD_CLOSE, CMD_HANDLE,
+                           CMD_NAME, CMD_STATUS, SFTPError)
+
+from xbot.plugins.ssh.compat import (ReplyHandler, adjust_path, async_request,
+                                     attributes, convert_status, read_response)
+
+
+class SFTPEntry(object):
+    """
+    Entry of a remote directory, similar to `os.DirEntry`.
+    """
+    __slots__ = ('name', 'path', 'attr')
+
+    def __init__(self, top: str, attr: SFTPAttributes):
+        """
+        :param top: the directory.
+        :param attr: attributes of the entry.
+
+        >>> attr = SFTPAttributes()
+        >>> attr.filename, attr.st_mode = 'xbot', 0o40755
+        >>> e = SFTPEntry('/tmp/', attr)
+        >>> e.path, e.is_dir(), e.is_file()
+        ('/tmp/xbot', True, False)
+        """
+        self.name = attr.filename
+        self.path = f"{top.rstrip('/')}/{self.name}"
+        self.attr = attr
+
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.attr.st_mode or 0)
+
+    def is_file(self) -> bool:
+        return stat.S_ISREG(self.attr.st_mode or 0)
+
+    def is_symlink(self) -> bool:
+        return stat.S_ISLNK(self.attr.st_mode or 0)
+
+    def stat(self) -> SFTPAttributes:
+        """
+        Attributes fetched with the listing (symlinks are not followed).
+        """
+        return self.attr
+
+    def __repr__(self) -> str:
+        return f'<SFTPEntry {self.path!r}>'
+
+
+class Walker(object):
+    """
+    Iterative walk of remote directories.
+
+    Up to `concurrency` directories are listed at the same time with
+    pipelined requests on one channel, and the attributes of the listing
+    are kept in the entries, so nothing needs to be stat again.
+
+    >>> for top, dirs, files in Walker(sftpclient).walk('/tmp'):    # doctest: +SKIP
+    ...     print(top, [f.attr.st_size for f in files])             # doctest: +SKIP
+    """
+    def __init__(self, sftpclient: SFTPClient, concurrency: int = 8):
+        """
+        :param sftpclient: client not used by other threads meanwhile.
+        :param concurrency: maximum number of directories listed at the same time.
+        """
+        self._sftpclient = sftpclient
+        self._concurrency = max(concurrency, 1)
+
+    def scandir(self, path: str) -> list:
+        """
+        List `path`.
+
+        :return: list of `SFTPEntry`.
+        """
+        for _, dirs, files in self.walk(path, recursive=False):
+            return dirs + files
+
+    def walk(
+        self,
+        top: str,
+        recursive: bool = True
+    ) -> Generator[Tuple[str, list, list], None, None]:
+        """
+        Similar to os.walk(), parents are yielded before children, and the
+        dirs removed from `dirs` by the caller are not walked.
+
+        :return: (dir, list of `SFTPEntry` of dirs, list of `SFTPEntry` of others).
+        """
+        client = self._sftpclient
+        lister = _Lister(client)
+        todo = deque([top])
+        try:
+            while todo or lister.requests or lister.ready:
+                while todo and len(lister.requests) < self._concurrency:
+                    lister.opendir(todo.popleft())
+                if not lister.ready:
+                    read_response(client)
+                    continue
+                path, entries, error = lister.ready.popleft()
+                if error:
+                    raise error
+                dirs = [e for e in entries if e.is_dir()]
+                files = [e for e in entries if not e.is_dir()]
+                yield path, dirs, files
+                if recursive:
+                    todo.extend(d.path for d in dirs)
+        finally:
+            lister.closed = True
+
+
+class _Lister(ReplyHandler):
+    """
+    Directory listings driven by the replies of pipelined requests.
+    """
+    def __init__(self, sftpclient: SFTPClient):
+        self._sftpclient = sftpclient
+        self.requests = {}
+        self.ready = deque()
+        self.closed = False
+
+    def opendir(self, path: str) -> None:
+        self._send(path, None, None, CMD_OPENDIR,
+                   adjust_path(self._sftpclient, path))
+
+    def _send(
+        self,
+        path: str,
+        handle: Optional[bytes],
+        entries: Optional[list],
+        t: int,
+        *args
+    ) -> None:
+        num = async_request(self._sftpclient, self, t, *args)
+        self.requests[num] = (path, handle, entries)
+
+    def _close(self, handle: bytes) -> None:
+        async_request(self._sftpclient, None, CMD_CLOSE, handle)
+
+    def onreply(self, t: int, msg, num: int) -> None:
+        """
+        Handle the reply of a request and send the next one.
+        """
+        path, handle, entries = self.requests.pop(num)
+        if t == CMD_HANDLE:
+            handle = msg.get_binary()
+            if self.closed:
+                return self._close(handle)
+            self._send(path, handle, [], CMD_READDIR, handle)
+        elif t == CMD_NAME:
+            for _ in range(msg.get_int()):
+                filename = msg.get_text()
+                longname = msg.get_text()
+                attr = attributes(msg, filename, longname)
+                if filename not in ('.', '..'):
+                    entries.append(SFTPEntry(path, attr))
+            if self.closed:
+                return self._close(handle)
+            self._send(path, handle, entries, CMD_READDIR, handle)
+        else:
+            if handle is not None:
+                self._close(handle)
+            if self.closed:
+                return
+            try:
+                if t != CMD_STATUS:
+                    raise SFTPError(f'Unexpected response {t} for {path}')
+                convert_status(self._sftpclient, msg)
+                raise SFTPError(f'Expected handle or name for {path}')
+            except EOFError:
+                self.ready.append((path, entries, None))
+            except Exception as e:
+                self.ready.append((path, None, e))